@@ -6,8 +6,26 @@ Real-time anomaly detection for authentication logs
 __version__ = "0.1.0"
 __author__ = "Your Name"
 
-from .collector import KeystoneLogCollector
-from .ai_engine import AnomalyDetector
-from .policy_advisor import PolicyAdvisor
+import importlib
 
-__all__ = ['KeystoneLogCollector', 'AnomalyDetector', 'PolicyAdvisor']
\ No newline at end of file
+__all__ = ['KeystoneLogCollector', 'AnomalyDetector', 'PolicyAdvisor']
+
+# Import pigri (PEP 562): pandas/sklearn sono caricati solo al primo uso
+# delle classi, non per `import ai_security_advisor` o per il client
+_LAZY_ATTRS = {
+    'KeystoneLogCollector': '.collector',
+    'AnomalyDetector': '.ai_engine',
+    'PolicyAdvisor': '.policy_advisor',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRS))
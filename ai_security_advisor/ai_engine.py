@@ -6,7 +6,21 @@ from datetime import datetime, timedelta
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
 from collections import defaultdict
+from typing import Dict, Any, Iterable, List
 import logging
+import threading
+
+from .baselines import HourOfWeekBaseline
+from .sketches import SpaceSaving, BloomFilter, ip_prefix24
+from .correlation import SprayTracker
+from .online import SlidingWindowForest
+from .scoring import ScoringEngine
+from .flat_forest import FlatForest
+from .sampling import StratifiedReservoir, strata_keys
+from .segments import CohortAssigner, SegmentedDetector
+from .drift import DriftMonitor
+from .registry import ModelRegistry, is_registry_path
+from .hot_swap import ModelWatcher
 
 # Disabilita alcuni warning
 import warnings
@@ -20,8 +34,93 @@ LOG = logging.getLogger(__name__)
 class AnomalyDetector:
     """Motore AI per rilevamento anomalie - VERSIONE CORRETTA"""
 
-    def __init__(self, model_path: str = None):
-        self.model = IsolationForest(
+    # Schema delle feature prodotte da prepare_features (nomi e ordine):
+    # il suo hash è salvato nel manifest dei modelli del registro
+    FEATURE_NAMES = [
+        'hour', 'day_of_week', 'is_weekend', 'user_id', 'ip_first',
+        'failure_rate', 'request_frequency', 'is_failed', 'hour_sin',
+        'hour_cos', 'how_deviation', 'ip_distinct_users', 'user_distinct_ips'
+    ]
+
+    DEFAULT_CONFIG = {
+        'baseline_half_life_hours': 336,  # 2 settimane
+        'baseline_min_events': 20,
+        'ip_topk_size': 16,  # IP più frequenti tracciati per utente
+        'ip_bloom_bits': 2048,  # 0 disabilita il filtro di Bloom
+        'ip_bloom_hashes': 4,
+        'ip_bloom_granularity': 'prefix24',  # 'prefix24' oppure 'ip'
+        'mode': 'batch',  # 'online' = foresta a finestra scorrevole
+        'online_trees_per_batch': 10,
+        'online_max_trees': 100,
+        'online_max_batch_rows': 4096,
+        'online_min_batch_rows': 32,
+        'online_contamination': 0.01,
+        'scoring_chunk_size': 10000,  # righe per blocco nello scoring parallelo
+        'scoring_threads': 0,  # 0 = tutti i core
+        'inference_engine': 'flat',  # 'flat' (array NumPy) oppure 'sklearn'
+        'training_max_samples': 200000,  # budget righe del reservoir di training
+        'training_chunk_size': 50000,  # eventi letti per blocco dallo storico
+        'segmentation': None,  # None, 'domain', 'role' oppure 'cluster'
+        'segment_dir': 'models/segments',
+        'segment_cache_mb': 256,  # budget RAM dei modelli di coorte caricati
+        'segment_min_rows': 200,  # sotto questa soglia si usa il modello globale
+        'segment_workers': 0,  # processi per l'addestramento (0 = tutti i core)
+        'segment_estimators': 25,
+        'segment_clusters': 8,
+        'service_users': [],
+        'admin_users': ['admin'],
+        'drift_threshold': 0.25,  # PSI oltre cui si segnala drift
+        'drift_min_events': 1000,  # eventi osservati tra due valutazioni
+        'drift_bins': 20,
+        'drift_reference_rows': 50000,  # campione uniforme per il riferimento del drift
+        'drift_features': ['failure_rate', 'request_frequency', 'how_deviation', 'ip_first'],
+        'registry_keep_versions': 5,  # versioni conservate nel registro modelli
+        'hot_swap_poll_seconds': 30,  # intervallo di controllo del registro
+        'hot_swap_shadow_rows': 2048,  # righe recenti per validare un nuovo modello
+        'hot_swap_max_anomaly_rate': 0.2,  # oltre, la nuova versione è scartata
+        'explain_top_k': 5,  # anomalie spiegate per report
+        'spray_window_minutes': 10,  # finestra di utenti distinti per IP e IP distinti per utente
+        'spray_sketch_width': 4096,  # celle HyperLogLog per riga e per minuto
+        'spray_sketch_depth': 2,
+        'spray_hll_precision': 6  # 2^6 registri per cella (errore ~13%)
+    }
+
+    def __init__(self, model_path: str = None, config: Dict[str, Any] = None):
+        self.config = dict(self.DEFAULT_CONFIG)
+        self.config.update(config or {})
+        # Il modo effettivo segue il modello caricato; l'addestramento usa
+        # sempre quello configurato
+        self.configured_mode = self.config['mode']
+
+        self.model = self._new_batch_model()
+        self.scaler = StandardScaler()
+        if self.online:
+            self.model = self._new_online_model()
+            self.scaler = self.model.scaler
+        self.user_profiles = defaultdict(dict)
+        self.baselines = self._new_baselines()
+        self.correlation = self._new_correlation()
+        self.scoring = ScoringEngine(
+            chunk_size=self.config['scoring_chunk_size'],
+            n_threads=self.config['scoring_threads']
+        )
+        self._flat_forest = None
+        self.segments = self._new_segments()
+        self.feature_names = None
+        self.drift = None
+        self.on_drift = None  # callback(report) invocata quando scatta il drift
+        self.model_version = None  # versione del registro in uso
+        self.shadow_batch = None  # ultime feature analizzate (validazione a caldo)
+        self._staged_state = None
+        self._swap_lock = threading.Lock()
+
+        if model_path:
+            self.load_model(model_path)
+
+    @staticmethod
+    def _new_batch_model() -> IsolationForest:
+        """IsolationForest del modo batch"""
+        return IsolationForest(
             n_estimators=50,  # Ottimizzato da auto-tuning
             contamination=0.01,  # Solo 1% anomalie (più conservativo)
             random_state=42,
@@ -30,11 +129,79 @@ class AnomalyDetector:
             bootstrap=True,  # Migliore stabilità
             n_jobs=-1  # Usa tutti i core CPU
         )
-        self.scaler = StandardScaler()
-        self.user_profiles = defaultdict(dict)
 
-        if model_path:
-            self.load_model(model_path)
+    @property
+    def online(self) -> bool:
+        """True se il detector usa il modello online incrementale"""
+        return self.config['mode'] == 'online'
+
+    def _new_online_model(self) -> SlidingWindowForest:
+        """Crea la foresta online secondo la configurazione"""
+        return SlidingWindowForest(
+            trees_per_batch=self.config['online_trees_per_batch'],
+            max_trees=self.config['online_max_trees'],
+            max_batch_rows=self.config['online_max_batch_rows'],
+            min_batch_rows=self.config['online_min_batch_rows'],
+            contamination=self.config['online_contamination']
+        )
+
+    def _inference_model(self):
+        """Modello usato per lo scoring: la foresta esportata in array piatti
+        quando configurata, altrimenti il modello sklearn/online"""
+        if self.config['inference_engine'] != 'flat' or not isinstance(self.model, IsolationForest):
+            return self.model
+        return self._flat_model()
+
+    def _flat_model(self) -> FlatForest:
+        """FlatForest esportata dalla IsolationForest corrente (in cache)"""
+        if self._flat_forest is None or self._flat_forest[0] is not self.model:
+            self._flat_forest = (self.model, FlatForest.from_isolation_forest(self.model))
+        return self._flat_forest[1]
+
+    def score_one(self, feature_vector: np.ndarray) -> float:
+        """Score (decision_function) di un singolo vettore di feature non
+        scalato: percorso a bassa latenza senza DataFrame né validazione"""
+        x = (np.asarray(feature_vector, dtype=np.float64) - self.scaler.mean_) / self.scaler.scale_
+        model = self._inference_model()
+        if isinstance(model, FlatForest):
+            return model.score_one(x)
+        return float(model.decision_function(x[None, :])[0])
+
+    def _new_segments(self):
+        """Detector segmentato per coorte, se configurato"""
+        if not self.config['segmentation']:
+            return None
+
+        assigner = CohortAssigner(
+            mode=self.config['segmentation'],
+            service_users=self.config['service_users'],
+            admin_users=self.config['admin_users'],
+            n_clusters=self.config['segment_clusters']
+        )
+        return SegmentedDetector(
+            assigner,
+            segment_dir=self.config['segment_dir'],
+            cache_mb=self.config['segment_cache_mb'],
+            min_rows=self.config['segment_min_rows'],
+            workers=self.config['segment_workers'],
+            model_params={'n_estimators': self.config['segment_estimators']}
+        )
+
+    def _new_baselines(self) -> HourOfWeekBaseline:
+        """Crea baseline ora-della-settimana vuote secondo la configurazione"""
+        return HourOfWeekBaseline(
+            half_life_hours=self.config['baseline_half_life_hours'],
+            min_events=self.config['baseline_min_events']
+        )
+
+    def _new_correlation(self) -> SprayTracker:
+        """Crea sketch vuoti di correlazione utenti/IP secondo la configurazione"""
+        return SprayTracker(
+            window_minutes=self.config['spray_window_minutes'],
+            width=self.config['spray_sketch_width'],
+            depth=self.config['spray_sketch_depth'],
+            precision=self.config['spray_hll_precision']
+        )
 
     def prepare_features(self, df: pd.DataFrame) -> pd.DataFrame:
         """Prepara features per il modello ML - VERSIONE SICURA"""
@@ -73,8 +240,17 @@ class AnomalyDetector:
             features['hour_sin'] = np.sin(2 * np.pi * features['hour'] / 24)
             features['hour_cos'] = np.cos(2 * np.pi * features['hour'] / 24)
 
+            # 6. Deviazione dalla baseline ora-della-settimana dell'utente
+            features['how_deviation'] = self.baselines.deviation(df)
+
+            # 7. Utenti distinti per IP e IP distinti per utente nella
+            # finestra scorrevole (gli sketch sono aggiornati col batch)
+            correlation = self.correlation.observe(df)
+            for name in SprayTracker.FEATURES:
+                features[name] = correlation[name].to_numpy()
+
             LOG.debug(f"Features create: {features.shape}")
-            return features
+            return features[self.FEATURE_NAMES]
 
         except Exception as e:
             LOG.error(f"Errore nella preparazione features: {e}")
@@ -147,6 +323,9 @@ class AnomalyDetector:
             return
 
         try:
+            # Sketch di correlazione ricostruiti dallo storico
+            self.correlation = self._new_correlation()
+
             # Prepara features
             features = self.prepare_features(df)
 
@@ -154,28 +333,174 @@ class AnomalyDetector:
                 LOG.warning("Features non sufficienti per l'addestramento")
                 return
 
-            # Salva profili utente (semplificati)
-            for user in df['user'].unique():
-                user_data = df[df['user'] == user]
-                if len(user_data) > 0:
-                    self.user_profiles[user] = {
-                        'usual_ips': list(user_data['ip'].unique())[:5],  # Limita a 5 IP
-                        'total_events': len(user_data),
-                        'last_seen': user_data['timestamp'].max()
-                    }
+            # Profili utente ricostruiti da zero (IP frequenti + conteggi)
+            self.user_profiles = defaultdict(dict)
+            self._update_user_profiles(df)
+
+            # Baseline ora-della-settimana ricostruite da zero
+            self.baselines = self._new_baselines()
+            self.baselines.update(df)
+            features['how_deviation'] = self.baselines.deviation(df)
 
             # Addestra il modello
-            features_array = features.values
+            self.feature_names = list(features.columns)
+            self._fit_model(features.values, df['user'].to_numpy())
+
+        except Exception as e:
+            LOG.error(f"Errore nell'addestramento: {e}")
+            import traceback
+            LOG.error(traceback.format_exc())
+
+    def _fit_model(self, features_array: np.ndarray, users: np.ndarray = None,
+                   reference: np.ndarray = None):
+        """Adatta scaler e modello (batch o online) a una matrice di feature,
+        più i modelli di coorte se la segmentazione è attiva. Il modo
+        (batch/online) è quello della configurazione, anche se il modello
+        caricato prima era dell'altro tipo.
+
+        `reference` sono le righe da cui costruire il riferimento del
+        monitor di drift, se features_array non è un campione uniforme
+        del traffico (es. il reservoir stratificato)"""
+        self.config['mode'] = self.configured_mode
+        if self.segments is not None and users is not None:
+            self.segments.assigner.fit(self.user_profiles, self.baselines)
+            cohorts = self.segments.assigner.assign(
+                pd.Series(users), self.user_profiles, self.baselines
+            )
+            self.segments.fit(features_array, cohorts)
+
+        if self.online:
+            # Modo online: la storia viene consumata a batch successivi
+            self.model = self._new_online_model()
+            self.scaler = self.model.scaler
+            step = self.model.max_batch_rows
+            for start in range(0, len(features_array), step):
+                self.model.partial_fit(features_array[start:start + step])
+            LOG.info(f"✅ Modello online inizializzato su {len(features_array)} campioni")
+        else:
+            if not isinstance(self.model, IsolationForest):
+                # Modello caricato dal registro (solo inferenza): nuovo fit
+                self.model = self._new_batch_model()
+                self.scaler = StandardScaler()
             self.scaler.fit(features_array)
             features_scaled = self.scaler.transform(features_array)
 
             self.model.fit(features_scaled)
-            LOG.info(f"✅ Modello addestrato su {len(features)} campioni")
+            LOG.info(f"✅ Modello addestrato su {len(features_array)} campioni")
+
+        # Riferimento di training per il monitor di drift
+        if not self.online or self.model.is_fitted:
+            if reference is None or len(reference) == 0:
+                reference = features_array
+            scores, _ = self.scoring.score(self._inference_model(),
+                                           self.scaler.transform(reference))
+            self.drift = DriftMonitor(
+                scores, reference, self.feature_names or [],
+                key_features=self.config['drift_features'],
+                n_bins=self.config['drift_bins'],
+                threshold=self.config['drift_threshold'],
+                min_events=self.config['drift_min_events']
+            )
+
+    def _handle_drift(self, report: Dict[str, Any]):
+        """Reazione al drift: nel modo online si scartano gli alberi più
+        vecchi (aggiornamento incrementale), poi si notifica il chiamante
+        (es. per un riaddestramento in background)"""
+        if self.online:
+            self.model.forget(0.5)
+            self.drift.triggered = False
+
+        if self.on_drift is not None:
+            self.on_drift(report)
+
+    def train_streaming(self, chunks: Iterable[pd.DataFrame]) -> bool:
+        """Addestra il modello leggendo lo storico una sola volta, a blocchi.
+
+        Profili utente e baseline sono aggiornati in modo esatto blocco per
+        blocco; scaler e foresta sono adattati su un reservoir stratificato
+        (utente, ora-della-settimana, esito) di al più training_max_samples
+        righe, quindi la memoria dipende dalla configurazione e non dal
+        volume dei log. Le feature a finestra (request_frequency) sono
+        calcolate dentro ciascun blocco; how_deviation è ricalcolata sul
+        campione a fine lettura, con le baseline complete come in train().
+
+        Il riferimento del monitor di drift viene da un secondo reservoir
+        uniforme (uno strato solo): quello stratificato sovra-rappresenta
+        gli strati rari e non descrive il traffico che il monitor osserva.
+        """
+        reservoir = StratifiedReservoir(self.config['training_max_samples'])
+        uniform = StratifiedReservoir(self.config['drift_reference_rows'], random_state=43)
+        self.user_profiles = defaultdict(dict)
+        self.baselines = self._new_baselines()
+        self.correlation = self._new_correlation()
+        columns = None
+
+        try:
+            for chunk in chunks:
+                if chunk.empty:
+                    continue
+
+                self._update_user_profiles(chunk)
+                self.baselines.update(chunk)
+
+                features = self.prepare_features(chunk)
+                if features.empty:
+                    continue
+
+                columns = list(features.columns)
+                reservoir.add(features.values, strata_keys(chunk), chunk['user'].to_numpy())
+                uniform.add(features.values, np.zeros(len(chunk), dtype=np.uint64),
+                            chunk['user'].to_numpy())
+                LOG.debug(f"Storico: {reservoir.seen} eventi letti, "
+                          f"{len(reservoir)} nel campione")
+
+            LOG.info(f"Addestramento su campione di {len(reservoir)} eventi "
+                     f"({reservoir.n_strata} strati) su {reservoir.seen} letti...")
+
+            if columns is None or len(reservoir) < 10:
+                LOG.warning("Troppi pochi dati per l'addestramento. Richiesti almeno 10 eventi.")
+                return False
+
+            self.feature_names = columns
+            sample = self._refresh_how_deviation(reservoir.sample(), reservoir.labels)
+            reference = self._refresh_how_deviation(uniform.sample(), uniform.labels)
+            self._fit_model(sample, reservoir.labels, reference=reference)
+            return True
 
         except Exception as e:
             LOG.error(f"Errore nell'addestramento: {e}")
             import traceback
             LOG.error(traceback.format_exc())
+            return False
+
+    def _refresh_how_deviation(self, rows: np.ndarray, users: np.ndarray) -> np.ndarray:
+        """Ricalcola la colonna how_deviation di righe campionate con le
+        baseline attuali (nel blocco di origine erano ancora parziali)"""
+        names = self.feature_names or self.FEATURE_NAMES
+        if len(rows) == 0 or 'how_deviation' not in names:
+            return rows
+        events = pd.DataFrame({
+            'user': users,
+            'hour': rows[:, names.index('hour')],
+            'day_of_week': rows[:, names.index('day_of_week')],
+        })
+        rows = rows.copy()
+        rows[:, names.index('how_deviation')] = self.baselines.deviation(events)
+        return rows
+
+    def _score(self, features_array: np.ndarray, features_scaled: np.ndarray,
+               users: pd.Series):
+        """Score e flag di anomalia: modelli di coorte dove disponibili,
+        modello globale per le righe rimanenti"""
+        if self.segments is None or not self.segments.index:
+            return self.scoring.score(self._inference_model(), features_scaled)
+
+        cohorts = self.segments.assigner.assign(users, self.user_profiles, self.baselines)
+        scores, scored = self.segments.score(features_array, cohorts)
+        if not scored.all():
+            global_scores, _ = self.scoring.score(self._inference_model(), features_scaled[~scored])
+            scores[~scored] = global_scores
+        return scores, scores < 0
 
     def detect_anomalies(self, df: pd.DataFrame) -> pd.DataFrame:
         """Rileva anomalie in nuovi eventi - VERSIONE SICURA"""
@@ -187,6 +512,9 @@ class AnomalyDetector:
 
         LOG.info(f"Analisi di {len(df)} eventi...")
 
+        # Nuova versione validata in background: scambio tra un batch e l'altro
+        self._apply_staged_state()
+
         try:
             # Prepara features
             features = self.prepare_features(df)
@@ -199,21 +527,53 @@ class AnomalyDetector:
 
             # Predici anomalie
             features_array = features.values
+            bootstrap = self.online and not self.model.is_fitted
+            if bootstrap:
+                # Avvio a freddo: il primo batch inizializza il modello
+                self.model.partial_fit(features_array)
+                if not self.model.is_fitted:
+                    LOG.info("Modello online in raccolta dati, batch non valutato")
+                    df['anomaly_score'] = 0.0
+                    df['is_anomaly'] = False
+                    return df
+
             features_scaled = self.scaler.transform(features_array)
 
-            # Calcola score e predizioni
-            anomaly_scores = self.model.decision_function(features_scaled)
-            predictions = self.model.predict(features_scaled)
+            # Calcola score e predizioni in un solo passaggio sulla foresta
+            anomaly_scores, is_anomaly = self._score(features_array, features_scaled, df['user'])
+            self.shadow_batch = features_array[-self.config['hot_swap_shadow_rows']:]
 
             # Aggiungi risultati al DataFrame
             df = df.copy()
             df['anomaly_score'] = anomaly_scores
-            df['is_anomaly'] = predictions == -1
+            df['is_anomaly'] = is_anomaly
+
+            # Feature accanto agli eventi: explain() le rilegge solo per le
+            # anomalie scelte per il report, senza ricalcolare il batch
+            for name in self.FEATURE_NAMES:
+                if name not in df.columns:
+                    df[name] = features[name].to_numpy()
 
             # Aggiungi flag comportamentali
             df['unusual_ip'] = self._check_unusual_ip_safe(df)
             df['high_frequency'] = self._check_high_frequency_safe(df, threshold=0.2)
 
+            # Confronto con la distribuzione di training
+            if self.drift is not None:
+                drift_report = self.drift.observe(anomaly_scores, features_array)
+                if drift_report:
+                    self._handle_drift(drift_report)
+
+            # Profilo delle anomalie com'era prima di questo batch, per explain()
+            self._snapshot_profiles(df)
+
+            # Aggiornamento incrementale di profili e baseline (dopo lo
+            # scoring, così il batch corrente non "normalizza" se stesso)
+            self._update_user_profiles(df)
+            self.baselines.update(df)
+            if self.online and not bootstrap:
+                self.model.partial_fit(features_array)
+
             # Statistiche
             anomaly_count = df['is_anomaly'].sum()
             LOG.info(f"✅ Analisi completata: {anomaly_count} anomalie rilevate")
@@ -230,22 +590,221 @@ class AnomalyDetector:
             df['is_anomaly'] = False
             return df
 
-    def _check_unusual_ip_safe(self, df: pd.DataFrame) -> pd.Series:
-        """Controlla se IP è insolito per l'utente - VERSIONE SICURA"""
-        results = []
+    def _explain_forest(self):
+        """Foresta in array piatti per le attribuzioni (None per il modo online)"""
+        model = self._inference_model()
+        if isinstance(model, FlatForest):
+            return model
+        if isinstance(self.model, IsolationForest) and hasattr(self.model, 'estimators_'):
+            return self._flat_model()
+        return None
+
+    def explain(self, events: pd.DataFrame, top_k: int = None) -> List[Dict[str, Any]]:
+        """Spiegazioni delle top_k anomalie (score più basso) di un batch
+        già analizzato da detect_anomalies.
+
+        Per ogni evento:
+            contributions - quota dell'isolamento attribuita a ciascuna
+                            feature lungo i cammini della foresta globale
+            z_scores      - feature più distanti dalla media di training
+            profile       - scostamento dal profilo dell'utente (ora della
+                            settimana, IP insolito, frequenza, fallimenti)
+        Il costo dipende da top_k, non dalla dimensione del batch.
+        """
+        top_k = self.config['explain_top_k'] if top_k is None else int(top_k)
+        if events.empty or top_k <= 0 or not set(self.FEATURE_NAMES).issubset(events.columns):
+            return []
 
-        for idx, row in df.iterrows():
-            user = row['user']
-            ip = row['ip']
+        try:
+            top = events.nsmallest(top_k, 'anomaly_score')
+            scaler = self.scaler
+            forest = self._explain_forest()
+            scaled = scaler.transform(top[self.FEATURE_NAMES].to_numpy(dtype=np.float64))
+            contributions = forest.path_contributions(scaled) if forest is not None else None
+
+            explanations = []
+            for row, (_, event) in enumerate(top.iterrows()):
+                explanation = {
+                    'timestamp': event['timestamp'],
+                    'user': event['user'],
+                    'ip': event['ip'],
+                    'anomaly_score': float(event['anomaly_score']),
+                }
+
+                if contributions is not None and contributions[row].sum() > 0:
+                    shares = contributions[row] / contributions[row].sum()
+                    order = np.argsort(-shares)[:3]
+                    explanation['contributions'] = {
+                        self.FEATURE_NAMES[i]: round(float(shares[i]), 3)
+                        for i in order if shares[i] > 0
+                    }
+
+                order = np.argsort(-np.abs(scaled[row]))[:3]
+                explanation['z_scores'] = {
+                    self.FEATURE_NAMES[i]: round(float(scaled[row, i]), 2) for i in order
+                }
+
+                total, ip_share = self._profile_stats(event)
+                explanation['profile'] = {
+                    'how_deviation': round(float(event['how_deviation']), 3),
+                    'unusual_ip': bool(event.get('unusual_ip', False)),
+                    'high_frequency': bool(event.get('high_frequency', False)),
+                    'failure_rate': round(float(event['failure_rate']), 3),
+                    'request_frequency': round(float(event['request_frequency']), 3),
+                    'user_total_events': int(total),
+                    'ip_share': round(float(ip_share), 3),
+                }
+
+                main_factors = explanation.get('contributions') or explanation['z_scores']
+                explanation['summary'] = ', '.join(
+                    f"{name} {value:.0%}" if 'contributions' in explanation else f"{name} z={value:+.1f}"
+                    for name, value in main_factors.items()
+                )
+                explanations.append(explanation)
+
+            return explanations
+
+        except Exception as e:
+            LOG.error(f"Errore nel calcolo delle spiegazioni: {e}")
+            import traceback
+            LOG.error(traceback.format_exc())
+            return []
+
+    def _snapshot_profiles(self, df: pd.DataFrame):
+        """Aggiunge alle anomalie le statistiche del profilo dell'utente
+        prima dell'aggiornamento col batch (eventi totali e quota dell'IP);
+        le altre righe restano NaN"""
+        total = np.full(len(df), np.nan)
+        ip_share = np.full(len(df), np.nan)
+        users = df['user'].to_numpy()
+        ips = df['ip'].to_numpy()
+        for row in np.flatnonzero(df['is_anomaly'].to_numpy(dtype=bool)):
+            profile = self.user_profiles.get(users[row]) or {}
+            topk = profile.get('ip_topk')
+            total[row] = profile.get('total_events', 0)
+            ip_share[row] = topk.counts.get(ips[row], 0) / total[row] \
+                if topk is not None and total[row] else 0.0
+        df['profile_total_events'] = total
+        df['profile_ip_share'] = ip_share
+
+    def _profile_stats(self, event: pd.Series):
+        """(eventi totali, quota dell'IP) del profilo: dallo snapshot di
+        detect_anomalies se presente, altrimenti dal profilo attuale"""
+        total = event.get('profile_total_events', np.nan)
+        if pd.notna(total):
+            return total, event['profile_ip_share']
+        profile = self.user_profiles.get(event['user']) or {}
+        topk = profile.get('ip_topk')
+        total = profile.get('total_events', 0)
+        return total, topk.counts.get(event['ip'], 0) / total if topk is not None and total else 0.0
+
+    def _new_user_profile(self) -> Dict[str, Any]:
+        """Profilo vuoto: sketch top-k degli IP e filtro di Bloom opzionale"""
+        bloom = None
+        if self.config['ip_bloom_bits'] and self.config['ip_bloom_granularity']:
+            bloom = BloomFilter(self.config['ip_bloom_bits'], self.config['ip_bloom_hashes'])
+
+        return {
+            'ip_topk': SpaceSaving(self.config['ip_topk_size']),
+            'ip_bloom': bloom,
+            'total_events': 0,
+            'last_seen': None
+        }
+
+    def _profile(self, user: str) -> Dict[str, Any]:
+        """Profilo dell'utente, creato o migrato al formato con sketch"""
+        profile = self.user_profiles.get(user)
+        if not profile or 'ip_topk' not in profile:
+            legacy = profile or {}
+            profile = self._new_user_profile()
+            # Profili salvati con la vecchia lista 'usual_ips'
+            for ip in legacy.get('usual_ips', []):
+                profile['ip_topk'].update(ip)
+            if profile['ip_bloom'] is not None and legacy.get('usual_ips'):
+                profile['ip_bloom'].add(self._bloom_keys(legacy['usual_ips']))
+            profile['total_events'] = legacy.get('total_events', 0)
+            profile['last_seen'] = legacy.get('last_seen')
+            self.user_profiles[user] = profile
+        return profile
+
+    def _bloom_keys(self, ips) -> np.ndarray:
+        """Chiavi per il filtro di Bloom secondo la granularità configurata"""
+        if self.config['ip_bloom_granularity'] == 'prefix24':
+            return ip_prefix24(ips)
+        return np.asarray(ips, dtype=object)
+
+    def _update_user_profiles(self, df: pd.DataFrame):
+        """Aggiorna in modo incrementale i profili utente con un batch.
+
+        Solo gli eventi successivi a 'last_seen' vengono contati, così le
+        finestre di raccolta sovrapposte non gonfiano i conteggi.
+        """
+        if df.empty:
+            return
 
-            if user in self.user_profiles:
-                usual_ips = self.user_profiles[user].get('usual_ips', [])
-                results.append(ip not in usual_ips)
-            else:
-                # Nuovo utente: non considerare insolito
-                results.append(False)
+        last_seen = df['user'].map(
+            {user: self._profile(user)['last_seen'] for user in df['user'].unique()}
+        )
+        last_seen = pd.to_datetime(last_seen).fillna(pd.Timestamp.min)
+        fresh = df[df['timestamp'].to_numpy() > last_seen.to_numpy()]
+        if fresh.empty:
+            return
+
+        # Conteggi (utente, IP) aggregati: un update per coppia, non per riga
+        pair_counts = fresh.groupby(['user', 'ip'], sort=False).size()
+        for (user, ip), count in pair_counts.items():
+            self.user_profiles[user]['ip_topk'].update(ip, int(count))
+
+        user_stats = fresh.groupby('user', sort=False)['timestamp'].agg(['size', 'max'])
+        for user, stats in user_stats.iterrows():
+            profile = self.user_profiles[user]
+            profile['total_events'] += int(stats['size'])
+            profile['last_seen'] = stats['max']
+
+        for user, ips in pair_counts.reset_index().groupby('user', sort=False)['ip']:
+            bloom = self.user_profiles[user]['ip_bloom']
+            if bloom is not None:
+                bloom.add(np.unique(self._bloom_keys(ips.to_numpy())))
+
+    def _check_unusual_ip_safe(self, df: pd.DataFrame) -> pd.Series:
+        """Controlla se IP è insolito per l'utente - VERSIONE VETTORIZZATA
+
+        Un IP è insolito se non è tra gli IP più frequenti dell'utente e
+        (con il filtro di Bloom attivo) la sua rete non è mai stata vista.
+        """
+        unusual = pd.Series(False, index=df.index)
+        if df.empty:
+            return unusual
+
+        # Nuovo utente: non considerare insolito
+        known_users = [user for user in df['user'].unique() if user in self.user_profiles]
+        if not known_users:
+            return unusual
+
+        profiles = [self._profile(user) for user in known_users]
+        known_pairs = pd.DataFrame(
+            [(user, ip) for user, profile in zip(known_users, profiles)
+             for ip in profile['ip_topk'].counts],
+            columns=['user', 'ip']
+        )
+        known_pairs['_usual'] = True
+
+        merged = df[['user', 'ip']].merge(known_pairs, on=['user', 'ip'], how='left')
+        usual = merged['_usual'].notna().to_numpy()
+        candidates = df['user'].isin(known_users).to_numpy() & ~usual
+
+        blooms = [profile['ip_bloom'] for profile in profiles]
+        if candidates.any() and all(bloom is not None for bloom in blooms):
+            user_row = {user: row for row, user in enumerate(known_users)}
+            rows = df['user'].to_numpy()[candidates]
+            rows = np.fromiter((user_row[user] for user in rows), dtype=np.int64, count=len(rows))
+            seen = BloomFilter.contains_many(
+                blooms, rows, self._bloom_keys(df['ip'].to_numpy()[candidates])
+            )
+            candidates[np.flatnonzero(candidates)[seen]] = False
 
-        return pd.Series(results, index=df.index)
+        unusual[:] = candidates
+        return unusual
 
     def _check_high_frequency_safe(self, df: pd.DataFrame, threshold: float = 0.2) -> pd.Series:
         """Controlla frequenza eccessiva di tentativi - VERSIONE SICURA"""
@@ -272,27 +831,135 @@ class AnomalyDetector:
         return pd.Series(results, index=df_sorted.index).reindex(df.index).fillna(False)
 
     def save_model(self, path: str):
-        """Salva il modello addestrato"""
+        """Salva il modello addestrato (registro versionato o pickle .pkl)"""
         try:
+            if is_registry_path(path):
+                registry = ModelRegistry(path, self.config['registry_keep_versions'])
+                self.model_version = registry.publish(self)
+                return
+
             with open(path, 'wb') as f:
                 pickle.dump({
                     'model': self.model,
                     'scaler': self.scaler,
-                    'user_profiles': dict(self.user_profiles)
+                    'user_profiles': dict(self.user_profiles),
+                    'baselines': self.baselines,
+                    'segments': self.segments,
+                    'feature_names': self.feature_names,
+                    'drift': self.drift,
+                    'correlation': self.correlation
                 }, f)
             LOG.info(f"Modello salvato in {path}")
         except Exception as e:
             LOG.error(f"Errore nel salvataggio modello: {e}")
 
-    def load_model(self, path: str):
-        """Carica modello pre-addestrato"""
+    def save_state(self, path: str):
+        """Salva profili, baseline, sketch di correlazione e modello online
+        aggiornati dalle analisi. Con il registro non pubblica una nuova
+        versione (solo l'addestramento lo fa) ma sovrascrive lo stato
+        incrementale della versione in uso; con un file .pkl riscrive il file"""
+        if not is_registry_path(path) or self.model_version is None:
+            self.save_model(path)
+            return
+        try:
+            ModelRegistry(path, self.config['registry_keep_versions']).save_live_state(self)
+        except Exception as e:
+            LOG.error(f"Errore nel salvataggio dello stato incrementale: {e}")
+
+    def load_model(self, path: str) -> bool:
+        """Carica modello pre-addestrato (registro versionato o pickle .pkl)"""
         try:
+            if is_registry_path(path):
+                version = ModelRegistry(path).load(self)
+                self.model_version = version
+                LOG.info(f"Modello {version} caricato dal registro {path}")
+                return True
+
             with open(path, 'rb') as f:
                 data = pickle.load(f)
 
-            self.model = data['model']
-            self.scaler = data['scaler']
-            self.user_profiles = defaultdict(dict, data.get('user_profiles', {}))
+            self.install_state({
+                'model': data['model'],
+                'scaler': data['scaler'],
+                'user_profiles': defaultdict(dict, data.get('user_profiles', {})),
+                'baselines': data.get('baselines') or self._new_baselines(),
+                'segments': data.get('segments', self.segments),
+                'feature_names': data.get('feature_names'),
+                'drift': data.get('drift'),
+                'correlation': data.get('correlation'),
+            })
             LOG.info(f"Modello caricato da {path}")
+            return True
         except Exception as e:
-            LOG.error(f"Errore nel caricamento modello: {e}")
\ No newline at end of file
+            LOG.error(f"Errore nel caricamento modello: {e}")
+            return False
+
+    def install_state(self, state: Dict[str, Any]):
+        """Installa modello, scaler e profili caricati (pickle o registro)"""
+        self.model = state['model']
+        self.scaler = state['scaler']
+        # Il modo segue il tipo del modello caricato in entrambe le
+        # direzioni: una foresta batch non ha partial_fit né is_fitted
+        mode = 'online' if isinstance(self.model, SlidingWindowForest) else 'batch'
+        if mode != self.config['mode']:
+            LOG.warning(f"Il modello caricato è di tipo '{mode}' ma la configurazione chiede "
+                        f"'{self.configured_mode}': uso '{mode}' fino al prossimo addestramento (--train)")
+            self.config['mode'] = mode
+        if self.online:
+            # Riprende lo stato online: lo scaler è quello della foresta
+            self.scaler = self.model.scaler
+        self.user_profiles = state['user_profiles']
+        self.baselines = state['baselines']
+        self.segments = state['segments']
+        self.feature_names = state['feature_names']
+        self.drift = state['drift']
+        self.correlation = state.get('correlation') or self._new_correlation()
+        self._flat_forest = None
+
+    def export_state(self) -> Dict[str, Any]:
+        """Stato corrente nella forma di install_state/stage_state"""
+        return {
+            'version': self.model_version,
+            'model': self.model,
+            'scaler': self.scaler,
+            'user_profiles': self.user_profiles,
+            'baselines': self.baselines,
+            'segments': self.segments,
+            'feature_names': self.feature_names,
+            'drift': self.drift,
+            'correlation': self.correlation,
+        }
+
+    @property
+    def staged_version(self):
+        """Versione in attesa di essere installata (None se nessuna)"""
+        staged = self._staged_state
+        return staged['version'] if staged is not None else None
+
+    def stage_state(self, state: Dict[str, Any]):
+        """Prepara uno stato già caricato e validato (es. dal ModelWatcher):
+        verrà installato all'inizio del prossimo batch"""
+        with self._swap_lock:
+            self._staged_state = state
+
+    def _apply_staged_state(self):
+        """Installa lo stato preparato, se presente (solo scambio di riferimenti)"""
+        with self._swap_lock:
+            state, self._staged_state = self._staged_state, None
+        if state is None:
+            return
+
+        # La finestra di correlazione in memoria è più recente di quella pubblicata
+        self.install_state(dict(state, correlation=self.correlation))
+        self.model_version = state.get('version')
+        LOG.info(f"Modello sostituito a caldo con la versione {self.model_version}")
+
+    def watch_registry(self, path: str) -> ModelWatcher:
+        """Avvia un thread che installa a caldo le nuove versioni del registro"""
+        watcher = ModelWatcher(
+            self, path,
+            poll_seconds=self.config['hot_swap_poll_seconds'],
+            max_anomaly_rate=self.config['hot_swap_max_anomaly_rate']
+        )
+        watcher.start()
+        return watcher
@@ -0,0 +1,235 @@
+"""
+Scrittura asincrona di eventi e report fuori dal percorso di rilevamento
+"""
+import logging
+import os
+import pickle
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+LOG = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    """Thread unico che persiste i dati accodati dal loop di rilevamento.
+
+    `sinks` associa un tipo ('events', 'report', ...) alla funzione che lo
+    scrive. submit() non fa I/O: accoda e ritorna. Il thread attende il
+    primo elemento, raccoglie quelli che arrivano entro `window_ms` (fino a
+    `max_batch_rows` righe) e concatena i DataFrame consecutivi dello
+    stesso tipo, così più batch finiscono in una sola chiamata al sink
+    (una transazione SQLite: group commit).
+
+    La coda è limitata a `max_queue` elementi: se è piena l'elemento è
+    scritto in `spill_dir` (pickle) e ripreso quando il writer torna
+    libero, oppure scartato se non c'è una directory di spill. I contatori
+    in stats() rendono visibili scarti, spill ed errori. close() svuota
+    coda e spill prima di terminare.
+    """
+
+    def __init__(self, sinks: Dict[str, Callable[[Any], Any]], max_queue: int = 64,
+                 window_ms: float = 50, max_batch_rows: int = 100000,
+                 spill_dir: Optional[str] = None, idle_seconds: float = 1.0):
+        self.sinks = dict(sinks)
+        self.window = float(window_ms) / 1000.0
+        self.max_batch_rows = int(max_batch_rows)
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.idle_seconds = float(idle_seconds)
+        self.queue: queue.Queue = queue.Queue(maxsize=int(max_queue))
+
+        self._lock = threading.Lock()
+        self._spill_seq = 0
+        self._stopping = False
+        self.counters = {
+            'submitted': 0,  # elementi accodati
+            'written': 0,  # elementi scritti dai sink
+            'commits': 0,  # chiamate ai sink (dopo il raggruppamento)
+            'spilled': 0,  # elementi scritti su disco per coda piena
+            'replayed': 0,  # elementi ripresi dallo spill
+            'dropped': 0,  # elementi persi (coda piena senza spill, errori)
+            'errors': 0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name='background-writer', daemon=True)
+        self._thread.start()
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.counters)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+    def submit(self, kind: str, payload: Any) -> bool:
+        """Accoda un elemento senza bloccare.
+
+        Returns:
+            True se accodato, False se la coda era piena (elemento
+            spillato su disco o scartato)
+        """
+        if kind not in self.sinks:
+            raise ValueError(f"Tipo di elemento sconosciuto: {kind}")
+        if isinstance(payload, pd.DataFrame) and payload.empty:
+            return True
+        try:
+            self.queue.put_nowait((kind, payload))
+        except queue.Full:
+            self._overflow(kind, payload)
+            return False
+        self._count('submitted')
+        return True
+
+    def _overflow(self, kind: str, payload: Any):
+        if self.spill_dir is None:
+            self._count('dropped')
+            LOG.warning(f"Coda di scrittura piena: elemento '{kind}' scartato")
+            return
+        try:
+            self._spill(kind, payload)
+            self._count('spilled')
+        except Exception as e:
+            self._count('dropped')
+            LOG.error(f"Spill su disco fallito, elemento '{kind}' scartato: {e}")
+
+    def _spill(self, kind: str, payload: Any):
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._spill_seq += 1
+            name = f"{time.time_ns():020d}-{os.getpid()}-{self._spill_seq:06d}-{kind}.pkl"
+        tmp_path = self.spill_dir / f".{name}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((kind, payload), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.spill_dir / name)
+
+    def _collect(self, first: Tuple[str, Any]) -> List[Tuple[str, Any]]:
+        """Elementi arrivati entro la finestra dopo il primo"""
+        pending = [first]
+        rows = len(first[1]) if isinstance(first[1], pd.DataFrame) else 1
+        deadline = time.monotonic() + self.window
+        while rows < self.max_batch_rows:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # Il loop termina dopo aver scritto questo gruppo
+                self.queue.task_done()
+                self._stopping = True
+                break
+            pending.append(item)
+            rows += len(item[1]) if isinstance(item[1], pd.DataFrame) else 1
+        return pending
+
+    @staticmethod
+    def _group(pending: List[Tuple[str, Any]]) -> List[Tuple[str, Any, int]]:
+        """Concatena i DataFrame consecutivi dello stesso tipo"""
+        groups: List[Tuple[str, List[Any]]] = []
+        for kind, payload in pending:
+            if groups and groups[-1][0] == kind and isinstance(payload, pd.DataFrame) \
+                    and isinstance(groups[-1][1][-1], pd.DataFrame):
+                groups[-1][1].append(payload)
+            else:
+                groups.append((kind, [payload]))
+        return [(kind, pd.concat(payloads, ignore_index=True) if len(payloads) > 1 else payloads[0],
+                 len(payloads)) for kind, payloads in groups]
+
+    def _write(self, kind: str, payload: Any, items: int) -> bool:
+        try:
+            self.sinks[kind](payload)
+        except Exception as e:
+            LOG.error(f"Errore nella scrittura asincrona ({kind}): {e}")
+            import traceback
+            LOG.error(traceback.format_exc())
+            self._count('errors')
+            if self.spill_dir is not None:
+                self._overflow(kind, payload)
+            else:
+                self._count('dropped', items)
+            return False
+        self._count('written', items)
+        self._count('commits')
+        return True
+
+    def _replay_spilled(self) -> int:
+        """Riprende gli elementi spillati, dal più vecchio; si ferma al primo
+        errore (il file resta per il prossimo tentativo)"""
+        if self.spill_dir is None or not self.spill_dir.exists():
+            return 0
+        replayed = 0
+        for path in sorted(self.spill_dir.glob('*.pkl')):
+            try:
+                with open(path, 'rb') as f:
+                    kind, payload = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                LOG.warning(f"File di spill non leggibile ({path}): {e}")
+                path.unlink(missing_ok=True)
+                continue
+            if kind not in self.sinks:
+                LOG.warning(f"File di spill di tipo sconosciuto ({path}): scartato")
+                path.unlink(missing_ok=True)
+                self._count('dropped')
+                continue
+            try:
+                self.sinks[kind](payload)
+            except Exception as e:
+                LOG.error(f"Ripresa dello spill fallita ({path}): {e}")
+                self._count('errors')
+                break
+            path.unlink(missing_ok=True)
+            self._count('written')
+            self._count('commits')
+            self._count('replayed')
+            replayed += 1
+            if not self.queue.empty():
+                break  # i nuovi dati hanno la precedenza
+        return replayed
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self.idle_seconds)
+            except queue.Empty:
+                self._replay_spilled()
+                continue
+            if first is _STOP:
+                self.queue.task_done()
+                return
+
+            pending = self._collect(first)
+            for kind, payload, items in self._group(pending):
+                self._write(kind, payload, items)
+            for _ in pending:
+                self.queue.task_done()
+            if self._stopping:
+                return
+
+    def flush(self):
+        """Attende che gli elementi accodati finora siano scritti"""
+        self.queue.join()
+
+    def close(self, timeout: Optional[float] = None):
+        """Scrive quanto resta in coda e nello spill, poi ferma il thread"""
+        if not self._thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            LOG.warning(f"Writer asincrono non terminato entro {timeout}s: "
+                        f"{self.queue.qsize()} elementi ancora in coda")
+            return
+        self._replay_spilled()
+        stats = self.stats()
+        LOG.info(f"Writer asincrono chiuso: {stats['written']} elementi scritti in "
+                 f"{stats['commits']} commit, {stats['spilled']} spillati, "
+                 f"{stats['dropped']} scartati")
@@ -0,0 +1,153 @@
+"""
+Baseline comportamentali per utente (istogramma ora-della-settimana)
+"""
+import logging
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+LOG = logging.getLogger(__name__)
+
+N_BUCKETS = 168  # 7 giorni x 24 ore
+
+
+def hour_of_week(df: pd.DataFrame) -> np.ndarray:
+    """Bucket ora-della-settimana (0..167) per ogni evento"""
+    return (df['day_of_week'].to_numpy(dtype=np.int64) * 24 +
+            df['hour'].to_numpy(dtype=np.int64))
+
+
+def to_epoch_seconds(timestamps: pd.Series) -> np.ndarray:
+    """Converte una colonna di timestamp in secondi epoch (float64)"""
+    values = pd.to_datetime(timestamps).to_numpy(dtype='datetime64[ns]')
+    return values.astype(np.int64).astype(np.float64) / 1e9
+
+
+class HourOfWeekBaseline:
+    """Istogramma compatto di attività ora-della-settimana per utente.
+
+    Ogni utente occupa una riga di una matrice float32 (n_utenti x 168).
+    I conteggi decadono esponenzialmente (half-life in ore) ad ogni
+    aggiornamento, quindi la baseline segue lentamente i cambi di abitudine
+    senza bisogno di riaddestrare il modello.
+    """
+
+    def __init__(self, half_life_hours: float = 336.0, min_events: float = 20.0):
+        self.half_life_hours = float(half_life_hours)
+        self.min_events = float(min_events)
+        self.user_index: Dict[str, int] = {}
+        self.hist = np.zeros((0, N_BUCKETS), dtype=np.float32)
+        self.last_update = np.zeros(0, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.user_index)
+
+    def _lookup_rows(self, users: np.ndarray) -> np.ndarray:
+        """Indici di riga per gli utenti dati (-1 se sconosciuti)"""
+        return np.fromiter(
+            (self.user_index.get(user, -1) for user in users),
+            dtype=np.int64, count=len(users)
+        )
+
+    def _ensure_rows(self, users: np.ndarray) -> np.ndarray:
+        """Indici di riga per gli utenti dati, allocando quelli nuovi"""
+        rows = self._lookup_rows(users)
+        new_users = users[rows < 0]
+
+        if len(new_users) > 0:
+            start = len(self.user_index)
+            needed = start + len(new_users)
+
+            if needed > len(self.hist):
+                # Crescita geometrica per ammortizzare le copie
+                capacity = max(needed, 2 * len(self.hist), 64)
+                hist = np.zeros((capacity, N_BUCKETS), dtype=np.float32)
+                hist[:start] = self.hist[:start]
+                last_update = np.zeros(capacity, dtype=np.float64)
+                last_update[:start] = self.last_update[:start]
+                self.hist, self.last_update = hist, last_update
+
+            for offset, user in enumerate(new_users):
+                self.user_index[user] = start + offset
+            rows[rows < 0] = np.arange(start, needed)
+
+        return rows
+
+    def update(self, df: pd.DataFrame) -> int:
+        """Aggiorna le baseline con un nuovo batch di eventi.
+
+        Vengono considerati solo gli eventi più recenti dell'ultimo
+        aggiornamento di ciascun utente, così finestre di raccolta
+        sovrapposte non contano due volte lo stesso evento.
+
+        Returns:
+            Numero di eventi effettivamente aggiunti
+        """
+        if df.empty:
+            return 0
+
+        codes, uniques = pd.factorize(df['user'])
+        rows = self._ensure_rows(np.asarray(uniques, dtype=object))
+        event_rows = rows[codes]
+
+        timestamps = to_epoch_seconds(df['timestamp'])
+        fresh = timestamps > self.last_update[event_rows]
+        if not fresh.any():
+            return 0
+
+        event_rows = event_rows[fresh]
+        timestamps = timestamps[fresh]
+        buckets = hour_of_week(df)[fresh]
+
+        # Ultimo timestamp del batch per ciascun utente toccato
+        touched, inverse = np.unique(event_rows, return_inverse=True)
+        batch_last = np.full(len(touched), -np.inf)
+        np.maximum.at(batch_last, inverse, timestamps)
+
+        # Decadimento esponenziale in base al tempo trascorso
+        elapsed_hours = np.maximum(batch_last - self.last_update[touched], 0.0) / 3600.0
+        decay = np.power(0.5, elapsed_hours / self.half_life_hours).astype(np.float32)
+        self.hist[touched] *= decay[:, None]
+
+        np.add.at(self.hist, (event_rows, buckets), np.float32(1.0))
+        self.last_update[touched] = batch_last
+
+        return int(fresh.sum())
+
+    def deviation(self, df: pd.DataFrame) -> np.ndarray:
+        """Deviazione di ogni evento dalla baseline del proprio utente.
+
+        0 = ora tipica per l'utente, 1 = ora mai vista. Gli utenti senza
+        abbastanza storia (min_events) ricevono 0, come per gli IP insoliti.
+        """
+        deviation = np.zeros(len(df), dtype=np.float64)
+        if df.empty or len(self.user_index) == 0:
+            return deviation
+
+        codes, uniques = pd.factorize(df['user'])
+        rows = self._lookup_rows(np.asarray(uniques, dtype=object))[codes]
+        known = rows >= 0
+        if not known.any():
+            return deviation
+
+        user_hist = self.hist[rows[known]]
+        totals = user_hist.sum(axis=1)
+        peaks = user_hist.max(axis=1)
+        counts = user_hist[np.arange(len(user_hist)), hour_of_week(df)[known]]
+
+        reliable = (totals >= self.min_events) & (peaks > 0)
+        values = np.zeros(len(user_hist), dtype=np.float64)
+        values[reliable] = 1.0 - counts[reliable] / peaks[reliable]
+
+        deviation[known] = values
+        return deviation
+
+    def user_histogram(self, user: str) -> np.ndarray:
+        """Istogramma normalizzato (probabilità) di un utente"""
+        row = self.user_index.get(user)
+        if row is None:
+            return np.zeros(N_BUCKETS, dtype=np.float32)
+        hist = self.hist[row]
+        total = hist.sum()
+        return hist / total if total > 0 else hist.copy()
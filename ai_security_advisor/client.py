@@ -0,0 +1,134 @@
+"""
+Client leggero del servizio di scoring (solo libreria standard)
+
+Sostituisce il percorso a freddo di `main.py --once` nei job cron: legge
+le righe nuove del log dall'ultimo offset salvato e le invia al servizio
+residente, che le valuta con il modello già in memoria.
+
+    python -m ai_security_advisor.client --log /opt/stack/logs/keystone.log \\
+        --state /var/lib/ai-security-advisor/offset
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+from typing import Dict, Any, List, Tuple
+
+DEFAULT_ADDRESS = 'unix:/tmp/ai-security-advisor.sock'
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection su socket Unix"""
+
+    def __init__(self, path: str, timeout: float = 60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ScoringClient:
+    """Invia batch di eventi al servizio di scoring"""
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, timeout: float = 60):
+        self.address = address
+        self.timeout = timeout
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self.address.startswith('unix:'):
+            return UnixHTTPConnection(self.address[len('unix:'):], self.timeout)
+        host, _, port = self.address.rpartition(':')
+        return http.client.HTTPConnection(host or '127.0.0.1', int(port), timeout=self.timeout)
+
+    def _request(self, method: str, path: str, body: bytes = None,
+                 headers: Dict[str, str] = None) -> Dict[str, Any]:
+        connection = self._connection()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            payload = json.loads(response.read().decode('utf-8'))
+            if response.status != 200:
+                raise RuntimeError(f"Servizio: HTTP {response.status} - {payload.get('error')}")
+            return payload
+        finally:
+            connection.close()
+
+    def score(self, records: List[Any]) -> Dict[str, Any]:
+        """Valuta righe di log grezze o dizionari evento"""
+        body = '\n'.join(json.dumps(record) for record in records).encode('utf-8')
+        return self._request('POST', '/score', body, {'Content-Type': 'application/x-ndjson'})
+
+    def health(self) -> Dict[str, Any]:
+        return self._request('GET', '/health')
+
+
+def read_new_lines(log_path: str, state_path: str = None) -> Tuple[List[str], int]:
+    """Righe aggiunte al log dall'offset salvato in state_path (tutte se
+    non c'è stato; da capo se il file è stato ruotato) e nuovo offset"""
+    offset = 0
+    if state_path and os.path.exists(state_path):
+        with open(state_path) as f:
+            offset = int(f.read().strip() or 0)
+    if os.path.getsize(log_path) < offset:
+        offset = 0
+
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+
+    # Un'eventuale riga incompleta in coda resta per il prossimo giro
+    end = data.rfind(b'\n') + 1
+    lines = [line for line in data[:end].decode('utf-8', errors='ignore').splitlines() if line.strip()]
+    return lines, offset + end
+
+
+def save_offset(state_path: str, offset: int):
+    """Salva l'offset solo dopo un invio riuscito"""
+    with open(state_path, 'w') as f:
+        f.write(str(offset))
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Client del servizio di scoring AI Security Advisor")
+    parser.add_argument('--address', default=DEFAULT_ADDRESS,
+                        help="'unix:/percorso/socket' oppure 'host:porta'")
+    parser.add_argument('--log', help='File di log da cui leggere le righe nuove (default: stdin)')
+    parser.add_argument('--state', help="File con l'offset già inviato")
+    parser.add_argument('--health', action='store_true', help='Mostra lo stato del servizio')
+    args = parser.parse_args(argv)
+
+    client = ScoringClient(args.address)
+    try:
+        if args.health:
+            print(json.dumps(client.health(), indent=2))
+            return 0
+
+        offset = None
+        if args.log:
+            lines, offset = read_new_lines(args.log, args.state)
+        else:
+            lines = [line for line in sys.stdin.read().splitlines() if line.strip()]
+        if not lines:
+            return 0
+
+        result = client.score(lines)
+        if args.state and offset is not None:
+            save_offset(args.state, offset)
+    except (OSError, RuntimeError) as e:
+        print(f"Servizio di scoring non raggiungibile ({args.address}): {e}", file=sys.stderr)
+        return 2
+
+    for rec in result['report'].get('recommendations', []):
+        print(f"RACCOMANDAZIONE [{rec['priority'].upper()}]: {rec['action']} per {rec['target']} - {rec['reason']}")
+    print(f"{result['events']} eventi, {result['anomaly_count']} anomalie "
+          f"(modello {result.get('model_version')})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
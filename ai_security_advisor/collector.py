@@ -3,7 +3,7 @@ import logging
 import re
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator
 import pandas as pd
 
 LOG = logging.getLogger(__name__)
@@ -63,6 +63,38 @@ class KeystoneLogCollector:
         LOG.debug(f"Riga non parsata: {line.strip()}")
         return None
 
+    def events_from_records(self, records: List[Any]) -> pd.DataFrame:
+        """Costruisce il DataFrame eventi da righe di log grezze (stringhe) o
+        da dizionari con almeno timestamp, user, ip ed event_type"""
+        events = []
+        for record in records:
+            if isinstance(record, str):
+                event = self.parse_log_line(record)
+            elif isinstance(record, dict) and 'user' not in record and record.get('raw_line'):
+                event = self.parse_log_line(record['raw_line'])
+            elif isinstance(record, dict):
+                try:
+                    event = dict(record)
+                    event['timestamp'] = pd.Timestamp(event['timestamp']).to_pydatetime()
+                    event.setdefault('success', event['event_type'] == 'auth_success')
+                    event.setdefault('raw_line', '')
+                    event['hour'] = event['timestamp'].hour
+                    event['day_of_week'] = event['timestamp'].weekday()
+                    event['is_weekend'] = event['day_of_week'] >= 5
+                    event['month'] = event['timestamp'].month
+                    event['day'] = event['timestamp'].day
+                    event['minute'] = event['timestamp'].minute
+                except (KeyError, ValueError, TypeError) as e:
+                    LOG.warning(f"Evento non valido scartato: {e}")
+                    event = None
+            else:
+                event = None
+
+            if event:
+                events.append(event)
+
+        return pd.DataFrame(events)
+
     def collect_historical_events(self, hours: int = 24) -> pd.DataFrame:
         """Raccoglie eventi storici dalle ultime N ore - VERSIONE MIGLIORATA"""
         events = []
@@ -107,6 +139,42 @@ class KeystoneLogCollector:
             LOG.error(traceback.format_exc())
             return self._generate_demo_events(hours)
 
+    def iter_historical_events(self, hours: int = 24, chunk_size: int = 50000) -> Iterator[pd.DataFrame]:
+        """Come collect_historical_events, ma restituisce blocchi di al più
+        chunk_size eventi per elaborare lo storico senza caricarlo tutto"""
+        if not self.log_path or not self.log_path.exists():
+            LOG.warning(f"File di log non trovato. Genero dati demo.")
+            yield self._generate_demo_events(hours)
+            return
+
+        cutoff_time = datetime.now() - timedelta(hours=hours)
+        events = []
+        total = 0
+
+        with open(self.log_path, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                event = self.parse_log_line(line)
+                if event and event['timestamp'] >= cutoff_time:
+                    events.append(event)
+
+                    if len(events) >= chunk_size:
+                        total += len(events)
+                        yield pd.DataFrame(events)
+                        events = []
+
+        if events:
+            total += len(events)
+            yield pd.DataFrame(events)
+
+        LOG.info(f"Raccolti {total} eventi storici da {self.log_path}")
+
+        if total == 0:
+            LOG.warning("Nessun evento trovato nel file di log")
+            yield self._generate_demo_events(hours)
+
     def _generate_demo_events(self, hours: int) -> pd.DataFrame:
         """Genera eventi demo per testing - VERSIONE MIGLIORATA"""
         LOG.info("Generazione eventi demo...")
@@ -0,0 +1,107 @@
+"""
+Cooldown delle raccomandazioni tra un'esecuzione e l'altra
+"""
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Optional
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+class CooldownStore:
+    """Scadenze per (azione, target) con indice TTL su min-heap.
+
+    Il dizionario risponde in O(1) se una coppia è in cooldown; l'heap
+    ordina le scadenze, così la pulizia costa O(log n) per voce scaduta
+    e non richiede scansioni. Le voci rinnovate lasciano nell'heap la
+    vecchia scadenza, scartata quando emerge (cancellazione pigra).
+    Lo stato è salvato su disco (JSON, scrittura atomica) per
+    sopravvivere tra le esecuzioni di main.py --once.
+    """
+
+    def __init__(self, path: Optional[str] = None, cooldown_minutes: float = 30):
+        self.path = Path(path) if path else None
+        self.cooldown_seconds = float(cooldown_minutes) * 60
+        self.expiry: Dict[Tuple[str, str], float] = {}
+        self.heap: List[Tuple[float, Tuple[str, str]]] = []
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        if self.path is not None and self.path.exists():
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.expiry)
+
+    def _expire(self, now: float):
+        while self.heap and self.heap[0][0] <= now:
+            expires, key = heapq.heappop(self.heap)
+            if self.expiry.get(key) == expires:
+                del self.expiry[key]
+                self._dirty = True
+
+    def active_mask(self, actions: np.ndarray, targets: np.ndarray,
+                    now: float = None) -> np.ndarray:
+        """True per le coppie (azione, target) ancora in cooldown"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now)
+            if not self.expiry:
+                return np.zeros(len(actions), dtype=bool)
+            expiry = self.expiry
+            mask = np.fromiter(((action, str(target)) in expiry
+                                for action, target in zip(actions, targets)),
+                               dtype=bool, count=len(actions))
+        self.suppressed += int(mask.sum())
+        return mask
+
+    def register(self, recommendations: List[Dict[str, Any]], now: float = None):
+        """Mette in cooldown le raccomandazioni emesse (per la loro durata,
+        se più lunga del cooldown configurato)"""
+        now = time.time() if now is None else now
+        with self._lock:
+            for rec in recommendations:
+                seconds = max(self.cooldown_seconds, rec.get('duration_minutes', 0) * 60)
+                key = (rec['action'], str(rec['target']))
+                expires = now + seconds
+                self.expiry[key] = expires
+                heapq.heappush(self.heap, (expires, key))
+                self._dirty = True
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            LOG.warning(f"Stato dei cooldown non leggibile ({self.path}): {e}")
+            return
+
+        now = time.time()
+        with self._lock:
+            self.expiry = {(action, target): expires for action, target, expires in entries
+                           if expires > now}
+            self.heap = [(expires, key) for key, expires in self.expiry.items()]
+            heapq.heapify(self.heap)
+        LOG.debug(f"Caricati {len(self.expiry)} cooldown attivi da {self.path}")
+
+    def save(self):
+        """Scrive le voci attive se qualcosa è cambiato"""
+        if self.path is None or not self._dirty:
+            return
+        with self._lock:
+            self._expire(time.time())
+            entries = [[action, target, expires] for (action, target), expires in self.expiry.items()]
+            self._dirty = False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
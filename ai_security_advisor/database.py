@@ -3,26 +3,57 @@ Database module per SQLite
 """
 import sqlite3
 import logging
+import threading
+import time
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .raw_lines import RawLineStore
 
 LOG = logging.getLogger(__name__)
 
+# Indici secondari di auth_events. (user, timestamp, ...) copre le finestre
+# per utente senza leggere la tabella (raw_line esclusa) e sostituisce il
+# vecchio indice sul solo utente; (ip, timestamp) serve le finestre per IP
+SECONDARY_INDEXES = {
+    'idx_auth_events_user_time': 'auth_events(user, timestamp, ip, event_type, success)',
+    'idx_auth_events_ip_time': 'auth_events(ip, timestamp)',
+}
+
+
+def create_secondary_indexes(conn: sqlite3.Connection):
+    """Crea gli indici secondari di auth_events (se mancanti)"""
+    conn.execute('DROP INDEX IF EXISTS idx_auth_events_user')
+    for name, target in SECONDARY_INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {target}')
+
+
+def init_db(db_path: str = "security_events.db", secondary_indexes: bool = True):
+    """Inizializza il database SQLite.
 
-def init_db(db_path: str = "security_events.db"):
-    """Inizializza il database SQLite"""
+    Con secondary_indexes=False auth_events ha solo l'indice sul timestamp
+    (inserimenti quasi in ordine, quindi economici): gli altri si creano
+    dopo con create_secondary_indexes, in un solo passaggio.
+    """
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
-    # Tabella eventi di autenticazione
+    # Pagine da 16 KiB: meno split dei B-tree negli insert massivi (vale
+    # solo per un database nuovo, prima della prima tabella)
+    cursor.execute('PRAGMA page_size = 16384')
+
+    # Tabella eventi di autenticazione (solo append: id = rowid, senza
+    # AUTOINCREMENT che aggiorna sqlite_sequence a ogni insert)
     cursor.execute('''
                    CREATE TABLE IF NOT EXISTS auth_events
                    (
                        id
                        INTEGER
                        PRIMARY
-                       KEY
-                       AUTOINCREMENT,
+                       KEY,
                        timestamp
                        DATETIME
                        NOT
@@ -104,13 +135,226 @@ def init_db(db_path: str = "security_events.db"):
                        )
                    ''')
 
+    # Righe grezze compresse (raw_lines.RawLineStore): template deduplicati
+    # e blocchi compressi, riferiti dagli eventi con (raw_block, raw_offset)
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS raw_templates
+                   (
+                       id INTEGER PRIMARY KEY,
+                       template TEXT NOT NULL UNIQUE
+                   )
+                   ''')
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS raw_blocks
+                   (
+                       id INTEGER PRIMARY KEY,
+                       codec TEXT NOT NULL,
+                       lines INTEGER NOT NULL,
+                       data BLOB NOT NULL
+                   )
+                   ''')
+    # Righe del blocco aperto, in chiaro finché il blocco non è pieno
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS raw_open_lines
+                   (
+                       block INTEGER NOT NULL,
+                       offset INTEGER NOT NULL,
+                       template TEXT NOT NULL,
+                       timestamp TEXT NOT NULL,
+                       user TEXT NOT NULL,
+                       ip TEXT NOT NULL,
+                       PRIMARY KEY (block, offset)
+                   ) WITHOUT ROWID
+                   ''')
+    # Colonne aggiunte dopo la prima versione dello schema
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(auth_events)')}
+    for name in ('raw_block', 'raw_offset'):
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE auth_events ADD COLUMN {name} INTEGER')
+
     # Indici per performance
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_auth_events_timestamp ON auth_events(timestamp)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_auth_events_user ON auth_events(user)')
+    if secondary_indexes:
+        create_secondary_indexes(conn)
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_anomalies_user ON anomalies(user)')
 
     conn.commit()
     conn.close()
 
     LOG.info(f"Database inizializzato: {db_path}")
-    return True
\ No newline at end of file
+    return True
+
+
+def timestamp_strings(timestamps) -> np.ndarray:
+    """Timestamp in testo ISO al secondo ('AAAA-MM-GGTHH:MM:SS'), ordinabile
+    come stringa e compreso dalle funzioni data/ora di SQLite"""
+    values = np.asarray(timestamps)
+    if not np.issubdtype(values.dtype, np.datetime64):
+        values = np.asarray(pd.to_datetime(timestamps))
+    return np.datetime_as_string(values.astype('datetime64[s]'), unit='s')
+
+
+class EventWriter:
+    """Scrive su SQLite gli eventi analizzati e le anomalie.
+
+    Una sola connessione aperta per tutta la vita del writer, journal WAL
+    con synchronous=NORMAL (fsync solo ai checkpoint), cache e mmap ampi;
+    ogni batch è una transazione con due executemany (eventi, poi anomalie).
+    Con un solo writer gli id degli eventi di una transazione sono
+    consecutivi, quindi le anomalie si collegano ai loro eventi senza
+    rileggere la tabella.
+
+    Con `raw_line_codec` ('zlib' o 'lzma') la riga grezza non va in
+    raw_line ma nel RawLineStore dello stesso database, nella stessa
+    transazione; l'evento ne conserva (raw_block, raw_offset).
+
+    Con `defer_indexes` (caricamenti massivi) gli indici secondari
+    (SECONDARY_INDEXES) di una tabella ancora vuota non sono mantenuti
+    durante le scritture: vengono creati in un solo passaggio da
+    create_indexes() o da close(). Su una tabella che contiene già eventi
+    il rinvio è ignorato e gli indici mancanti (es. dopo un caricamento
+    interrotto) sono ricreati all'apertura: le query non restano mai senza
+    indici su dati già scritti.
+    """
+
+    PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,  # KiB (negativo) = 64 MB
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    }
+
+    INSERT_EVENT = ('INSERT INTO auth_events (timestamp, user, ip, event_type, success, '
+                    'anomaly_score, is_anomaly, raw_line, raw_block, raw_offset) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+    INSERT_ANOMALY = ('INSERT INTO anomalies (event_id, user, ip, anomaly_type, score, description) '
+                      'VALUES (?, ?, ?, ?, ?, ?)')
+
+    def __init__(self, db_path: str = "security_events.db", secondary_indexes: bool = True,
+                 raw_line_codec: Optional[str] = None, raw_block_lines: int = 4096,
+                 defer_indexes: bool = False):
+        self.db_path = db_path
+        self.defer_indexes = bool(secondary_indexes and defer_indexes)
+        init_db(db_path, secondary_indexes and not self.defer_indexes)
+        # Transazioni esplicite (BEGIN/COMMIT): niente BEGIN implicito del modulo
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        for name, value in self.PRAGMAS.items():
+            self.conn.execute(f"PRAGMA {name}={value}")
+        if self.defer_indexes and self.conn.execute('SELECT 1 FROM auth_events LIMIT 1').fetchone():
+            # Tabella già popolata: indici (ri)creati subito e mantenuti
+            self.defer_indexes = False
+            create_secondary_indexes(self.conn)
+        self.raw_lines = RawLineStore(self.conn, raw_line_codec, raw_block_lines) if raw_line_codec else None
+        self._lock = threading.Lock()
+        self.events_written = 0
+        self.anomalies_written = 0
+
+    @staticmethod
+    def _event_rows(events: pd.DataFrame,
+                    raw_refs: Optional[Tuple[List[Any], List[Any], List[Any]]] = None) -> Iterator[tuple]:
+        """Righe di auth_events; raw_refs = (raw_line, raw_block, raw_offset)
+        per le righe grezze già salvate nel RawLineStore"""
+        n = len(events)
+
+        def column(name, default):
+            return events[name].tolist() if name in events.columns else [default] * n
+
+        success = events['success'].astype(bool).astype(int).tolist() if 'success' in events.columns \
+            else [1] * n
+        is_anomaly = events['is_anomaly'].astype(bool).astype(int).tolist() if 'is_anomaly' in events.columns \
+            else [0] * n
+        scores = events['anomaly_score'].astype(float).tolist() if 'anomaly_score' in events.columns \
+            else [None] * n
+        raw_line, raw_block, raw_offset = raw_refs or (column('raw_line', None), [None] * n, [None] * n)
+        return zip(timestamp_strings(events['timestamp']).tolist(),
+                   events['user'].astype(str).tolist(), events['ip'].astype(str).tolist(),
+                   column('event_type', 'unknown'), success, scores, is_anomaly,
+                   raw_line, raw_block, raw_offset)
+
+    def _store_raw_lines(self, events: pd.DataFrame) -> Optional[Tuple[List[Any], List[Any], List[Any]]]:
+        """Salva le righe grezze non vuote nel RawLineStore (nella transazione
+        corrente) e restituisce le colonne raw_line/raw_block/raw_offset"""
+        if self.raw_lines is None or 'raw_line' not in events.columns:
+            return None
+        lines = events['raw_line']
+        stored = (lines.notna() & (lines.astype(str) != '')).to_numpy()
+        raw_line = lines.where(~stored, None).tolist()
+        raw_block = [None] * len(events)
+        raw_offset = [None] * len(events)
+        if stored.any():
+            positions = np.flatnonzero(stored)
+            blocks, offsets = self.raw_lines.append(
+                lines.to_numpy()[positions].astype(str).tolist(),
+                events['user'].to_numpy()[positions].astype(str).tolist(),
+                events['ip'].to_numpy()[positions].astype(str).tolist())
+            for position, block, offset in zip(positions.tolist(), blocks.tolist(), offsets.tolist()):
+                raw_block[position] = block
+                raw_offset[position] = offset
+        return raw_line, raw_block, raw_offset
+
+    @staticmethod
+    def _anomaly_types(anomalies: pd.DataFrame) -> np.ndarray:
+        """Tipo di anomalia dai flag comportamentali, altrimenti 'isolation_forest'"""
+        flags = [name for name in ('high_frequency', 'unusual_ip') if name in anomalies.columns]
+        return np.select([anomalies[name].astype(bool).to_numpy() for name in flags], flags,
+                         default='isolation_forest')
+
+    def write_batch(self, events: pd.DataFrame) -> int:
+        """Persiste un batch analizzato (e le sue anomalie) in una transazione.
+
+        Returns:
+            Numero di eventi scritti
+        """
+        if events.empty:
+            return 0
+        events = events.reset_index(drop=True)
+        anomalies = events[events['is_anomaly'].astype(bool)] if 'is_anomaly' in events.columns \
+            else events.iloc[:0]
+
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN')
+            try:
+                cursor.executemany(self.INSERT_EVENT, self._event_rows(events, self._store_raw_lines(events)))
+                if len(anomalies):
+                    first_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0] - len(events) + 1
+                    cursor.executemany(self.INSERT_ANOMALY, zip(
+                        (anomalies.index.to_numpy() + first_id).tolist(),
+                        anomalies['user'].astype(str).tolist(),
+                        anomalies['ip'].astype(str).tolist(),
+                        self._anomaly_types(anomalies).tolist(),
+                        anomalies['anomaly_score'].astype(float).tolist(),
+                        [None] * len(anomalies)))
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                if self.raw_lines is not None:
+                    self.raw_lines.reload()
+                raise
+
+        self.events_written += len(events)
+        self.anomalies_written += len(anomalies)
+        return len(events)
+
+    def create_indexes(self):
+        """Crea gli indici secondari rimandati (un ordinamento per indice
+        invece di un inserimento nel B-tree per riga)"""
+        with self._lock:
+            if not self.defer_indexes:
+                return
+            started = time.perf_counter()
+            create_secondary_indexes(self.conn)
+            self.defer_indexes = False
+        LOG.info(f"Indici secondari di {self.db_path} creati in {time.perf_counter() - started:.1f}s")
+
+    def close(self):
+        try:
+            self.create_indexes()
+        except Exception as e:
+            LOG.error(f"Errore nella creazione degli indici di {self.db_path}: {e}")
+            import traceback
+            LOG.error(traceback.format_exc())
+        with self._lock:
+            self.conn.close()
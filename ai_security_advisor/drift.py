@@ -0,0 +1,101 @@
+"""
+Monitor di drift sulla distribuzione di score e feature
+"""
+import logging
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+def population_stability_index(reference: np.ndarray, current: np.ndarray,
+                               eps: float = 1e-4) -> float:
+    """PSI tra due istogrammi (conteggi o probabilità) sugli stessi bin"""
+    p = reference / max(reference.sum(), eps) + eps
+    q = current / max(current.sum(), eps) + eps
+    return float(np.sum((q - p) * np.log(q / p)))
+
+
+class BinnedDistribution:
+    """Istogramma a bin fissi con bordi scelti sui quantili di riferimento"""
+
+    __slots__ = ('edges', 'reference', 'current')
+
+    def __init__(self, values: np.ndarray, n_bins: int = 20):
+        quantiles = np.linspace(0, 100, n_bins + 1)[1:-1]
+        self.edges = np.unique(np.percentile(values, quantiles))
+        self.reference = self._counts(values)
+        self.current = np.zeros_like(self.reference)
+
+    def _counts(self, values: np.ndarray) -> np.ndarray:
+        bins = np.searchsorted(self.edges, values, side='right')
+        return np.bincount(bins, minlength=len(self.edges) + 1).astype(np.float64)
+
+    def observe(self, values: np.ndarray):
+        self.current += self._counts(values)
+
+    def psi(self) -> float:
+        return population_stability_index(self.reference, self.current)
+
+
+class DriftMonitor:
+    """Confronta score e feature chiave con la distribuzione di training.
+
+    Il riferimento (istogrammi sui quantili di training) è salvato insieme
+    al modello; durante la rilevazione si accumulano gli stessi istogrammi
+    e, raggiunti `min_events` eventi, si calcola il PSI. Sopra `threshold`
+    il monitor segnala drift una sola volta, finché un nuovo modello non
+    porta un nuovo riferimento. Dopo ogni valutazione i conteggi correnti
+    vengono dimezzati (memoria esponenziale).
+    """
+
+    def __init__(self, scores: np.ndarray, features: np.ndarray,
+                 feature_names: List[str], key_features: List[str],
+                 n_bins: int = 20, threshold: float = 0.25,
+                 min_events: int = 1000):
+        self.threshold = float(threshold)
+        self.min_events = int(min_events)
+        self.distributions: Dict[str, BinnedDistribution] = {
+            'anomaly_score': BinnedDistribution(scores, n_bins)
+        }
+        self.columns: Dict[str, int] = {}
+        for name in key_features:
+            if name in feature_names:
+                column = feature_names.index(name)
+                self.columns[name] = column
+                self.distributions[name] = BinnedDistribution(features[:, column], n_bins)
+
+        self.pending = 0
+        self.triggered = False
+        self.last_report: Optional[Dict[str, Any]] = None
+
+    def observe(self, scores: np.ndarray, features: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Aggiunge un batch; restituisce il report se il drift è appena scattato"""
+        self.distributions['anomaly_score'].observe(scores)
+        for name, column in self.columns.items():
+            self.distributions[name].observe(features[:, column])
+        self.pending += len(scores)
+
+        if self.pending < self.min_events:
+            return None
+
+        psi = {name: dist.psi() for name, dist in self.distributions.items()}
+        worst = max(psi, key=psi.get)
+        self.last_report = {
+            'psi': psi,
+            'worst': worst,
+            'max_psi': psi[worst],
+            'drift': psi[worst] > self.threshold,
+        }
+        LOG.debug(f"Drift PSI: {psi}")
+
+        for dist in self.distributions.values():
+            dist.current *= 0.5
+        self.pending = 0
+
+        if self.last_report['drift'] and not self.triggered:
+            self.triggered = True
+            LOG.warning(f"Drift rilevato su '{worst}' (PSI {psi[worst]:.3f} > {self.threshold})")
+            return self.last_report
+        return None
@@ -0,0 +1,334 @@
+"""
+Archivio degli eventi partizionato per giorno (un file SQLite per giorno)
+"""
+import logging
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .database import EventWriter, create_secondary_indexes, timestamp_strings
+from .raw_lines import RawLineStore
+
+LOG = logging.getLogger(__name__)
+
+PARTITION_NAME = re.compile(r'^events-(\d{4}-\d{2}-\d{2})\.db$')
+
+# Colonne lette di default: tutte quelle di auth_events tranne raw_line
+EVENT_COLUMNS = ['id', 'timestamp', 'user', 'ip', 'event_type', 'success',
+                 'anomaly_score', 'is_anomaly']
+
+# Tipo NumPy di ciascuna colonna nei blocchi letti (object per il testo)
+COLUMN_DTYPES = {
+    'id': np.int64,
+    'timestamp': 'datetime64[s]',
+    'success': bool,
+    'anomaly_score': np.float64,
+    'is_anomaly': bool,
+}
+
+
+def _day(value) -> int:
+    """Giorno (giorni dall'epoch) di un timestamp"""
+    return int(np.datetime64(pd.Timestamp(value), 'D').astype(np.int64))
+
+
+def _day_name(day: int) -> str:
+    return str(np.datetime64(day, 'D'))
+
+
+def event_filters(start=None, end=None, users: Optional[Iterable[str]] = None,
+                  ips: Optional[Iterable[str]] = None,
+                  anomalies_only: bool = False) -> Tuple[str, List[Any]]:
+    """Clausola WHERE (vuota se non ci sono filtri) e parametri per
+    auth_events: timestamp in [start, end), utenti e IP in elenco"""
+    conditions, params = [], []
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(str(timestamp_strings([pd.Timestamp(start)])[0]))
+    if end is not None:
+        conditions.append('timestamp < ?')
+        params.append(str(timestamp_strings([pd.Timestamp(end)])[0]))
+    for column, values in (('user', users), ('ip', ips)):
+        if values is not None:
+            values = [str(value) for value in values]
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    if anomalies_only:
+        conditions.append('is_anomaly = 1')
+    return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+
+def list_partitions(directory, start=None, end=None) -> List[Tuple[int, Path]]:
+    """Partizioni (giorno, file) di `directory` che intersecano [start, end), in ordine"""
+    directory = Path(directory)
+    if not directory.is_dir():
+        return []
+    first = _day(start) if start is not None else None
+    # end è escluso: a mezzanotte il giorno di end non serve
+    last = _day(pd.Timestamp(end) - pd.Timedelta(1, unit='ns')) if end is not None else None
+    result = []
+    for path in directory.iterdir():
+        match = PARTITION_NAME.match(path.name)
+        if match is None:
+            continue
+        day = _day(match.group(1))
+        if (first is None or day >= first) and (last is None or day <= last):
+            result.append((day, path))
+    return sorted(result)
+
+
+def _typed_chunk(rows: List[tuple], columns: List[str]) -> pd.DataFrame:
+    """Righe di fetchmany -> DataFrame con colonne NumPy tipizzate (i
+    timestamp ISO sono convertiti da NumPy senza passare da datetime)"""
+    data = {}
+    for column, values in zip(columns, zip(*rows)):
+        array = np.array(values, dtype=COLUMN_DTYPES.get(column, object))
+        if column == 'timestamp':
+            array = array.astype('datetime64[ns]')
+        data[column] = array
+    return pd.DataFrame(data, columns=columns)
+
+
+def iter_events(paths: Iterable[Path], start=None, end=None, users: Optional[Iterable[str]] = None,
+                ips: Optional[Iterable[str]] = None, anomalies_only: bool = False,
+                columns: Optional[List[str]] = None, chunk_size: int = 50000) -> Iterator[pd.DataFrame]:
+    """Eventi dei database `paths` (in quest'ordine) a blocchi di al più
+    chunk_size righe, con i filtri nella query SQL e ordinati per tempo
+    all'interno di ciascun database"""
+    columns = list(columns or EVENT_COLUMNS)
+    where, params = event_filters(start, end, users, ips, anomalies_only)
+    for path in paths:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            # Righe grezze compresse: si leggono anche i riferimenti al blocco
+            selected = list(columns)
+            raw_lines = None
+            if 'raw_line' in columns and _has_raw_refs(conn):
+                selected += ['raw_block', 'raw_offset']
+                raw_lines = RawLineStore(conn)
+            cursor = conn.execute(
+                f"SELECT {', '.join(selected)} FROM auth_events{where} ORDER BY timestamp", params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunk = _typed_chunk(rows, selected)
+                if raw_lines is not None:
+                    _resolve_raw_lines(chunk, raw_lines)
+                yield chunk[columns]
+        finally:
+            conn.close()
+
+
+def _has_raw_refs(conn: sqlite3.Connection) -> bool:
+    return 'raw_block' in {row[1] for row in conn.execute('PRAGMA table_info(auth_events)')}
+
+
+def _resolve_raw_lines(chunk: pd.DataFrame, raw_lines: RawLineStore):
+    """Ricostruisce raw_line dove l'evento ha solo il riferimento al blocco"""
+    blocks = chunk['raw_block'].to_numpy()
+    missing = np.flatnonzero(chunk['raw_line'].isna().to_numpy() & pd.notna(blocks))
+    if len(missing):
+        lines = chunk['raw_line'].to_numpy(dtype=object, copy=True)
+        lines[missing] = raw_lines.get_many(blocks[missing].astype(np.int64),
+                                            chunk['raw_offset'].to_numpy()[missing].astype(np.int64))
+        chunk['raw_line'] = lines
+
+
+class EventStore:
+    """Eventi analizzati in un database SQLite per giorno.
+
+    Ogni partizione `events-AAAA-MM-GG.db` ha lo schema di init_db (eventi
+    e anomalie del giorno, collegati per id) ed è scritta da un EventWriter;
+    restano aperti solo i writer degli ultimi `max_open` giorni usati. La
+    retention elimina i file dei giorni più vecchi di `retention_days`
+    rispetto a oggi: nessun DELETE, nessun VACUUM. Gli eventi datati oltre
+    domani (orologi sbagliati, timestamp malformati) sono scartati, così
+    non creano partizioni future né spostano la retention. Le query aprono
+    in sola lettura solo le partizioni che intersecano l'intervallo.
+
+    La partizione del giorno corrente ha solo l'indice sul timestamp, così
+    gli inserimenti non pagano gli indici (user, timestamp) e (ip,
+    timestamp) riga per riga: quando arriva un giorno nuovo le partizioni
+    precedenti vengono "sigillate" creando questi indici in un solo
+    passaggio (PRAGMA user_version = 1 ne registra lo stato).
+    """
+
+    SEALED_VERSION = 1
+    FUTURE_DAYS = 1  # tolleranza per fusi orari e orologi non allineati
+
+    def __init__(self, directory: str = "data/events", retention_days: int = 30, max_open: int = 3,
+                 raw_line_codec: Optional[str] = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.retention_days = int(retention_days)
+        self.raw_line_codec = raw_line_codec
+        self.max_open = max(int(max_open), 1)
+        self._writers: 'OrderedDict[int, EventWriter]' = OrderedDict()
+        self._lock = threading.RLock()
+        self.events_written = 0
+        self.anomalies_written = 0
+        self.expired_events = 0
+        self.future_events = 0
+        self._sealed = set()
+
+    def partition_path(self, day: int) -> Path:
+        return self.directory / f"events-{_day_name(day)}.db"
+
+    def partitions(self, start=None, end=None) -> List[Tuple[int, Path]]:
+        """Partizioni (giorno, file) che intersecano [start, end), in ordine"""
+        return list_partitions(self.directory, start, end)
+
+    @staticmethod
+    def _today() -> int:
+        return _day(pd.Timestamp.now())
+
+    def _oldest_kept(self) -> int:
+        return self._today() - self.retention_days + 1
+
+    def _writer(self, day: int) -> EventWriter:
+        writer = self._writers.get(day)
+        if writer is not None:
+            self._writers.move_to_end(day)
+            return writer
+        writer = self._writers[day] = EventWriter(str(self.partition_path(day)), secondary_indexes=False,
+                                                  raw_line_codec=self.raw_line_codec)
+        while len(self._writers) > self.max_open:
+            _, oldest = self._writers.popitem(last=False)
+            oldest.close()
+        return writer
+
+    def write_batch(self, events: pd.DataFrame) -> int:
+        """Scrive un batch analizzato nelle partizioni dei suoi giorni
+        (una transazione per giorno); i giorni già fuori retention e quelli
+        futuri sono scartati.
+
+        Returns:
+            Numero di eventi scritti
+        """
+        if events.empty:
+            return 0
+        days = np.asarray(pd.to_datetime(events['timestamp']), dtype='datetime64[D]').astype(np.int64)
+        written = 0
+        with self._lock:
+            existing = [day for day, _ in self.partitions()]
+            today = self._today()
+            oldest = self._oldest_kept()
+            created = False
+            for day in np.unique(days):
+                day = int(day)
+                rows = events[days == day]
+                if day < oldest:
+                    self.expired_events += len(rows)
+                    LOG.debug(f"Scartati {len(rows)} eventi del {_day_name(day)}: fuori retention")
+                    continue
+                if day > today + self.FUTURE_DAYS:
+                    self.future_events += len(rows)
+                    LOG.warning(f"Scartati {len(rows)} eventi datati nel futuro ({_day_name(day)})")
+                    continue
+                created |= day not in existing
+                writer = self._writer(day)
+                anomalies_before = writer.anomalies_written
+                written += writer.write_batch(rows)
+                self.anomalies_written += writer.anomalies_written - anomalies_before
+            self.events_written += written
+            if created:
+                self.drop_expired()
+                self.seal()
+        return written
+
+    def seal(self, before: Optional[int] = None) -> int:
+        """Crea gli indici secondari nelle partizioni dei giorni precedenti
+        a `before` (default oggi) non ancora sigillate.
+
+        Returns:
+            Numero di partizioni sigillate
+        """
+        sealed = 0
+        with self._lock:
+            partitions = self.partitions()
+            if before is None:
+                before = self._today()
+            for day, path in partitions:
+                if day >= before or day in self._sealed:
+                    continue
+                writer = self._writers.pop(day, None)
+                if writer is not None:
+                    writer.close()
+                conn = sqlite3.connect(str(path))
+                try:
+                    if conn.execute('PRAGMA user_version').fetchone()[0] < self.SEALED_VERSION:
+                        create_secondary_indexes(conn)
+                        conn.execute(f'PRAGMA user_version = {self.SEALED_VERSION}')
+                        conn.commit()
+                        sealed += 1
+                finally:
+                    conn.close()
+                self._sealed.add(day)
+        if sealed:
+            LOG.info(f"Indicizzate {sealed} partizioni di eventi chiuse")
+        return sealed
+
+    def drop_expired(self) -> List[Path]:
+        """Elimina i file delle partizioni fuori retention (rispetto a oggi)"""
+        with self._lock:
+            partitions = self.partitions()
+            oldest = self._oldest_kept()
+            dropped = []
+            for day, path in partitions:
+                if day >= oldest:
+                    break
+                writer = self._writers.pop(day, None)
+                if writer is not None:
+                    writer.close()
+                self._sealed.discard(day)
+                for suffix in ('', '-wal', '-shm'):
+                    path.with_name(path.name + suffix).unlink(missing_ok=True)
+                dropped.append(path)
+        if dropped:
+            LOG.info(f"Retention: eliminate {len(dropped)} partizioni di eventi "
+                     f"(fino al {_day_name(oldest - 1)})")
+        return dropped
+
+    def iter_query(self, start=None, end=None, users: Optional[Iterable[str]] = None,
+                   ips: Optional[Iterable[str]] = None, anomalies_only: bool = False,
+                   columns: Optional[List[str]] = None, chunk_size: int = 50000) -> Iterator[pd.DataFrame]:
+        """Come query(), a blocchi di al più chunk_size eventi"""
+        paths = [path for _, path in self.partitions(start, end)]
+        return iter_events(paths, start, end, users, ips, anomalies_only, columns, chunk_size)
+
+    def query(self, start=None, end=None, users: Optional[Iterable[str]] = None,
+              ips: Optional[Iterable[str]] = None, anomalies_only: bool = False,
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Eventi in [start, end) filtrati per utente/IP, in ordine di tempo.
+
+        Le partizioni fuori dall'intervallo non vengono aperte; nelle altre
+        i filtri sono nella query SQL e usano gli indici (user, timestamp),
+        (ip, timestamp) e timestamp (nella partizione del giorno corrente,
+        non ancora sigillata, solo quello sul timestamp).
+        """
+        frames = list(self.iter_query(start, end, users, ips, anomalies_only, columns))
+        if not frames:
+            return pd.DataFrame(columns=list(columns or EVENT_COLUMNS))
+        return pd.concat(frames, ignore_index=True)
+
+    def stats(self) -> Dict[str, Any]:
+        partitions = self.partitions()
+        return {
+            'partitions': len(partitions),
+            'first_day': _day_name(partitions[0][0]) if partitions else None,
+            'last_day': _day_name(partitions[-1][0]) if partitions else None,
+            'size_mb': round(sum(path.stat().st_size for _, path in partitions) / 1e6, 1),
+        }
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers.clear()
@@ -0,0 +1,148 @@
+"""
+Statistiche dei fallimenti per IP e per utente su più giorni, a memoria fissa
+"""
+import logging
+import os
+import pickle
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+import numpy as np
+import pandas as pd
+
+from .sketches import HeavyHitters
+
+LOG = logging.getLogger(__name__)
+
+
+class FailureStats:
+    """Tentativi falliti per IP e per utente in bucket giornalieri.
+
+    Ogni giorno ha due HeavyHitters (Count-Min Sketch + candidati top-k),
+    quindi la memoria dipende da retention_days, epsilon e delta e non dal
+    numero di IP/utenti, anche durante attacchi da botnet. Le interrogazioni
+    su più giorni uniscono i bucket; merge() unisce le statistiche di un
+    altro worker bucket per bucket.
+    """
+
+    DIMENSIONS = ('ip', 'user')
+
+    def __init__(self, path: Optional[str] = None, retention_days: int = 7, top_k: int = 20,
+                 epsilon: float = 0.001, delta: float = 0.01, save_seconds: float = 60):
+        self.path = Path(path) if path else None
+        self.retention_days = int(retention_days)
+        self.top_k = int(top_k)
+        self.epsilon = float(epsilon)
+        self.delta = float(delta)
+        self.save_seconds = float(save_seconds)
+        self.buckets: Dict[int, Dict[str, HeavyHitters]] = {}
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+        self._dirty = False
+        if self.path is not None and self.path.exists():
+            self.load()
+
+    def _new_bucket(self) -> Dict[str, HeavyHitters]:
+        return {dimension: HeavyHitters(self.top_k, self.epsilon, self.delta)
+                for dimension in self.DIMENSIONS}
+
+    def _prune(self):
+        if not self.buckets:
+            return
+        oldest = max(self.buckets) - self.retention_days + 1
+        for day in [day for day in self.buckets if day < oldest]:
+            del self.buckets[day]
+
+    def update(self, events: pd.DataFrame):
+        """Aggiunge i tentativi falliti di un batch analizzato"""
+        if events.empty or 'success' not in events.columns:
+            return
+        failed = events[~events['success'].astype(bool)]
+        if failed.empty:
+            return
+
+        days = np.asarray(pd.to_datetime(failed['timestamp']), dtype='datetime64[D]').astype(np.int64)
+        with self._lock:
+            for day, group in failed.groupby(days, sort=True):
+                bucket = self.buckets.get(day)
+                if bucket is None:
+                    if self.buckets and day <= max(self.buckets) - self.retention_days:
+                        continue  # più vecchio della retention
+                    bucket = self.buckets[day] = self._new_bucket()
+                for dimension in self.DIMENSIONS:
+                    bucket[dimension].add(group[dimension].astype(str).to_numpy())
+            self._prune()
+            self._dirty = True
+
+    def merged(self, dimension: str, days: Optional[int] = None) -> HeavyHitters:
+        """Sketch unito degli ultimi `days` giorni (default tutta la retention)"""
+        result = HeavyHitters(self.top_k, self.epsilon, self.delta)
+        with self._lock:
+            selected = sorted(self.buckets)[-days:] if days else sorted(self.buckets)
+            for day in selected:
+                result.merge(self.buckets[day][dimension])
+        return result
+
+    def estimate(self, dimension: str, keys, days: Optional[int] = None) -> np.ndarray:
+        """Fallimenti stimati (limite superiore) per ciascuna chiave"""
+        keys = np.asarray(keys, dtype=object).astype(str)
+        if len(keys) == 0 or not self.buckets:
+            return np.zeros(len(keys))
+        codes, uniques = pd.factorize(keys)
+        return self.merged(dimension, days).query(uniques)[codes]
+
+    def summary(self, n: int = 10, days: Optional[int] = None) -> Dict[str, Any]:
+        """IP e utenti con più fallimenti, con l'errore massimo delle stime"""
+        sketches = {dimension: self.merged(dimension, days) for dimension in self.DIMENSIONS}
+        result = {
+            'days': len(self.buckets) if not days else min(days, len(self.buckets)),
+            # Ogni fallimento è contato una volta per dimensione
+            'total_failures': int(sketches['ip'].sketch.total),
+            'error_bound': round(sketches['ip'].sketch.error_bound, 1),
+        }
+        for dimension, sketch in sketches.items():
+            result[f"top_failing_{dimension}s"] = [
+                {dimension: key, 'failures': int(count)} for key, count in sketch.top(n)
+            ]
+        return result
+
+    def merge(self, other: 'FailureStats'):
+        """Unisce le statistiche di un altro worker (stessi parametri)"""
+        with self._lock:
+            for day, bucket in other.buckets.items():
+                own = self.buckets.setdefault(day, self._new_bucket())
+                for dimension in self.DIMENSIONS:
+                    own[dimension].merge(bucket[dimension])
+            self._prune()
+            self._dirty = True
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                buckets = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            LOG.warning(f"Statistiche dei fallimenti non leggibili ({self.path}): {e}")
+            return
+        with self._lock:
+            self.buckets = buckets
+            self._prune()
+        LOG.debug(f"Caricati {len(self.buckets)} giorni di statistiche dei fallimenti da {self.path}")
+
+    def save(self, force: bool = False):
+        """Scrive gli sketch se cambiati, al più ogni save_seconds secondi"""
+        if self.path is None or not self._dirty:
+            return
+        if not force and time.time() - self._last_save < self.save_seconds:
+            return
+        with self._lock:
+            payload = pickle.dumps(self.buckets, protocol=pickle.HIGHEST_PROTOCOL)
+            self._dirty = False
+            self._last_save = time.time()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,192 @@
+"""
+Motore di inferenza IsolationForest su array piatti NumPy
+"""
+import logging
+from typing import Dict
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+
+def average_path_length(n_samples: np.ndarray) -> np.ndarray:
+    """Lunghezza media di un cammino non riuscito in un BST di n elementi
+    (stessa formula di sklearn.ensemble._iforest._average_path_length)"""
+    n_samples = np.asarray(n_samples, dtype=np.float64)
+    result = np.zeros_like(n_samples)
+    result[n_samples == 2] = 1.0
+    mask = n_samples > 2
+    n = n_samples[mask]
+    result[mask] = 2.0 * (np.log(n - 1.0) + np.euler_gamma) - 2.0 * (n - 1.0) / n
+    return result
+
+
+class FlatForest:
+    """IsolationForest esportata in array di nodi contigui.
+
+    Tutti gli alberi sono concatenati: per ogni nodo si conservano feature
+    (già rimappata sulle colonne globali), soglia, coppia di figli
+    (sinistro, destro) e, per le foglie, il contributo di profondità
+    (profondità + c(n_campioni)). Le foglie puntano a se stesse, così
+    l'attraversamento è un numero fisso di passi vettorizzati (max_depth)
+    senza rami Python per albero.
+
+    Riproduce score_samples/decision_function di sklearn (errore < 1e-9).
+    """
+
+    ARRAY_NAMES = ('feature', 'threshold', 'children', 'leaf_value', 'roots')
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray, children: np.ndarray,
+                 leaf_value: np.ndarray, roots: np.ndarray, max_depth: int,
+                 denominator: float, offset: float, chunk_size: int = 1024):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.leaf_value = leaf_value
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.denominator = float(denominator)
+        self.offset_ = float(offset)
+        self.chunk_size = int(chunk_size)
+
+    @property
+    def n_estimators(self) -> int:
+        return len(self.roots)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.feature)
+
+    @classmethod
+    def from_isolation_forest(cls, model, chunk_size: int = 1024) -> 'FlatForest':
+        """Esporta una IsolationForest sklearn già addestrata"""
+        features, thresholds, children, leaf_values, roots = [], [], [], [], []
+        offset = 0
+        max_depth = 0
+
+        for tree, tree_features in zip(model.estimators_, model.estimators_features_):
+            t = tree.tree_
+            n_nodes = t.node_count
+            left = t.children_left.astype(np.int64)
+            right = t.children_right.astype(np.int64)
+            is_leaf = left == -1
+
+            # Profondità dei nodi (radice = 0); i figli hanno indici maggiori
+            depth = np.zeros(n_nodes, dtype=np.int64)
+            for node in range(n_nodes):
+                if not is_leaf[node]:
+                    depth[left[node]] = depth[node] + 1
+                    depth[right[node]] = depth[node] + 1
+
+            own = np.arange(n_nodes, dtype=np.int64)
+            feature = np.where(is_leaf, 0, np.asarray(tree_features)[np.maximum(t.feature, 0)])
+            features.append(feature.astype(np.intp))
+            thresholds.append(np.where(is_leaf, 0.0, t.threshold))
+            children.append(np.stack([np.where(is_leaf, own, left),
+                                      np.where(is_leaf, own, right)], axis=1) + offset)
+            leaf_values.append(np.where(
+                is_leaf, depth + average_path_length(t.n_node_samples), 0.0
+            ))
+            roots.append(offset)
+
+            max_depth = max(max_depth, int(depth.max()))
+            offset += n_nodes
+
+        denominator = len(roots) * float(average_path_length(np.array([model._max_samples]))[0])
+        return cls(
+            feature=np.concatenate(features),
+            threshold=np.concatenate(thresholds),
+            children=np.concatenate(children).ravel().astype(np.intp),
+            leaf_value=np.concatenate(leaf_values),
+            roots=np.asarray(roots, dtype=np.intp),
+            max_depth=max_depth,
+            denominator=denominator,
+            offset=model.offset_,
+            chunk_size=chunk_size,
+        )
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Array dei nodi (per la persistenza)"""
+        return {name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    def metadata(self) -> Dict[str, float]:
+        """Parametri scalari (per la persistenza)"""
+        return {'max_depth': self.max_depth, 'denominator': self.denominator,
+                'offset': self.offset_}
+
+    def _leaves(self, X: np.ndarray) -> np.ndarray:
+        """Indici delle foglie raggiunte (n_campioni x n_alberi).
+
+        children è appiattito come [sx0, dx0, sx1, dx1, ...]: il figlio
+        scelto è children[2 * nodo + (x > soglia)].
+        """
+        n_rows, n_cols = X.shape
+        flat = X.ravel()
+        row_base = (np.arange(n_rows, dtype=np.intp) * n_cols)[:, None]
+        nodes = np.repeat(self.roots[None, :], n_rows, axis=0)
+        for _ in range(self.max_depth):
+            go_right = flat[row_base + self.feature[nodes]] > self.threshold[nodes]
+            nodes = self.children[2 * nodes + go_right]
+        return nodes
+
+    def path_contributions(self, X: np.ndarray) -> np.ndarray:
+        """Attribuzione per feature dell'isolamento (n_campioni x n_feature).
+
+        In ogni albero il "guadagno" è quanto il cammino è più corto della
+        profondità media attesa c(max_samples); il guadagno va alla feature
+        dell'ultimo split, quello che ha isolato il campione nella foglia.
+        Costo O(n * alberi * max_depth): da usare solo su poche righe.
+        """
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+        n_rows, n_cols = X.shape
+        flat = X.ravel()
+        row_base = (np.arange(n_rows, dtype=np.intp) * n_cols)[:, None]
+
+        nodes = np.repeat(self.roots[None, :], n_rows, axis=0)
+        last_feature = np.zeros_like(nodes)
+        for _ in range(self.max_depth):
+            features = self.feature[nodes]
+            go_right = flat[row_base + features] > self.threshold[nodes]
+            children = self.children[2 * nodes + go_right]
+            # Le foglie puntano a se stesse: lì non c'è uno split
+            last_feature = np.where(children != nodes, features, last_feature)
+            nodes = children
+
+        expected = self.denominator / max(self.n_estimators, 1)
+        gain = np.maximum(expected - self.leaf_value[nodes], 0.0)
+        contributions = np.zeros((n_rows, n_cols), dtype=np.float64)
+        rows = np.repeat(np.arange(n_rows), self.n_estimators)
+        np.add.at(contributions, (rows, last_feature.ravel()), gain.ravel())
+        return contributions
+
+    def _scores(self, depths: np.ndarray) -> np.ndarray:
+        if self.denominator == 0:
+            return -np.ones_like(depths)
+        return -np.power(2.0, -depths / self.denominator)
+
+    def score_samples(self, X: np.ndarray) -> np.ndarray:
+        """Equivalente di IsolationForest.score_samples"""
+        # sklearn confronta le feature in float32 con soglie float64: si
+        # arrotonda a float32 e si torna a float64 (stessi valori, confronti
+        # senza conversioni di tipo ad ogni passo)
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+        depths = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), self.chunk_size):
+            block = X[start:start + self.chunk_size]
+            depths[start:start + len(block)] = self.leaf_value[self._leaves(block)].sum(axis=1)
+        return self._scores(depths)
+
+    def decision_function(self, X: np.ndarray) -> np.ndarray:
+        return self.score_samples(X) - self.offset_
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return np.where(self.decision_function(X) < 0, -1, 1)
+
+    def score_one(self, x: np.ndarray) -> float:
+        """decision_function per un singolo evento (percorso a bassa latenza)"""
+        x = np.asarray(x, dtype=np.float32).astype(np.float64)
+        nodes = self.roots
+        for _ in range(self.max_depth):
+            nodes = self.children[2 * nodes + (x[self.feature[nodes]] > self.threshold[nodes])]
+        depth = self.leaf_value[nodes].sum()
+        return float(self._scores(np.array([depth]))[0] - self.offset_)
@@ -0,0 +1,102 @@
+"""
+Scambio a caldo del modello: osserva il registro e installa le nuove versioni
+"""
+import logging
+import threading
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+from .registry import ModelRegistry
+
+LOG = logging.getLogger(__name__)
+
+
+class ModelWatcher:
+    """Controlla periodicamente il symlink 'current' del registro.
+
+    Quando compare una versione diversa da quella in uso, il thread di
+    controllo la apre (mmap, senza toccare il detector), la valuta sul
+    batch ombra (le ultime righe analizzate) e, se supera i controlli, la
+    consegna al detector con stage_state(). Lo scambio vero e proprio è
+    un'assegnazione di riferimenti fatta dal detector all'inizio del batch
+    successivo: lo scoring non attende mai caricamento o validazione.
+    """
+
+    def __init__(self, detector, registry_path: str, poll_seconds: float = 30,
+                 max_anomaly_rate: float = 0.2):
+        self.detector = detector
+        self.registry = ModelRegistry(registry_path)
+        self.poll_seconds = float(poll_seconds)
+        self.max_anomaly_rate = float(max_anomaly_rate)
+        self.rejected = set()  # versioni scartate, non riprovate
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Avvia il thread di controllo (daemon)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='model-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.poll_seconds):
+            self.poll()
+
+    def poll(self, version: str = None) -> Optional[str]:
+        """Un controllo del registro (o di una versione esplicita, es. appena
+        pubblicata da un riaddestramento); restituisce la versione preparata
+        per lo scambio, oppure None"""
+        try:
+            version = version or self.registry.current_version()
+            if version is None or version in self.rejected:
+                return None
+            if version in (self.detector.model_version, self.detector.staged_version):
+                return None
+
+            state = self.registry.open(self.detector, version)
+            report = self.validate(state)
+            if report is not None and not report['valid']:
+                self.rejected.add(version)
+                LOG.warning(f"Versione {version} scartata: {report['reason']}")
+                return None
+
+            self.detector.stage_state(state)
+            LOG.info(f"Versione {version} pronta per lo scambio a caldo")
+            return version
+
+        except Exception as e:
+            LOG.error(f"Errore nel controllo del registro modelli: {e}")
+            import traceback
+            LOG.error(traceback.format_exc())
+            return None
+
+    def validate(self, state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Valuta il nuovo modello sul batch ombra (None se non disponibile)"""
+        shadow = self.detector.shadow_batch
+        if shadow is None or len(shadow) == 0:
+            return None
+
+        try:
+            scaled = state['scaler'].transform(shadow)
+            scores = np.asarray(state['model'].decision_function(scaled), dtype=np.float64)
+        except Exception as e:
+            return {'valid': False, 'reason': f"scoring fallito ({e})"}
+
+        if not np.isfinite(scores).all():
+            return {'valid': False, 'reason': "score non finiti"}
+
+        anomaly_rate = float((scores < 0).mean())
+        LOG.info(f"Validazione ombra di {state['version']}: {len(shadow)} righe, "
+                 f"tasso anomalie {anomaly_rate:.3f}")
+        if anomaly_rate > self.max_anomaly_rate:
+            return {'valid': False,
+                    'reason': f"tasso anomalie {anomaly_rate:.3f} > {self.max_anomaly_rate}"}
+        return {'valid': True, 'anomaly_rate': anomaly_rate}
@@ -0,0 +1,192 @@
+"""
+Modello di anomalia online (foresta a finestra scorrevole)
+"""
+import logging
+from collections import deque
+
+import numpy as np
+from sklearn.ensemble import IsolationForest
+from sklearn.preprocessing import StandardScaler
+
+LOG = logging.getLogger(__name__)
+
+
+class SlidingWindowForest:
+    """Isolation Forest aggiornabile a batch con memoria limitata.
+
+    Ogni batch allena una piccola sotto-foresta di `trees_per_batch` alberi;
+    quando si superano `max_trees` alberi le sotto-foreste più vecchie
+    vengono scartate. La soglia (offset_) è il percentile di
+    contaminazione sugli score recenti.
+
+    Lo scaler descrive solo la finestra: è ricalcolato dalle statistiche
+    (righe, media, varianza) dei batch delle sotto-foreste conservate, quindi
+    dimentica i dati scartati insieme ai loro alberi. Ogni sotto-foresta
+    tiene la media/scala con cui è stata addestrata e in scoring riceve le
+    righe trasformate con quella, non con lo scaler corrente.
+
+    Espone la stessa interfaccia di IsolationForest usata dal detector
+    (score_samples, decision_function, predict, offset_).
+    """
+
+    def __init__(self, trees_per_batch: int = 10, max_trees: int = 100,
+                 max_samples: int = 256, max_batch_rows: int = 4096,
+                 min_batch_rows: int = 32, contamination: float = 0.01,
+                 max_features: float = 0.5, random_state: int = 42):
+        self.trees_per_batch = int(trees_per_batch)
+        self.max_trees = int(max_trees)
+        self.max_samples = int(max_samples)
+        self.max_batch_rows = int(max_batch_rows)
+        self.min_batch_rows = int(min_batch_rows)
+        self.contamination = float(contamination)
+        self.max_features = max_features
+        self.random_state = random_state
+
+        self.scaler = StandardScaler()
+        self.forests = deque()
+        self.batch_stats = deque()  # (righe, media, varianza) del batch di ogni sotto-foresta
+        self.forest_scalers = deque()  # (media, scala) con cui è stata addestrata
+        window = max(1, self.max_trees // max(1, self.trees_per_batch))
+        self.recent_scores = deque(maxlen=window)
+        self.pending = None  # righe accumulate sotto min_batch_rows
+        self.n_batches = 0
+        self.offset_ = -0.5
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'forest_scalers' not in state:
+            # Modello salvato con lo scaler cumulativo: le sotto-foreste
+            # esistenti ereditano lo scaler corrente
+            fitted = hasattr(self.scaler, 'mean_')
+            n = self.scaler.n_samples_seen_ // max(len(self.forests), 1) if fitted else 0
+            self.batch_stats = deque((n, self.scaler.mean_, self.scaler.var_)
+                                     for _ in self.forests) if fitted else deque()
+            self.forest_scalers = deque((self.scaler.mean_, self.scaler.scale_)
+                                        for _ in self.forests) if fitted else deque()
+
+    @property
+    def is_fitted(self) -> bool:
+        return len(self.forests) > 0
+
+    @property
+    def n_estimators(self) -> int:
+        return sum(forest.n_estimators for forest in self.forests)
+
+    def partial_fit(self, X: np.ndarray) -> 'SlidingWindowForest':
+        """Aggiorna scaler e foresta con un batch di feature NON scalate.
+
+        Costo e memoria sono limitati da max_batch_rows e max_trees,
+        indipendentemente dalla dimensione del batch.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if self.pending is not None:
+            X = np.vstack([self.pending, X])
+            self.pending = None
+
+        if len(X) < self.min_batch_rows:
+            self.pending = X
+            return self
+
+        rng = np.random.default_rng(None if self.random_state is None
+                                    else self.random_state + self.n_batches)
+        if len(X) > self.max_batch_rows:
+            X = X[rng.choice(len(X), self.max_batch_rows, replace=False)]
+
+        # Sotto-foreste che usciranno dalla finestra con quella nuova: i loro
+        # dati non entrano nello scaler della nuova
+        while self.forests and self.n_estimators + self.trees_per_batch > self.max_trees:
+            self._drop_oldest()
+        self.batch_stats.append((len(X), X.mean(axis=0), X.var(axis=0)))
+        self._refit_scaler()
+        X_scaled = self.scaler.transform(X)
+
+        forest = IsolationForest(
+            n_estimators=self.trees_per_batch,
+            max_samples=min(self.max_samples, len(X_scaled)),
+            max_features=self.max_features,
+            contamination='auto',
+            random_state=int(rng.integers(2 ** 31 - 1)),
+        )
+        try:
+            forest.fit(X_scaled)
+        except Exception:
+            self.batch_stats.pop()
+            self._refit_scaler()
+            raise
+        self.forests.append(forest)
+        self.forest_scalers.append((self.scaler.mean_.copy(), self.scaler.scale_.copy()))
+
+        # Soglia aggiornata sugli score dei batch recenti
+        self.recent_scores.append(self.score_samples(X_scaled))
+        self.offset_ = float(np.percentile(
+            np.concatenate(self.recent_scores), 100.0 * self.contamination
+        ))
+        self.n_batches += 1
+
+        LOG.debug(f"Foresta online aggiornata: {self.n_estimators} alberi, "
+                  f"{self.n_batches} batch")
+        return self
+
+    def forget(self, fraction: float = 0.5):
+        """Scarta la frazione più vecchia delle sotto-foreste (es. dopo un
+        drift), mantenendone almeno una, e riparte con la soglia recente"""
+        drop = min(int(len(self.forests) * fraction), len(self.forests) - 1)
+        for _ in range(drop):
+            self._drop_oldest()
+        if drop:
+            self._refit_scaler()
+        while len(self.recent_scores) > 1:
+            self.recent_scores.popleft()
+        LOG.info(f"Foresta online: scartate {drop} sotto-foreste obsolete")
+
+    def _drop_oldest(self):
+        self.forests.popleft()
+        if self.batch_stats:
+            self.batch_stats.popleft()
+        if self.forest_scalers:
+            self.forest_scalers.popleft()
+
+    def _refit_scaler(self):
+        """Media e varianza aggregate dei batch della finestra, scritte
+        nello scaler esistente (il detector ne tiene il riferimento)"""
+        if not self.batch_stats:
+            return
+        counts = np.array([n for n, _, _ in self.batch_stats], dtype=np.float64)
+        means = np.vstack([mean for _, mean, _ in self.batch_stats])
+        variances = np.vstack([var for _, _, var in self.batch_stats])
+        total = counts.sum()
+        mean = counts @ means / total
+        var = counts @ (variances + np.square(means - mean)) / total
+
+        scale = np.sqrt(var)
+        scale[scale < 10 * np.finfo(np.float64).eps] = 1.0  # come StandardScaler
+        self.scaler.mean_ = mean
+        self.scaler.var_ = var
+        self.scaler.scale_ = scale
+        self.scaler.n_samples_seen_ = int(total)
+        self.scaler.n_features_in_ = len(mean)
+
+    def score_samples(self, X_scaled: np.ndarray) -> np.ndarray:
+        """Score di anomalia (più basso = più anomalo) come IsolationForest.
+
+        X_scaled è trasformato con lo scaler corrente; ogni sotto-foresta
+        riceve le righe ritrasformate con la propria media/scala. Gli score
+        delle sotto-foreste sono combinati come se fossero un'unica
+        foresta: si media il logaritmo (profondità normalizzata) pesando per
+        numero di alberi.
+        """
+        if not self.forests:
+            raise ValueError("Foresta online non ancora addestrata")
+
+        X = np.asarray(X_scaled, dtype=np.float64) * self.scaler.scale_ + self.scaler.mean_
+        log_depths = np.zeros(len(X_scaled))
+        for forest, (mean, scale) in zip(self.forests, self.forest_scalers):
+            rows = (X - mean) / scale
+            log_depths += forest.n_estimators * np.log2(-forest.score_samples(rows))
+        return -np.power(2.0, log_depths / self.n_estimators)
+
+    def decision_function(self, X_scaled: np.ndarray) -> np.ndarray:
+        return self.score_samples(X_scaled) - self.offset_
+
+    def predict(self, X_scaled: np.ndarray) -> np.ndarray:
+        return np.where(self.decision_function(X_scaled) < 0, -1, 1)
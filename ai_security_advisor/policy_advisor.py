@@ -1,76 +1,115 @@
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Iterable, Optional, Union
 import logging
 
+from .policy_rules import RuleSet, DEFAULT_RULES
+from .cooldown import CooldownStore
+from .report import ReportBuilder
+from .failure_stats import FailureStats
+from .rollups import HourlyRollups
+
 LOG = logging.getLogger(__name__)
 
 class PolicyAdvisor:
     """Genera consigli di sicurezza basati sulle anomalie"""
 
+    DEFAULT_CONFIG = {
+        'risk_threshold': 0.7,
+        'mfa_threshold': 0.5,  # score minimo di force_mfa per credential stuffing
+        'block_threshold': 0.9,  # score minimo di temporary_block per password spraying
+        'max_failed_attempts': 5,
+        'spray_min_users': 30,  # utenti distinti da un IP nella finestra del detector
+        'stuffing_min_ips': 15,  # IP distinti verso un utente nella finestra del detector
+        'cooldown_minutes': 30,  # stessa (azione, target) non ripetuta prima di allora
+        'cooldown_path': None,  # file JSON dei cooldown (None = solo in memoria)
+        'aggregates': {},  # aggregati per chiave usabili nelle regole
+        'rules': None,  # None = DEFAULT_RULES (vedi policy_rules.py)
+        'extra_rules': [],  # regole aggiunte in coda a quelle di base
+        'report_max_users': 20,  # voci per sezione del report (il resto è contato in 'omitted')
+        'report_max_ips': 20,
+        'report_max_recommendations': 10,
+        'report_max_anomalies': 5,
+        'failure_stats_path': None,  # sketch dei fallimenti per IP/utente (None = solo in memoria)
+        'failure_stats_days': 7,  # bucket giornalieri conservati
+        'failure_stats_top_k': 20,  # candidati heavy hitter per giorno
+        'sketch_epsilon': 0.001,  # errore massimo: epsilon * fallimenti totali...
+        'sketch_delta': 0.01,  # ...con probabilità 1 - delta
+        'failure_stats_save_seconds': 60,
+        'rollup_path': None,  # aggregati orari per utente/IP (None = solo in memoria)
+        'rollup_retention_hours': 24 * 35,
+        'rollup_hll_precision': 6,
+        'rollup_save_seconds': 60
+    }
+
     def __init__(self, config: Dict[str, Any] = None):
-        self.config = config or {
-            'risk_threshold': 0.7,
-            'mfa_threshold': 0.5,
-            'block_threshold': 0.9,
-            'cooldown_minutes': 30
+        self.config = dict(self.DEFAULT_CONFIG)
+        self.config.update(config or {})
+
+        # Regole compilate una volta: soglie numeriche come costanti
+        self.rules = RuleSet(
+            list(self.config['rules'] or DEFAULT_RULES) + list(self.config['extra_rules'] or []),
+            aggregates=self.config['aggregates'],
+            constants=self.config
+        )
+
+        self.cooldowns = CooldownStore(self.config['cooldown_path'], self.config['cooldown_minutes'])
+        self.failure_stats = FailureStats(
+            self.config['failure_stats_path'],
+            retention_days=self.config['failure_stats_days'],
+            top_k=self.config['failure_stats_top_k'],
+            epsilon=self.config['sketch_epsilon'],
+            delta=self.config['sketch_delta'],
+            save_seconds=self.config['failure_stats_save_seconds']
+        )
+        self.rollups = HourlyRollups(
+            self.config['rollup_path'],
+            retention_hours=self.config['rollup_retention_hours'],
+            precision=self.config['rollup_hll_precision'],
+            save_seconds=self.config['rollup_save_seconds']
+        )
+
+    def observe(self, events: pd.DataFrame):
+        """Aggiorna statistiche dei fallimenti e rollup orari con tutti gli
+        eventi analizzati di un batch (non solo le anomalie)"""
+        self.failure_stats.update(events)
+        self.rollups.update(events)
+        self.save_state()
+
+    def save_state(self, force: bool = False):
+        """Persiste statistiche e rollup (al più ogni *_save_seconds)"""
+        try:
+            self.failure_stats.save(force)
+            self.rollups.save(force)
+        except OSError as e:
+            LOG.warning(f"Impossibile salvare statistiche e rollup: {e}")
+
+    def summarize(self, hours: int = 24, end=None, n: int = 10) -> Dict[str, Any]:
+        """Riepilogo delle ultime `hours` ore (24 giornaliero, 168
+        settimanale) dai rollup orari, senza rileggere gli eventi"""
+        end = pd.Timestamp(end) if end is not None else pd.Timestamp.now()
+        start = end - pd.Timedelta(hours=hours)
+        return {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'top_attacked_users': self.rollups.top('user', 'failures', n, start, end),
+            'most_anomalous_users': self.rollups.top('user', 'anomalies', n, start, end),
+            'top_failing_ips': self.rollups.top('ip', 'failures', n, start, end),
         }
 
-        self.action_history = []
+    def with_failure_counts(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Aggiunge ip_failures e user_failures: fallimenti stimati nei
+        giorni conservati, usabili nelle regole"""
+        if df.empty or not self.failure_stats.buckets:
+            return df
+        return df.assign(
+            ip_failures=self.failure_stats.estimate('ip', df['ip'].to_numpy()),
+            user_failures=self.failure_stats.estimate('user', df['user'].to_numpy())
+        )
 
     def analyze_event(self, event: pd.Series) -> List[Dict[str, Any]]:
-        """Analizza un singolo evento e genera raccomandazioni - VERSIONE MIGLIORATA"""
-        recommendations = []
-        risk_score = event.get('anomaly_score', 0)
-
-        # Normalizza score (IsolationForest: negativo = anomalia)
-        # Più negativo = più anomalo
-        normalized_score = abs(risk_score)  # Ora usiamo valore assoluto
-
-        # Check 1: Tentativi multipli falliti
-        if event.get('high_frequency', False) and not event.get('success', True):
-            # Conta quanti tentativi falliti ci sono stati
-            # (dovresti avere questa informazione nel DataFrame)
-            recommendations.append({
-                'action': 'temporary_block',
-                'target': event['ip'],
-                'duration_minutes': 30,
-                'reason': f"Alta frequenza di tentativi falliti da {event['ip']}",
-                'priority': 'high',
-                'score': min(normalized_score + 0.3, 1.0)
-            })
-
-        # Check 2: IP insolito con fallimento
-        if event.get('unusual_ip', False) and not event.get('success', True):
-            recommendations.append({
-                'action': 'force_mfa',
-                'target': event['user'],
-                'reason': f"Tentativo fallito da IP insolito {event['ip']}",
-                'priority': 'medium',
-                'score': min(normalized_score + 0.2, 1.0)
-            })
-
-        # Check 3: IP insolito con successo (potrebbe essere legittimo)
-        if event.get('unusual_ip', False) and event.get('success', True):
-            recommendations.append({
-                'action': 'notify_user',
-                'target': event['user'],
-                'reason': f"Accesso riuscito da IP insolito {event['ip']}",
-                'priority': 'low',
-                'score': normalized_score
-            })
-
-        # Check 4: Anomalia generale ad alto rischio
-        if event.get('is_anomaly', False) and normalized_score > self.config['risk_threshold']:
-            recommendations.append({
-                'action': 'review_session',
-                'target': event['user'],
-                'reason': f"Pattern di accesso anomalo (score: {normalized_score:.2f})",
-                'priority': 'medium' if normalized_score < 0.8 else 'high',
-                'score': normalized_score
-            })
-
-        return recommendations
+        """Analizza un singolo evento e genera raccomandazioni"""
+        return self.rules.evaluate(pd.DataFrame([event]))
 
     def _is_new_geolocation(self, event: pd.Series) -> bool:
         """Verifica se la geolocalizzazione è nuova per l'utente"""
@@ -83,68 +122,115 @@ class PolicyAdvisor:
         # Qui ritorno sempre False per semplicità
         return False
 
-    def _deduplicate_recommendations(self, recommendations: List[Dict]) -> List[Dict]:
-        """Rimuove raccomandazioni duplicate"""
-        seen = set()
-        unique = []
-
-        for rec in recommendations:
-            key = f"{rec['action']}-{rec['target']}"
-            if key not in seen:
-                seen.add(key)
-                unique.append(rec)
-
-        # Ordina per score decrescente
-        return sorted(unique, key=lambda x: x['score'], reverse=True)
-
-    def generate_report(self, anomalies_df: pd.DataFrame) -> Dict[str, Any]:
-        """Genera report giornaliero delle anomalie"""
-        if len(anomalies_df) == 0:
-            return {"status": "clean", "message": "Nessuna anomalia rilevata"}
-
-        report = {
-            "timestamp": datetime.now().isoformat(),
-            "total_events": len(anomalies_df),
-            "anomaly_count": anomalies_df['is_anomaly'].sum(),
-            "high_risk_users": [],
-            "suspicious_ips": [],
-            "recommendations": []
-        }
-
-        # Utenti ad alto rischio
-        high_risk_users = anomalies_df[anomalies_df['is_anomaly']].groupby('user').agg({
-            'anomaly_score': 'mean',
-            'ip': 'nunique'
-        }).reset_index()
-
-        for _, user in high_risk_users.iterrows():
-            report['high_risk_users'].append({
-                'user': user['user'],
-                'avg_risk_score': float(user['anomaly_score']),
-                'unique_ips': int(user['ip'])
-            })
-
-        # IP sospetti
-        suspicious_ips = anomalies_df.groupby('ip').agg({
-            'anomaly_score': 'mean',
-            'user': 'nunique',
-            'success': lambda x: (x == False).sum()
-        }).reset_index()
-
-        for _, ip in suspicious_ips.iterrows():
-            report['suspicious_ips'].append({
-                'ip': ip['ip'],
-                'avg_risk_score': float(ip['anomaly_score']),
-                'unique_users': int(ip['user']),
-                'failed_attempts': int(ip['success'])
-            })
-
-        # Raccomandazioni aggregate
-        all_recommendations = []
-        for idx, event in anomalies_df.iterrows():
-            recs = self.analyze_event(event)
-            all_recommendations.extend(recs)
-
-        report['recommendations'] = self._deduplicate_recommendations(all_recommendations)[:10]  # Top 10
-
-        return report
\ No newline at end of file
+    def recommend(self, df: pd.DataFrame, limit: int = None) -> List[Dict[str, Any]]:
+        """Raccomandazioni per un batch, in forma vettoriale.
+
+        Ogni regola è una maschera sul batch; i candidati sono raggruppati
+        per (azione, target) tenendo lo score massimo, e solo i gruppi
+        superstiti diventano dizionari.
+        """
+        return self.rules.evaluate(df, limit)
+
+    def _recommend_with_cooldown(self, df: pd.DataFrame, limit: int = None,
+                                 stats: Optional[Dict[str, int]] = None,
+                                 anomalies: Optional[np.ndarray] = None):
+        """Come recommend, scartando in blocco le coppie (azione, target)
+        ancora in cooldown; le raccomandazioni emesse entrano in cooldown.
+
+        Returns:
+            (raccomandazioni, numero di raccomandazioni soppresse)
+        """
+        suppressed = []
+
+        def suppress(actions, targets):
+            mask = self.cooldowns.active_mask(actions, targets)
+            suppressed.append(int(mask.sum()))
+            return mask
+
+        recommendations = self.rules.evaluate(df, limit, suppress, stats, anomalies)
+        self.cooldowns.register(recommendations)
+        try:
+            self.cooldowns.save()
+        except OSError as e:
+            LOG.warning(f"Impossibile salvare i cooldown: {e}")
+        return recommendations, sum(suppressed)
+
+    def report_builder(self) -> ReportBuilder:
+        """Builder di report con i limiti configurati"""
+        return ReportBuilder(
+            max_users=self.config['report_max_users'],
+            max_ips=self.config['report_max_ips'],
+            max_recommendations=self.config['report_max_recommendations'],
+            max_anomalies=self.config['report_max_anomalies']
+        )
+
+    def generate_report(self, anomalies: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+                        explain: Optional[Callable[[pd.DataFrame], List[Dict]]] = None,
+                        events: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
+        """Genera report giornaliero delle anomalie.
+
+        `anomalies` è un DataFrame o un iterabile di batch: ogni batch è
+        consumato dal ReportBuilder, quindi la dimensione del report resta
+        fissa (report_max_*) e l'eccedenza è contata in 'omitted'.
+
+        `explain` (es. AnomalyDetector.explain) riceve le anomalie e
+        restituisce le spiegazioni delle più gravi: sono aggiunte come
+        'top_anomalies' e collegate alle voci con lo stesso utente/IP.
+
+        `events` è il batch analizzato completo: se passato le raccomandazioni
+        sono calcolate su di esso, con le regole a finestra (scope
+        'events', es. password spraying) su tutti gli eventi e le altre solo
+        sulle anomalie. Un report può allora contenere raccomandazioni
+        anche senza anomalie.
+        """
+        batches = [anomalies] if isinstance(anomalies, pd.DataFrame) else anomalies
+        builder = self.report_builder()
+        limit = self.config['report_max_recommendations']
+
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            builder.add_events(batch)
+
+            # Raccomandazioni aggregate (regole vettoriali sull'intero batch)
+            if events is None:
+                stats = {}
+                recommendations, suppressed = self._recommend_with_cooldown(
+                    self.with_failure_counts(batch), limit, stats)
+                builder.add_recommendations(recommendations, stats.get('groups'), suppressed)
+
+            if explain is not None:
+                builder.add_explanations(explain(batch))
+
+        if events is not None and len(events):
+            stats = {}
+            recommendations, suppressed = self._recommend_with_cooldown(
+                self.with_failure_counts(events), limit, stats,
+                anomalies=events['is_anomaly'].to_numpy(dtype=bool))
+            builder.add_recommendations(recommendations, stats.get('groups'), suppressed)
+
+        report = builder.build()
+        if self.failure_stats.buckets and 'status' not in report:
+            report['failure_summary'] = self.failure_stats.summary(self.config['report_max_ips'])
+        if explain is not None and 'top_anomalies' in report:
+            self._attach_explanations(report)
+        return report
+
+    @staticmethod
+    def _attach_explanations(report: Dict[str, Any]):
+        """Collega a utenti, IP e raccomandazioni la spiegazione dell'anomalia
+        più grave che li riguarda"""
+        by_target = {}
+        for explanation in report.get('top_anomalies', []):
+            by_target.setdefault(explanation['user'], explanation['summary'])
+            by_target.setdefault(explanation['ip'], explanation['summary'])
+
+        for entry in report['high_risk_users']:
+            if entry['user'] in by_target:
+                entry['explanation'] = by_target[entry['user']]
+        for entry in report['suspicious_ips']:
+            if entry['ip'] in by_target:
+                entry['explanation'] = by_target[entry['ip']]
+        for rec in report['recommendations']:
+            if rec['target'] in by_target:
+                rec['explanation'] = by_target[rec['target']]
\ No newline at end of file
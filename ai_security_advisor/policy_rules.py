@@ -0,0 +1,490 @@
+"""
+Regole di policy dichiarative (YAML) compilate in predicati vettoriali
+
+Esempio (sezione `policy` della configurazione):
+
+    aggregates:
+      failed_per_ip_5m:            # fallimenti dello stesso IP negli ultimi 5 minuti
+        count: ip
+        window_minutes: 5
+        where: "not success"
+    rules:
+      - name: brute_force_block
+        when:                      # condizioni in AND
+          - "failed_per_ip_5m >= max_failed_attempts"
+          - "score > block_threshold"
+        action: temporary_block
+        target: ip
+        priority: high
+        score: "min(score + 0.3, 1)"
+        reason: "{failed_per_ip_5m} tentativi falliti in 5 minuti da {ip}"
+        params: {duration_minutes: 30}
+
+`scope` indica su quali righe è valutata una regola quando il chiamante
+passa il batch analizzato completo: 'anomalies' (predefinito) solo sugli
+eventi con is_anomaly, 'events' su tutti (regole su aggregati a finestra,
+come password spraying e credential stuffing, che devono vedere anche
+i tentativi che il modello non considera anomali).
+
+Le espressioni usano colonne del batch, `score` (|anomaly_score|), le
+soglie numeriche della configurazione e gli aggregati; sono ammessi
+and/or/not, confronti (anche `in [...]`), + - * / e min/max/abs.
+Ogni espressione è compilata una sola volta in una funzione NumPy; le
+condizioni di una regola sono valutate solo sulle righe sopravvissute
+alle precedenti, nell'ordine di selettività misurata (la più
+restrittiva prima).
+"""
+import ast
+import logging
+import operator
+import string
+from typing import Dict, Any, List, Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+LOG = logging.getLogger(__name__)
+
+# Valori dei flag mancanti nel batch (come event.get(nome, default))
+COLUMN_DEFAULTS = {
+    'success': True,
+    'is_anomaly': False,
+    'unusual_ip': False,
+    'high_frequency': False,
+    'ip_distinct_users': 0.0,
+    'user_distinct_ips': 0.0,
+    'ip_failures': 0.0,
+    'user_failures': 0.0,
+}
+
+# Le quattro regole storiche di PolicyAdvisor.analyze_event, più quelle
+# sulle cardinalità utenti/IP calcolate dal detector (SprayTracker): il
+# loro score minimo è block_threshold per i blocchi e mfa_threshold per l'MFA
+DEFAULT_RULES = [
+    {
+        'name': 'high_frequency_failures',
+        'when': ['high_frequency', 'not success'],
+        'action': 'temporary_block',
+        'target': 'ip',
+        'priority': 'high',
+        'score': 'min(score + 0.3, 1)',
+        'reason': 'Alta frequenza di tentativi falliti da {ip}',
+        'params': {'duration_minutes': 30},
+    },
+    {
+        'name': 'unusual_ip_failure',
+        'when': ['unusual_ip', 'not success'],
+        'action': 'force_mfa',
+        'target': 'user',
+        'priority': 'medium',
+        'score': 'min(score + 0.2, 1)',
+        'reason': 'Tentativo fallito da IP insolito {ip}',
+    },
+    {
+        'name': 'unusual_ip_success',
+        'when': ['unusual_ip', 'success'],
+        'action': 'notify_user',
+        'target': 'user',
+        'priority': 'low',
+        'score': 'score',
+        'reason': 'Accesso riuscito da IP insolito {ip}',
+    },
+    {
+        'name': 'high_risk_anomaly',
+        'when': ['is_anomaly', 'score > risk_threshold'],
+        'action': 'review_session',
+        'target': 'user',
+        'priority': {'high': 'score >= 0.8', 'default': 'medium'},
+        'score': 'score',
+        'reason': 'Pattern di accesso anomalo (score: {score:.2f})',
+    },
+    {
+        'name': 'password_spraying',
+        'scope': 'events',
+        'when': ['not success', 'ip_distinct_users >= spray_min_users'],
+        'action': 'temporary_block',
+        'target': 'ip',
+        'priority': 'high',
+        'score': 'max(score, block_threshold)',
+        'reason': 'Password spraying da {ip}: {ip_distinct_users:.0f} utenti distinti in pochi minuti',
+        'params': {'duration_minutes': 60},
+    },
+    {
+        'name': 'credential_stuffing',
+        'scope': 'events',
+        'when': ['not success', 'user_distinct_ips >= stuffing_min_ips'],
+        'action': 'force_mfa',
+        'target': 'user',
+        'priority': 'high',
+        'score': 'max(score, mfa_threshold)',
+        'reason': 'Tentativi falliti su {user} da {user_distinct_ips:.0f} IP distinti in pochi minuti',
+    },
+]
+
+_BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+_COMPARE_OPS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+_FUNCTIONS = {
+    'min': np.minimum,
+    'max': np.maximum,
+    'abs': np.abs,
+}
+
+Compiled = Callable[['BatchEnv', np.ndarray], Any]
+
+
+class Expression:
+    """Espressione compilata: fn(env, righe) -> array (o scalare)"""
+
+    def __init__(self, source: str):
+        self.source = str(source)
+        self.names = set()
+        try:
+            tree = ast.parse(self.source, mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f"Espressione non valida '{self.source}': {e}") from e
+        self.fn = self._compile(tree.body)
+
+    def __call__(self, env: 'BatchEnv', rows: np.ndarray):
+        return self.fn(env, rows)
+
+    def _compile(self, node) -> Compiled:
+        if isinstance(node, ast.Constant):
+            value = node.value
+            return lambda env, rows: value
+
+        if isinstance(node, ast.Name):
+            name = node.id
+            self.names.add(name)
+            return lambda env, rows: env.values(name, rows)
+
+        if isinstance(node, (ast.List, ast.Tuple)):
+            items = [self._literal(item) for item in node.elts]
+            return lambda env, rows: items
+
+        if isinstance(node, ast.BoolOp):
+            parts = [self._compile(value) for value in node.values]
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return lambda env, rows: combine.reduce([np.broadcast_to(part(env, rows), rows.shape)
+                                                     for part in parts])
+
+        if isinstance(node, ast.UnaryOp):
+            operand = self._compile(node.operand)
+            if isinstance(node.op, ast.Not):
+                return lambda env, rows: np.logical_not(operand(env, rows))
+            if isinstance(node.op, ast.USub):
+                return lambda env, rows: -operand(env, rows)
+            raise ValueError(f"Operatore non ammesso in '{self.source}'")
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            op = _BINARY_OPS[type(node.op)]
+            left, right = self._compile(node.left), self._compile(node.right)
+            return lambda env, rows: op(left(env, rows), right(env, rows))
+
+        if isinstance(node, ast.Compare):
+            return self._compile_compare(node)
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id in _FUNCTIONS and not node.keywords:
+            fn = _FUNCTIONS[node.func.id]
+            args = [self._compile(arg) for arg in node.args]
+            return lambda env, rows: fn(*[arg(env, rows) for arg in args])
+
+        raise ValueError(f"Costrutto non ammesso in '{self.source}': {type(node).__name__}")
+
+    def _compile_compare(self, node: ast.Compare) -> Compiled:
+        terms = [self._compile(node.left)] + [self._compile(c) for c in node.comparators]
+        steps = []
+        for op in node.ops:
+            if isinstance(op, (ast.In, ast.NotIn)):
+                negate = isinstance(op, ast.NotIn)
+                steps.append(lambda a, b, negate=negate: np.isin(a, b, invert=negate))
+            elif type(op) in _COMPARE_OPS:
+                steps.append(_COMPARE_OPS[type(op)])
+            else:
+                raise ValueError(f"Confronto non ammesso in '{self.source}'")
+
+        def compare(env, rows):
+            values = [term(env, rows) for term in terms]
+            result = True
+            for step, left, right in zip(steps, values, values[1:]):
+                result = np.logical_and(result, step(left, right))
+            return result
+
+        return compare
+
+    def _literal(self, node):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) \
+                and isinstance(node.operand, ast.Constant):
+            return -node.operand.value
+        raise ValueError(f"Le liste in '{self.source}' ammettono solo costanti")
+
+
+class Condition:
+    """Predicato booleano con statistiche di selettività"""
+
+    def __init__(self, source: str):
+        self.expression = Expression(source)
+        self.evaluated = 0
+        self.passed = 0
+
+    @property
+    def selectivity(self) -> float:
+        """Frazione stimata di righe che passano (prior 0.5)"""
+        return (self.passed + 1) / (self.evaluated + 2)
+
+    def filter(self, env: 'BatchEnv', rows: np.ndarray) -> np.ndarray:
+        mask = np.broadcast_to(np.asarray(self.expression(env, rows), dtype=bool), rows.shape)
+        kept = rows[mask]
+        self.evaluated += len(rows)
+        self.passed += len(kept)
+        return kept
+
+
+class Aggregate:
+    """Aggregato per chiave calcolato sull'intero batch.
+
+    count: <colonna>  numero di righe (filtrate da `where`) con la stessa
+                      chiave, eventualmente nella finestra di
+                      `window_minutes` che termina all'evento
+    distinct: <colonna>, by: <colonna>  valori distinti per chiave
+    """
+
+    def __init__(self, name: str, spec: Dict[str, Any]):
+        self.name = name
+        self.where = Expression(spec['where']) if spec.get('where') else None
+        if 'count' in spec:
+            self.kind, self.key, self.of = 'count', spec['count'], None
+        elif 'distinct' in spec and 'by' in spec:
+            self.kind, self.key, self.of = 'distinct', spec['by'], spec['distinct']
+        else:
+            raise ValueError(f"Aggregato '{name}': serve 'count' oppure 'distinct' + 'by'")
+        self.window_seconds = int(spec.get('window_minutes', 0) * 60)
+
+    def compute(self, env: 'BatchEnv') -> np.ndarray:
+        all_rows = np.arange(env.n_rows)
+        mask = np.ones(env.n_rows, dtype=bool)
+        if self.where is not None:
+            mask = np.broadcast_to(np.asarray(self.where(env, all_rows), dtype=bool), mask.shape)
+
+        codes, uniques = pd.factorize(env.values(self.key, all_rows))
+        n_keys = len(uniques)
+
+        if self.kind == 'distinct':
+            value_codes, values = pd.factorize(env.values(self.of, all_rows))
+            pairs = np.unique(codes[mask].astype(np.int64) * max(len(values), 1) + value_codes[mask])
+            return np.bincount(pairs // max(len(values), 1), minlength=n_keys)[codes]
+
+        if not self.window_seconds:
+            return np.bincount(codes[mask], minlength=n_keys)[codes]
+
+        # Conteggio a finestra: chiave e tempo combinati in un solo intero
+        # ordinabile, poi due searchsorted per riga
+        timestamps = pd.to_datetime(env.values('timestamp', all_rows))
+        seconds = np.asarray(timestamps, dtype='datetime64[s]').astype(np.int64)
+        seconds = seconds - seconds.min() + self.window_seconds
+        span = int(seconds.max()) + self.window_seconds + 1
+        combined = codes.astype(np.int64) * span + seconds
+        matching = np.sort(combined[mask])
+        high = np.searchsorted(matching, combined, side='right')
+        low = np.searchsorted(matching, combined - self.window_seconds, side='left')
+        return high - low
+
+
+class BatchEnv:
+    """Valori delle variabili per un batch, calcolati al primo uso"""
+
+    def __init__(self, df: pd.DataFrame, constants: Dict[str, Any],
+                 aggregates: Dict[str, Aggregate]):
+        self.df = df
+        self.n_rows = len(df)
+        self.constants = constants
+        self.aggregates = aggregates
+        self.columns: Dict[str, np.ndarray] = {}
+
+    def column(self, name: str) -> np.ndarray:
+        if name in self.columns:
+            return self.columns[name]
+
+        if name in self.aggregates:
+            values = self.aggregates[name].compute(self)
+        elif name == 'score':
+            raw = self.df['anomaly_score'].fillna(0) if 'anomaly_score' in self.df.columns \
+                else pd.Series(0.0, index=self.df.index)
+            values = np.abs(raw.to_numpy(dtype=np.float64))
+        elif name in COLUMN_DEFAULTS:
+            default = COLUMN_DEFAULTS[name]
+            dtype = bool if isinstance(default, bool) else np.float64
+            values = self.df[name].fillna(default).to_numpy(dtype=dtype) \
+                if name in self.df.columns else np.full(self.n_rows, default, dtype=dtype)
+        elif name in self.df.columns:
+            values = self.df[name].to_numpy()
+        else:
+            raise KeyError(f"Variabile sconosciuta nelle regole di policy: '{name}'")
+
+        self.columns[name] = values
+        return values
+
+    def values(self, name: str, rows: np.ndarray):
+        if name in self.constants:
+            return self.constants[name]
+        return self.column(name)[rows]
+
+
+class Rule:
+    """Regola compilata: condizioni in AND, azione, target, score, priorità"""
+
+    def __init__(self, spec: Dict[str, Any]):
+        missing = [key for key in ('action', 'target') if key not in spec]
+        if missing:
+            raise ValueError(f"Regola {spec.get('name', '?')}: mancano {missing}")
+
+        self.name = spec.get('name', spec['action'])
+        self.action = spec['action']
+        self.target = spec['target']
+        self.scope = spec.get('scope', 'anomalies')
+        if self.scope not in ('anomalies', 'events'):
+            raise ValueError(f"Regola {self.name}: scope non valido '{self.scope}' "
+                             f"(ammessi: anomalies, events)")
+        when = spec.get('when') or []
+        self.conditions = [Condition(c) for c in ([when] if isinstance(when, str) else when)]
+        self.score = Expression(spec.get('score', 'score'))
+        self.params = dict(spec.get('params') or {})
+        self.reason = spec.get('reason', f"Regola {self.name}")
+        self.reason_fields = {field for _, field, _, _ in string.Formatter().parse(self.reason)
+                              if field}
+
+        priority = spec.get('priority', 'medium')
+        if isinstance(priority, dict):
+            self.default_priority = priority.get('default', 'medium')
+            self.priority_levels = [(level, Condition(source))
+                                    for level, source in priority.items() if level != 'default']
+        else:
+            self.default_priority = priority
+            self.priority_levels = []
+
+    def select(self, env: BatchEnv, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Righe (tra `rows`, di default tutte) che soddisfano tutte le
+        condizioni (corto circuito, le più selettive per prime)"""
+        rows = np.arange(env.n_rows) if rows is None else rows
+        for condition in sorted(self.conditions, key=lambda c: c.selectivity):
+            if len(rows) == 0:
+                break
+            rows = condition.filter(env, rows)
+        return rows
+
+    def scores(self, env: BatchEnv, rows: np.ndarray) -> np.ndarray:
+        return np.broadcast_to(np.asarray(self.score(env, rows), dtype=np.float64), rows.shape)
+
+    def priorities(self, env: BatchEnv, rows: np.ndarray) -> np.ndarray:
+        result = np.full(len(rows), self.default_priority, dtype=object)
+        undecided = np.ones(len(rows), dtype=bool)
+        for level, condition in self.priority_levels:
+            match = undecided & np.broadcast_to(
+                np.asarray(condition.expression(env, rows), dtype=bool), rows.shape)
+            result[match] = level
+            undecided &= ~match
+        return result
+
+    def build(self, env: BatchEnv, rows: np.ndarray, scores: np.ndarray) -> List[Dict[str, Any]]:
+        """Dizionari di raccomandazione per le righe superstiti"""
+        fields = {name: env.values(name, rows) for name in self.reason_fields
+                  if name not in ('score', 'target')}
+        targets = env.values(self.target, rows)
+        priorities = self.priorities(env, rows)
+
+        recommendations = []
+        for i in range(len(rows)):
+            values = {name: column[i] if np.ndim(column) else column
+                      for name, column in fields.items()}
+            values['score'] = float(scores[i])
+            values['target'] = targets[i]
+            rec = {'action': self.action, 'target': targets[i]}
+            rec.update(self.params)
+            rec['reason'] = self.reason.format(**values)
+            rec['priority'] = priorities[i]
+            rec['score'] = float(scores[i])
+            rec['rule'] = self.name
+            recommendations.append(rec)
+        return recommendations
+
+
+class RuleSet:
+    """Insieme di regole compilate una volta all'avvio"""
+
+    def __init__(self, rules: List[Dict[str, Any]], aggregates: Dict[str, Dict] = None,
+                 constants: Dict[str, Any] = None):
+        self.rules = [Rule(spec) for spec in rules]
+        self.aggregates = {name: Aggregate(name, spec) for name, spec in (aggregates or {}).items()}
+        self.constants = {name: value for name, value in (constants or {}).items()
+                          if isinstance(value, (int, float, bool)) and name not in self.aggregates}
+        LOG.debug(f"Compilate {len(self.rules)} regole di policy")
+
+    def evaluate(self, df: pd.DataFrame, limit: Optional[int] = None,
+                 suppress: Callable[[np.ndarray, np.ndarray], np.ndarray] = None,
+                 stats: Optional[Dict[str, int]] = None,
+                 anomalies: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+        """Raccomandazioni per un batch: una per (azione, target), con lo
+        score massimo, ordinate per score decrescente.
+
+        `anomalies` è la maschera booleana delle anomalie quando il batch
+        contiene tutti gli eventi analizzati: le regole con scope
+        'anomalies' sono valutate solo su quelle righe.
+
+        `suppress(azioni, target)` restituisce la maschera dei gruppi da
+        scartare (es. in cooldown), applicata prima del limite. Se passato,
+        `stats['groups']` riceve il numero di gruppi prima del limite.
+        """
+        if len(df) == 0:
+            return []
+
+        env = BatchEnv(df.reset_index(drop=True), self.constants, self.aggregates)
+        anomaly_rows = np.flatnonzero(anomalies) if anomalies is not None else None
+        frames = []
+        for index, rule in enumerate(self.rules):
+            rows = rule.select(env, anomaly_rows if rule.scope == 'anomalies' else None)
+            if len(rows):
+                frames.append(pd.DataFrame({
+                    'rule': index,
+                    'action': rule.action,
+                    'target': env.values(rule.target, rows),
+                    'score': rule.scores(env, rows),
+                    'row': rows,
+                }))
+        if not frames:
+            return []
+
+        candidates = pd.concat(frames, ignore_index=True)
+        best = candidates.loc[candidates.groupby(['action', 'target'], sort=False)['score'].idxmax()]
+        if suppress is not None and len(best):
+            best = best[~suppress(best['action'].to_numpy(), best['target'].to_numpy())]
+        if stats is not None:
+            stats['groups'] = len(best)
+        if limit is not None and len(best) > limit:
+            best = best.loc[best['score'].nlargest(limit, keep='first').index]
+        best = best.sort_values('score', ascending=False, kind='stable')
+
+        # Dizionari costruiti solo per i gruppi superstiti, regola per regola
+        built = {}
+        for index, group in best.groupby('rule', sort=False):
+            recs = self.rules[index].build(env, group['row'].to_numpy(), group['score'].to_numpy())
+            built.update(zip(group.index, recs))
+        return [built[position] for position in best.index]
+
+    def selectivity(self) -> Dict[str, Dict[str, float]]:
+        """Selettività misurata delle condizioni (per diagnostica)"""
+        return {rule.name: {c.expression.source: round(c.selectivity, 4) for c in rule.conditions}
+                for rule in self.rules}
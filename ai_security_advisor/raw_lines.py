@@ -0,0 +1,268 @@
+"""
+Archivio compresso e deduplicato delle righe di log grezze
+"""
+import json
+import logging
+import lzma
+import re
+import sqlite3
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+TIMESTAMP_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?')
+
+# Segnaposto dei campi variabili nei template (\x00 non compare nei log)
+TIMESTAMP_MARK = '\x00T'
+IP_MARK = '\x00I'
+USER_MARK = '\x00U'
+
+# Template speciali: riga intera nel blocco, in chiaro o in JSON se
+# contiene i separatori del formato
+RAW_TEMPLATE = -1
+ESCAPED_TEMPLATE = -2
+
+# Delimitatori più comuni attorno al nome utente, provati prima del nome nudo
+USER_DELIMITERS = (("'", "'"), ('[', ']'), ('"', '"'), ('=', ' '))
+
+COLUMN_SEPARATOR = '\x1d'
+# Codec del blocco aperto: righe in chiaro in raw_open_lines, data vuoto
+OPEN_CODEC = 'open'
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+
+def split_line(line: str, user: str, ip: str) -> Optional[Tuple[str, str]]:
+    """Scompone una riga in (template, timestamp testuale) togliendo
+    timestamp, IP e utente; None se la scomposizione non è reversibile"""
+    if '\x00' in line:
+        return None
+    match = TIMESTAMP_PATTERN.search(line)
+    if match is None:
+        return None
+    template = line[:match.start()] + TIMESTAMP_MARK + line[match.end():]
+
+    if ip:
+        position = template.find(ip)
+        if position < 0:
+            return None
+        template = template[:position] + IP_MARK + template[position + len(ip):]
+
+    if user:
+        position = -1
+        for left, right in USER_DELIMITERS:
+            position = template.find(left + user + right)
+            if position >= 0:
+                position += len(left)
+                break
+        if position < 0:
+            position = template.find(user)
+        if position < 0:
+            return None
+        template = template[:position] + USER_MARK + template[position + len(user):]
+
+    # I segnaposto sono unici (la riga non contiene \x00), quindi
+    # join_line ricostruisce esattamente la riga
+    return template, match.group(0)
+
+
+def join_line(template: str, timestamp: str, user: str, ip: str) -> str:
+    """Inverso di split_line"""
+    return (template.replace(TIMESTAMP_MARK, timestamp, 1)
+            .replace(IP_MARK, ip, 1).replace(USER_MARK, user, 1))
+
+
+def encode_block(columns: List[List[str]], codec: str) -> bytes:
+    """Blocco a colonne (template, timestamp, utente, IP): ogni colonna è
+    compressa accanto a valori simili, il che rende la compressione molto
+    più efficace che riga per riga"""
+    compress, _ = CODECS[codec]
+    text = COLUMN_SEPARATOR.join('\n'.join(column) for column in columns)
+    return compress(text.encode('utf-8'))
+
+
+def decode_block(data: bytes, codec: str) -> List[List[str]]:
+    _, decompress = CODECS[codec]
+    return [column.split('\n') for column in decompress(data).decode('utf-8').split(COLUMN_SEPARATOR)]
+
+
+class RawLineStore:
+    """Righe di log grezze in una connessione SQLite, compresse a blocchi.
+
+    Ogni riga è ridotta a un template (la riga senza timestamp, utente e
+    IP, salvato una sola volta in raw_templates) più i tre valori
+    variabili. Le righe sono raccolte in blocchi di `block_lines` righe,
+    memorizzati a colonne e compressi con zlib o lzma in raw_blocks. Un
+    evento riferisce la sua riga con (blocco, posizione).
+
+    L'ultimo blocco resta aperto: le sue righe sono inserite in chiaro in
+    raw_open_lines e il blocco è compresso una sola volta, quando è pieno.
+    Le scritture avvengono nella transazione del chiamante, quindi eventi
+    e righe sono salvati insieme (dopo un rollback va chiamato reload()).
+    Le letture decomprimono un blocco intero e ne tengono in cache gli
+    ultimi `cache_blocks`.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, codec: str = 'zlib', block_lines: int = 4096,
+                 cache_blocks: int = 8):
+        if codec not in CODECS:
+            raise ValueError(f"Codec non supportato: {codec} (disponibili: {', '.join(CODECS)})")
+        self.conn = conn
+        self.codec = codec
+        self.block_lines = int(block_lines)
+        self.cache_blocks = int(cache_blocks)
+        self._cache: 'OrderedDict[int, List[List[str]]]' = OrderedDict()
+        self.reload()
+
+    def reload(self):
+        """Rilegge template e blocco aperto dal database"""
+        self.templates: Dict[str, int] = {
+            template: template_id for template_id, template in
+            self.conn.execute('SELECT id, template FROM raw_templates')
+        }
+        self.template_texts: Dict[int, str] = {
+            template_id: template for template, template_id in self.templates.items()
+        }
+        self._cache.clear()
+
+        # Blocco aperto: l'ultimo, se non è ancora compresso (un blocco
+        # compresso non pieno di una versione precedente resta com'è)
+        self.open_block: Optional[int] = None
+        self.open_columns: List[List[str]] = [[], [], [], []]
+        row = self.conn.execute('SELECT id, codec FROM raw_blocks ORDER BY id DESC LIMIT 1').fetchone()
+        if row is not None and row[1] == OPEN_CODEC:
+            self.open_block = row[0]
+            self.open_columns = self._open_lines(row[0])
+
+    def _open_lines(self, block: int) -> List[List[str]]:
+        """Colonne (template, timestamp, utente, IP) di un blocco aperto"""
+        rows = self.conn.execute('SELECT template, timestamp, user, ip FROM raw_open_lines '
+                                 'WHERE block = ? ORDER BY offset', (block,)).fetchall()
+        return [list(column) for column in zip(*rows)] if rows else [[], [], [], []]
+
+    def _template_id(self, template: str) -> int:
+        template_id = self.templates.get(template)
+        if template_id is None:
+            template_id = self.conn.execute(
+                'INSERT INTO raw_templates (template) VALUES (?)', (template,)).lastrowid
+            self.templates[template] = template_id
+            self.template_texts[template_id] = template
+        return template_id
+
+    def _record(self, line: str, user: str, ip: str) -> Tuple[str, str, str, str]:
+        parts = split_line(line, user, ip)
+        fields = user + ip
+        if parts is not None and '\n' not in fields and COLUMN_SEPARATOR not in fields:
+            return str(self._template_id(parts[0])), parts[1], user, ip
+        if '\n' in line or COLUMN_SEPARATOR in line:
+            return str(ESCAPED_TEMPLATE), json.dumps(line), '', ''
+        return str(RAW_TEMPLATE), line, '', ''
+
+    def append(self, lines: Iterable[str], users: Iterable[str], ips: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Aggiunge le righe e restituisce (blocco, posizione) di ciascuna"""
+        records = [self._record(line, user, ip) for line, user, ip in zip(lines, users, ips)]
+        blocks = np.empty(len(records), dtype=np.int64)
+        offsets = np.empty(len(records), dtype=np.int64)
+
+        start = 0
+        while start < len(records):
+            used = len(self.open_columns[0])
+            take = min(self.block_lines - used, len(records) - start)
+            chunk = records[start:start + take]
+            for column, values in zip(self.open_columns, zip(*chunk)):
+                column.extend(values)
+            lines_in_block = len(self.open_columns[0])
+
+            if self.open_block is None:
+                self.open_block = self.conn.execute(
+                    'INSERT INTO raw_blocks (codec, lines, data) VALUES (?, ?, ?)',
+                    (OPEN_CODEC, lines_in_block, b'')).lastrowid
+            if lines_in_block >= self.block_lines:
+                # Blocco pieno: compresso una volta, righe in chiaro rimosse
+                self.conn.execute('UPDATE raw_blocks SET codec = ?, lines = ?, data = ? WHERE id = ?',
+                                  (self.codec, lines_in_block,
+                                   encode_block(self.open_columns, self.codec), self.open_block))
+                self.conn.execute('DELETE FROM raw_open_lines WHERE block = ?', (self.open_block,))
+            else:
+                self.conn.executemany(
+                    'INSERT INTO raw_open_lines (block, offset, template, timestamp, user, ip) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    ((self.open_block, used + i) + record for i, record in enumerate(chunk)))
+                self.conn.execute('UPDATE raw_blocks SET lines = ? WHERE id = ?',
+                                  (lines_in_block, self.open_block))
+
+            blocks[start:start + take] = self.open_block
+            offsets[start:start + take] = np.arange(used, used + take)
+            start += take
+            if lines_in_block >= self.block_lines:
+                self.open_block = None
+                self.open_columns = [[], [], [], []]
+
+        return blocks, offsets
+
+    def _block(self, block: int) -> Optional[List[List[str]]]:
+        if block == self.open_block:
+            return self.open_columns
+        cached = self._cache.get(block)
+        if cached is not None:
+            self._cache.move_to_end(block)
+            return cached
+        row = self.conn.execute('SELECT codec, data FROM raw_blocks WHERE id = ?', (block,)).fetchone()
+        if row is None:
+            return None
+        if row[0] == OPEN_CODEC:
+            # Blocco aperto di un altro writer: cresce ancora, niente cache
+            return self._open_lines(block)
+        columns = self._cache[block] = decode_block(row[1], row[0])
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return columns
+
+    def _template(self, template_id: int) -> Optional[str]:
+        template = self.template_texts.get(template_id)
+        if template is None:
+            # Template aggiunto da un altro writer dopo il caricamento
+            row = self.conn.execute('SELECT template FROM raw_templates WHERE id = ?', (template_id,)).fetchone()
+            if row is not None:
+                template = self.template_texts[template_id] = row[0]
+        return template
+
+    def get(self, block: int, offset: int) -> Optional[str]:
+        """Riga originale in posizione `offset` del blocco `block`"""
+        columns = self._block(int(block))
+        if columns is None or not 0 <= offset < len(columns[0]):
+            return None
+        template_id = int(columns[0][offset])
+        if template_id == RAW_TEMPLATE:
+            return columns[1][offset]
+        if template_id == ESCAPED_TEMPLATE:
+            return json.loads(columns[1][offset])
+        template = self._template(template_id)
+        if template is None:
+            return None
+        return join_line(template, columns[1][offset], columns[2][offset], columns[3][offset])
+
+    def get_many(self, blocks: Iterable[int], offsets: Iterable[int]) -> List[Optional[str]]:
+        """Righe originali, decomprimendo ogni blocco una volta sola"""
+        blocks = np.asarray(list(blocks), dtype=np.int64)
+        offsets = np.asarray(list(offsets), dtype=np.int64)
+        result: List[Optional[str]] = [None] * len(blocks)
+        for position in np.argsort(blocks, kind='stable'):
+            result[position] = self.get(blocks[position], int(offsets[position]))
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        lines, compressed = self.conn.execute(
+            'SELECT COALESCE(SUM(lines), 0), COALESCE(SUM(LENGTH(data)), 0) FROM raw_blocks').fetchone()
+        return {
+            'lines': int(lines),
+            'templates': len(self.templates),
+            'compressed_bytes': int(compressed),
+            'bytes_per_line': round(compressed / lines, 2) if lines else 0.0,
+        }
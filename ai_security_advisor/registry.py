@@ -0,0 +1,566 @@
+"""
+Registro versionato dei modelli (artefatti .npy mappabili in memoria)
+
+Struttura della directory:
+
+    <root>/
+        current -> versions/v000003      (symlink aggiornato atomicamente)
+        live_state.pkl                   stato incrementale della versione in uso
+        readers/<pid>                    versioni aperte da processi attivi
+        versions/
+            v000003/
+                manifest.json            versione, tipo di modello, hash dello schema feature, file
+                forest_*.npy             nodi della FlatForest
+                scaler_*.npy             media/scala dello StandardScaler
+                baseline_*.npy           istogrammi ora-della-settimana
+                profile_*.npy            profili utente (indice ordinato + CSR top-k)
+                state.pkl                oggetti piccoli (drift, segmenti, modello online)
+
+Le versioni sono scritte solo dopo un (ri)addestramento. Profili,
+baseline, sketch di correlazione e modello online aggiornati ad ogni
+analisi vanno in live_state.pkl, che vale solo per la versione da cui
+deriva e viene sovrascritto ad ogni salvataggio.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+from .baselines import HourOfWeekBaseline
+from .flat_forest import FlatForest
+from .sketches import SpaceSaving, BloomFilter
+
+LOG = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+CURRENT_LINK = 'current'
+VERSIONS_DIR = 'versions'
+LIVE_STATE = 'live_state.pkl'
+READERS_DIR = 'readers'
+
+
+def feature_schema_hash(feature_names: List[str]) -> str:
+    """Hash dello schema delle feature (nomi e ordine)"""
+    payload = json.dumps(list(feature_names)).encode('utf-8')
+    return hashlib.sha1(payload).hexdigest()[:16]
+
+
+def is_registry_path(path) -> bool:
+    """Un percorso senza estensione .pkl è trattato come registro"""
+    return Path(path).suffix != '.pkl'
+
+
+def _save_array(directory: Path, name: str, array: np.ndarray):
+    """Salva un array; se è già un file .npy mappato in sola lettura di una
+    versione precedente, crea un hard link invece di riscriverlo"""
+    target = directory / f"{name}.npy"
+    source = getattr(array, 'filename', None)
+    if isinstance(array, np.memmap) and array.mode == 'r' and source:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    np.save(target, np.ascontiguousarray(array), allow_pickle=False)
+
+
+def _load_array(directory: Path, name: str, mmap_mode: Optional[str] = 'r') -> np.ndarray:
+    return np.load(directory / f"{name}.npy", mmap_mode=mmap_mode, allow_pickle=False)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # processo di un altro utente
+    return True
+
+
+class LazyUserProfiles(MutableMapping):
+    """Profili utente letti pigramente da array mappati in memoria.
+
+    Gli utenti sono ordinati: la ricerca è un searchsorted, e il profilo
+    (sketch top-k + filtro di Bloom) viene materializzato solo al primo
+    accesso. I profili nuovi o modificati vivono in un dict in memoria.
+    """
+
+    def __init__(self, directory: Path, bloom_hashes: int):
+        self.users = _load_array(directory, 'profile_users')
+        self.total = _load_array(directory, 'profile_total')
+        self.last_seen = _load_array(directory, 'profile_last_seen')
+        self.topk_offsets = _load_array(directory, 'profile_topk_offsets')
+        self.topk_ips = _load_array(directory, 'profile_topk_ips')
+        self.topk_counts = _load_array(directory, 'profile_topk_counts')
+        self.topk_errors = _load_array(directory, 'profile_topk_errors')
+        self.topk_capacity = int(_load_array(directory, 'profile_topk_capacity', None))
+        self.bloom_bits = _load_array(directory, 'profile_bloom_bits')
+        self.bloom_hashes = int(bloom_hashes)
+        self.loaded: Dict[str, Dict[str, Any]] = {}
+
+    def _row(self, user) -> int:
+        if not isinstance(user, str) or len(self.users) == 0:
+            return -1
+        row = int(np.searchsorted(self.users, user))
+        if row < len(self.users) and self.users[row] == user:
+            return row
+        return -1
+
+    def _materialize(self, row: int) -> Dict[str, Any]:
+        topk = SpaceSaving(self.topk_capacity)
+        for i in range(self.topk_offsets[row], self.topk_offsets[row + 1]):
+            ip = str(self.topk_ips[i])
+            topk.counts[ip] = float(self.topk_counts[i])
+            topk.errors[ip] = float(self.topk_errors[i])
+
+        bloom = None
+        if self.bloom_bits.shape[1] > 0:
+            bloom = BloomFilter(self.bloom_bits.shape[1] * 8, self.bloom_hashes)
+            bloom.bits = np.array(self.bloom_bits[row])
+
+        last_seen = self.last_seen[row]
+        return {
+            'ip_topk': topk,
+            'ip_bloom': bloom,
+            'total_events': int(self.total[row]),
+            'last_seen': None if last_seen == np.iinfo(np.int64).min else pd.Timestamp(int(last_seen)),
+        }
+
+    def __getitem__(self, user):
+        if user in self.loaded:
+            return self.loaded[user]
+        row = self._row(user)
+        if row < 0:
+            raise KeyError(user)
+        profile = self._materialize(row)
+        self.loaded[user] = profile
+        return profile
+
+    def __setitem__(self, user, profile):
+        self.loaded[user] = profile
+
+    def __delitem__(self, user):
+        raise TypeError("I profili del registro non possono essere rimossi")
+
+    def __contains__(self, user) -> bool:
+        return user in self.loaded or self._row(user) >= 0
+
+    def __iter__(self):
+        for user in self.users:
+            yield str(user)
+        for user in self.loaded:
+            if self._row(user) < 0:
+                yield user
+
+    def __len__(self) -> int:
+        return len(self.users) + sum(1 for user in self.loaded if self._row(user) < 0)
+
+
+class ModelRegistry:
+    """Registro dei modelli con versioni immutabili e puntatore 'current'"""
+
+    def __init__(self, root: str, keep_versions: int = 5):
+        self.root = Path(root)
+        self.keep_versions = int(keep_versions)
+
+    @property
+    def versions_dir(self) -> Path:
+        return self.root / VERSIONS_DIR
+
+    def versions(self) -> List[str]:
+        if not self.versions_dir.exists():
+            return []
+        return sorted(p.name for p in self.versions_dir.iterdir()
+                      if p.is_dir() and p.name.startswith('v') and p.name[1:].isdigit())
+
+    def current_version(self) -> Optional[str]:
+        link = self.root / CURRENT_LINK
+        if not link.is_symlink():
+            return None
+        return Path(os.readlink(link)).name
+
+    def current_dir(self) -> Optional[Path]:
+        version = self.current_version()
+        return self.versions_dir / version if version else None
+
+    def read_manifest(self, version: str = None) -> Optional[Dict[str, Any]]:
+        directory = self.versions_dir / version if version else self.current_dir()
+        if directory is None or not (directory / 'manifest.json').exists():
+            return None
+        with open(directory / 'manifest.json') as f:
+            return json.load(f)
+
+    # ------------------------------------------------------------------
+    # Scrittura
+    # ------------------------------------------------------------------
+
+    def publish(self, detector) -> str:
+        """Scrive una nuova versione del detector e sposta 'current' su di essa
+        (dopo un addestramento: lo stato incrementale va in save_live_state)"""
+        self.versions_dir.mkdir(parents=True, exist_ok=True)
+        existing = self.versions()
+        number = int(existing[-1][1:]) + 1 if existing else 1
+        version = f"v{number:06d}"
+        staging = self.versions_dir / f".{version}.tmp"
+        if staging.exists():
+            shutil.rmtree(staging)
+        staging.mkdir()
+
+        files = []
+        model = detector._inference_model()
+        if isinstance(model, FlatForest):
+            for name, array in model.arrays().items():
+                _save_array(staging, f"forest_{name}", array)
+                files.append(f"forest_{name}.npy")
+            forest_meta = model.metadata()
+            model_type = 'flat'
+        else:
+            forest_meta = None
+            model_type = 'online' if detector.online else 'sklearn'
+
+        scaler = detector.scaler
+        if hasattr(scaler, 'mean_'):
+            _save_array(staging, 'scaler_mean', scaler.mean_)
+            _save_array(staging, 'scaler_scale', scaler.scale_)
+            files += ['scaler_mean.npy', 'scaler_scale.npy']
+
+        files += self._write_baselines(staging, detector.baselines)
+        files += self._write_profiles(staging, detector)
+
+        segments = detector.segments
+        if segments is not None and segments.index:
+            segment_dir = staging / 'segments'
+            segment_dir.mkdir()
+            for file_name, _ in segments.index.values():
+                source = segments.segment_dir / file_name
+                if source.exists():
+                    shutil.copy2(source, segment_dir / file_name)
+
+        state = {
+            'config': detector.config,
+            'feature_names': detector.feature_names,
+            'drift': detector.drift,
+            'segments': segments,
+            'correlation': detector.correlation,
+            # Modelli non esportati in array piatti: la foresta online e la
+            # IsolationForest con inference_engine 'sklearn'
+            'online_model': detector.model if model_type == 'online' else None,
+            'sklearn_model': detector.model if model_type == 'sklearn' else None,
+        }
+        with open(staging / 'state.pkl', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        files.append('state.pkl')
+
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'version': version,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'feature_names': detector.feature_names,
+            'feature_schema_hash': feature_schema_hash(detector.FEATURE_NAMES),
+            'model_type': model_type,
+            'forest': forest_meta,
+            'n_users': len(detector.user_profiles),
+            'files': files,
+        }
+        with open(staging / 'manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        staging.rename(self.versions_dir / version)
+        self._point_current(version)
+        self._prune()
+        LOG.info(f"Modello pubblicato nel registro {self.root} come {version}")
+        return version
+
+    def _point_current(self, version: str):
+        """Aggiorna atomicamente il symlink 'current'"""
+        tmp_link = self.root / f".{CURRENT_LINK}.tmp"
+        if tmp_link.is_symlink() or tmp_link.exists():
+            tmp_link.unlink()
+        os.symlink(Path(VERSIONS_DIR) / version, tmp_link)
+        os.replace(tmp_link, self.root / CURRENT_LINK)
+
+    def _prune(self):
+        """Rimuove le versioni più vecchie oltre keep_versions (mai 'current'
+        né quelle ancora aperte da un processo attivo)"""
+        if self.keep_versions <= 0:
+            return
+        keep = self.versions_in_use()
+        keep.add(self.current_version())
+        versions = self.versions()
+        excess = len(versions) - self.keep_versions
+        for version in versions:
+            if excess <= 0:
+                break
+            if version not in keep:
+                shutil.rmtree(self.versions_dir / version, ignore_errors=True)
+                excess -= 1
+
+    def _lease(self, versions: List[str]):
+        """Registra le versioni aperte da questo processo: gli array mappati
+        e i modelli di coorte (letti su richiesta) restano sul disco finché
+        il processo è attivo"""
+        readers = self.root / READERS_DIR
+        readers.mkdir(parents=True, exist_ok=True)
+        path = readers / str(os.getpid())
+        tmp_path = readers / f".{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(sorted(set(versions)), f)
+        os.replace(tmp_path, path)
+
+    def versions_in_use(self) -> set:
+        """Versioni aperte da processi ancora attivi (i lease dei processi
+        terminati vengono rimossi)"""
+        readers = self.root / READERS_DIR
+        in_use = set()
+        if not readers.exists():
+            return in_use
+        for path in readers.iterdir():
+            if not path.name.isdigit():
+                continue
+            if not _pid_alive(int(path.name)):
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                with open(path) as f:
+                    in_use.update(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return in_use
+
+    def save_live_state(self, detector):
+        """Salva lo stato aggiornato in modo incrementale (profili toccati,
+        baseline, sketch di correlazione, drift, modello online) legato
+        alla versione in uso, senza pubblicare una nuova versione"""
+        profiles = detector.user_profiles
+        if isinstance(profiles, LazyUserProfiles):
+            # Solo i profili materializzati: gli altri sono invariati nella versione
+            profiles = profiles.loaded
+        state = {
+            'version': detector.model_version,
+            'saved_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'user_profiles': dict(profiles),
+            'baselines': self._baseline_snapshot(detector.baselines),
+            'correlation': detector.correlation,
+            'drift': detector.drift,
+            'online_model': detector.model if detector.online else None,
+        }
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.root / f".{LIVE_STATE}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.root / LIVE_STATE)
+        LOG.info(f"Stato incrementale di {detector.model_version} salvato in {self.root / LIVE_STATE}")
+
+    def read_live_state(self, version: str) -> Optional[Dict[str, Any]]:
+        """Stato incrementale salvato per `version` (None se assente o di
+        un'altra versione)"""
+        path = self.root / LIVE_STATE
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            LOG.warning(f"Stato incrementale non leggibile ({path}): {e}")
+            return None
+        return state if state.get('version') == version else None
+
+    @staticmethod
+    def _baseline_snapshot(baselines: HourOfWeekBaseline) -> HourOfWeekBaseline:
+        """Copia delle baseline in array ordinari (non mappati) da serializzare"""
+        n_users = len(baselines.user_index)
+        snapshot = HourOfWeekBaseline(half_life_hours=baselines.half_life_hours,
+                                      min_events=baselines.min_events)
+        snapshot.user_index = dict(baselines.user_index)
+        snapshot.hist = np.array(baselines.hist[:n_users])
+        snapshot.last_update = np.array(baselines.last_update[:n_users])
+        return snapshot
+
+    @staticmethod
+    def _write_baselines(directory: Path, baselines: HourOfWeekBaseline) -> List[str]:
+        n_users = len(baselines.user_index)
+        users = np.empty(n_users, dtype=object)
+        for user, row in baselines.user_index.items():
+            users[row] = user
+        np.save(directory / 'baseline_users.npy', users.astype(str), allow_pickle=False)
+        np.save(directory / 'baseline_hist.npy', np.ascontiguousarray(baselines.hist[:n_users]))
+        np.save(directory / 'baseline_last_update.npy',
+                np.ascontiguousarray(baselines.last_update[:n_users]))
+        np.save(directory / 'baseline_params.npy',
+                np.array([baselines.half_life_hours, baselines.min_events]))
+        return ['baseline_users.npy', 'baseline_hist.npy',
+                'baseline_last_update.npy', 'baseline_params.npy']
+
+    @staticmethod
+    def _write_profiles(directory: Path, detector) -> List[str]:
+        profiles = detector.user_profiles
+        users = sorted(str(user) for user in profiles)
+        n_users = len(users)
+
+        total = np.zeros(n_users, dtype=np.int64)
+        last_seen = np.full(n_users, np.iinfo(np.int64).min, dtype=np.int64)
+        offsets = np.zeros(n_users + 1, dtype=np.int64)
+        ips, counts, errors = [], [], []
+        bloom_bytes = 0
+        blooms = []
+
+        lazy = profiles if isinstance(profiles, LazyUserProfiles) else None
+        for row, user in enumerate(users):
+            source = lazy._row(user) if lazy is not None and user not in lazy.loaded else -1
+            if source >= 0:
+                # Profilo mai letto: copiato dagli array senza materializzarlo
+                total[row] = lazy.total[source]
+                last_seen[row] = lazy.last_seen[source]
+                start, end = lazy.topk_offsets[source], lazy.topk_offsets[source + 1]
+                ips.extend(str(ip) for ip in lazy.topk_ips[start:end])
+                counts.extend(lazy.topk_counts[start:end].tolist())
+                errors.extend(lazy.topk_errors[start:end].tolist())
+                offsets[row + 1] = len(ips)
+                if lazy.bloom_bits.shape[1] > 0:
+                    bloom_bytes = lazy.bloom_bits.shape[1]
+                    blooms.append(lazy.bloom_bits[source])
+                else:
+                    blooms.append(None)
+                continue
+
+            profile = detector._profile(user)
+            total[row] = profile['total_events']
+            if profile['last_seen'] is not None:
+                last_seen[row] = pd.Timestamp(profile['last_seen']).value
+            for ip, count in profile['ip_topk'].counts.items():
+                ips.append(ip)
+                counts.append(count)
+                errors.append(profile['ip_topk'].errors.get(ip, 0))
+            offsets[row + 1] = len(ips)
+            bloom = profile['ip_bloom']
+            blooms.append(bloom.bits if bloom is not None else None)
+            if bloom is not None:
+                bloom_bytes = len(bloom.bits)
+
+        bloom_bits = np.zeros((n_users, bloom_bytes), dtype=np.uint8)
+        for row, bits in enumerate(blooms):
+            if bits is not None and len(bits) == bloom_bytes:
+                bloom_bits[row] = bits
+
+        arrays = {
+            'profile_users': np.array(users, dtype=str) if users else np.zeros(0, dtype='U1'),
+            'profile_total': total,
+            'profile_last_seen': last_seen,
+            'profile_topk_offsets': offsets,
+            'profile_topk_ips': np.array(ips, dtype=str) if ips else np.zeros(0, dtype='U1'),
+            'profile_topk_counts': np.array(counts, dtype=np.float64),
+            'profile_topk_errors': np.array(errors, dtype=np.float64),
+            'profile_topk_capacity': np.array(detector.config['ip_topk_size']),
+            'profile_bloom_bits': bloom_bits,
+        }
+        for name, array in arrays.items():
+            np.save(directory / f"{name}.npy", array, allow_pickle=False)
+        return [f"{name}.npy" for name in arrays]
+
+    # ------------------------------------------------------------------
+    # Lettura
+    # ------------------------------------------------------------------
+
+    def load(self, detector, version: str = None) -> str:
+        """Apre (mmap) una versione e la installa nel detector.
+
+        Returns:
+            La versione caricata
+        """
+        state = self.open(detector, version)
+        detector.install_state(state)
+        return state['version']
+
+    def open(self, detector, version: str = None) -> Dict[str, Any]:
+        """Apre una versione senza modificare il detector (usato anche per
+        preparare uno scambio a caldo). Solleva ValueError se la versione
+        non è compatibile con lo schema feature corrente."""
+        directory = self.versions_dir / version if version else self.current_dir()
+        if directory is None or not directory.exists():
+            raise FileNotFoundError(f"Nessuna versione disponibile in {self.root}")
+
+        with open(directory / 'manifest.json') as f:
+            manifest = json.load(f)
+
+        if manifest.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Formato registro non supportato: {manifest.get('format_version')}")
+        expected = feature_schema_hash(detector.FEATURE_NAMES)
+        if manifest['feature_schema_hash'] != expected:
+            raise ValueError(f"Schema feature incompatibile ({manifest['feature_schema_hash']} != {expected})")
+
+        self._lease([manifest['version']] + ([detector.model_version] if detector.model_version else []))
+
+        with open(directory / 'state.pkl', 'rb') as f:
+            state = pickle.load(f)
+
+        if manifest['forest'] is not None:
+            arrays = {name: _load_array(directory, f"forest_{name}") for name in FlatForest.ARRAY_NAMES}
+            model = FlatForest(**arrays, max_depth=manifest['forest']['max_depth'],
+                               denominator=manifest['forest']['denominator'],
+                               offset=manifest['forest']['offset'])
+        elif manifest.get('model_type') == 'sklearn':
+            model = state['sklearn_model']
+        else:
+            # 'online' (o versione precedente a model_type)
+            model = state['online_model']
+
+        scaler = StandardScaler()
+        if (directory / 'scaler_mean.npy').exists():
+            scaler.mean_ = _load_array(directory, 'scaler_mean')
+            scaler.scale_ = _load_array(directory, 'scaler_scale')
+            scaler.var_ = np.square(scaler.scale_)
+            scaler.n_features_in_ = len(scaler.mean_)
+            scaler.n_samples_seen_ = 0
+        if hasattr(model, 'scaler'):
+            scaler = model.scaler
+
+        half_life, min_events = _load_array(directory, 'baseline_params', None)
+        baselines = HourOfWeekBaseline(half_life_hours=half_life, min_events=min_events)
+        users = _load_array(directory, 'baseline_users')
+        baselines.user_index = {user: row for row, user in enumerate(users.tolist())}
+        # Copy-on-write: gli aggiornamenti incrementali non toccano il file
+        baselines.hist = _load_array(directory, 'baseline_hist', 'c')
+        baselines.last_update = _load_array(directory, 'baseline_last_update', 'c')
+
+        segments = state['segments']
+        if segments is not None and (directory / 'segments').exists():
+            segments.segment_dir = directory / 'segments'
+
+        profiles = LazyUserProfiles(directory, detector.config['ip_bloom_hashes'])
+        drift = state['drift']
+        correlation = state.get('correlation')
+
+        # Aggiornamenti incrementali successivi alla pubblicazione
+        live = self.read_live_state(manifest['version'])
+        if live is not None:
+            profiles.loaded.update(live['user_profiles'])
+            baselines = live['baselines']
+            drift = live['drift']
+            correlation = live['correlation']
+            if live.get('online_model') is not None:
+                model = live['online_model']
+                scaler = model.scaler
+
+        return {
+            'version': manifest['version'],
+            'manifest': manifest,
+            'model': model,
+            'scaler': scaler,
+            'user_profiles': profiles,
+            'baselines': baselines,
+            'segments': segments,
+            'feature_names': state['feature_names'],
+            'drift': drift,
+            'correlation': correlation,
+        }
@@ -0,0 +1,205 @@
+"""
+Costruzione incrementale e limitata del report delle anomalie
+"""
+import heapq
+import itertools
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+LOG = logging.getLogger(__name__)
+
+
+class ReportBuilder:
+    """Report a dimensione fissa costruito consumando batch di anomalie.
+
+    Per ogni batch gli aggregati per utente e per IP sono calcolati con
+    groupby vettoriali e fusi con quelli dei batch precedenti (memoria
+    proporzionale alle chiavi distinte, non agli eventi). In build() solo
+    i primi N utenti/IP per score medio diventano dizionari, scelti con
+    heapq.nsmallest in O(m log N); le raccomandazioni restano in un heap
+    di al più `max_recommendations` voci per (azione, target). Quanto
+    escluso è contato in report['omitted'].
+    """
+
+    def __init__(self, max_users: int = 20, max_ips: int = 20,
+                 max_recommendations: int = 10, max_anomalies: int = 5):
+        self.max_users = int(max_users)
+        self.max_ips = int(max_ips)
+        self.max_recommendations = int(max_recommendations)
+        self.max_anomalies = int(max_anomalies)
+
+        self.total_events = 0
+        self.anomaly_count = 0
+        self.suppressed_recommendations = 0
+        self.omitted_recommendations = 0
+
+        # Aggregati parziali: somma/conteggio degli score, fallimenti e
+        # coppie (utente, IP) distinte per i conteggi nunique
+        self._users: Optional[pd.DataFrame] = None
+        self._ips: Optional[pd.DataFrame] = None
+        self._user_ips: Optional[pd.DataFrame] = None
+        self._ip_users: Optional[pd.DataFrame] = None
+
+        # Min-heap delle raccomandazioni: (score, seq, chiave); le voci
+        # superate da uno score più alto per la stessa chiave restano
+        # nell'heap e sono scartate quando emergono
+        self._recommendations: Dict[Tuple[str, str], Tuple[float, int, Dict[str, Any]]] = {}
+        self._heap: List[Tuple[float, int, Tuple[str, str]]] = []
+        self._seq = itertools.count()
+
+        self._anomalies: List[Tuple[float, int, Dict[str, Any]]] = []
+
+    @staticmethod
+    def _merge(current: Optional[pd.DataFrame], partial: pd.DataFrame) -> pd.DataFrame:
+        if current is None:
+            return partial
+        return pd.concat([current, partial]).groupby(level=0, sort=False).sum()
+
+    @staticmethod
+    def _merge_pairs(current: Optional[pd.DataFrame], partial: pd.DataFrame) -> pd.DataFrame:
+        if current is None:
+            return partial
+        return pd.concat([current, partial], ignore_index=True).drop_duplicates()
+
+    def add_events(self, batch: pd.DataFrame):
+        """Aggiorna contatori e aggregati per utente/IP con un batch"""
+        if len(batch) == 0:
+            return
+        is_anomaly = batch['is_anomaly'].to_numpy(dtype=bool)
+        self.total_events += len(batch)
+        self.anomaly_count += int(is_anomaly.sum())
+
+        scores = batch['anomaly_score'].astype(float)
+        failed = ~batch['success'].astype(bool)
+
+        # Utenti ad alto rischio: solo eventi anomali
+        anomalous = batch[is_anomaly]
+        if len(anomalous):
+            users = pd.DataFrame({
+                'score_sum': scores[is_anomaly].to_numpy(),
+                'count': 1,
+            }, index=anomalous['user'].to_numpy()).groupby(level=0, sort=False).sum()
+            self._users = self._merge(self._users, users)
+            self._user_ips = self._merge_pairs(
+                self._user_ips, anomalous[['user', 'ip']].drop_duplicates())
+
+        # IP sospetti: tutti gli eventi del batch
+        ips = pd.DataFrame({
+            'score_sum': scores.to_numpy(),
+            'count': 1,
+            'failed': failed.to_numpy(dtype=np.int64),
+        }, index=batch['ip'].to_numpy()).groupby(level=0, sort=False).sum()
+        self._ips = self._merge(self._ips, ips)
+        self._ip_users = self._merge_pairs(self._ip_users, batch[['ip', 'user']].drop_duplicates())
+
+    def add_recommendations(self, recommendations: List[Dict[str, Any]],
+                            groups: Optional[int] = None, suppressed: int = 0):
+        """Offre all'heap le raccomandazioni di un batch.
+
+        `groups` è il numero di gruppi (azione, target) del batch prima del
+        limite: quelli non arrivati fin qui sono contati come omessi (una
+        coppia omessa in più batch è contata una volta per batch).
+        """
+        self.suppressed_recommendations += int(suppressed)
+        if groups is not None:
+            self.omitted_recommendations += max(int(groups) - len(recommendations), 0)
+
+        for rec in recommendations:
+            key = (rec['action'], str(rec['target']))
+            score = float(rec['score'])
+            current = self._recommendations.get(key)
+            if current is not None:
+                if score <= current[0]:
+                    continue
+            elif len(self._recommendations) >= self.max_recommendations:
+                floor = self._pop_stale()
+                if floor is None or score <= floor[0]:
+                    self.omitted_recommendations += 1
+                    continue
+                heapq.heappop(self._heap)
+                del self._recommendations[floor[2]]
+                self.omitted_recommendations += 1
+
+            seq = next(self._seq)
+            self._recommendations[key] = (score, seq, rec)
+            heapq.heappush(self._heap, (score, seq, key))
+
+    def _pop_stale(self) -> Optional[Tuple[float, int, Tuple[str, str]]]:
+        """Scarta le voci superate in cima all'heap e restituisce la minima valida"""
+        while self._heap:
+            score, seq, key = self._heap[0]
+            current = self._recommendations.get(key)
+            if current is not None and current[1] == seq:
+                return self._heap[0]
+            heapq.heappop(self._heap)
+        return None
+
+    def add_explanations(self, explanations: List[Dict[str, Any]]):
+        """Tiene le `max_anomalies` spiegazioni con score più basso"""
+        for explanation in explanations:
+            item = (-float(explanation['anomaly_score']), next(self._seq), explanation)
+            if len(self._anomalies) < self.max_anomalies:
+                heapq.heappush(self._anomalies, item)
+            elif item[0] > self._anomalies[0][0]:
+                heapq.heapreplace(self._anomalies, item)
+
+    @staticmethod
+    def _top(aggregates: Optional[pd.DataFrame], limit: int) -> List[Tuple[float, Any]]:
+        """Le `limit` chiavi con score medio più basso (più anomale)"""
+        if aggregates is None or len(aggregates) == 0:
+            return []
+        means = (aggregates['score_sum'] / aggregates['count']).to_numpy()
+        return heapq.nsmallest(limit, zip(means, aggregates.index), key=lambda item: item[0])
+
+    def build(self) -> Dict[str, Any]:
+        """Report con al più N utenti, IP e raccomandazioni"""
+        if self.total_events == 0 and not self._recommendations:
+            return {"status": "clean", "message": "Nessuna anomalia rilevata"}
+
+        report = {
+            "timestamp": datetime.now().isoformat(),
+            "total_events": self.total_events,
+            "anomaly_count": self.anomaly_count,
+            "high_risk_users": [],
+            "suspicious_ips": [],
+            "recommendations": [],
+            "suppressed_recommendations": self.suppressed_recommendations,
+        }
+
+        top_users = self._top(self._users, self.max_users)
+        if top_users:
+            unique_ips = self._user_ips['user'].value_counts()
+            report['high_risk_users'] = [{
+                'user': user,
+                'avg_risk_score': float(score),
+                'unique_ips': int(unique_ips.get(user, 0))
+            } for score, user in top_users]
+
+        top_ips = self._top(self._ips, self.max_ips)
+        if top_ips:
+            unique_users = self._ip_users['ip'].value_counts()
+            failed = self._ips['failed']
+            report['suspicious_ips'] = [{
+                'ip': ip,
+                'avg_risk_score': float(score),
+                'unique_users': int(unique_users.get(ip, 0)),
+                'failed_attempts': int(failed[ip])
+            } for score, ip in top_ips]
+
+        live = sorted(self._recommendations.values(), key=lambda item: (-item[0], item[1]))
+        report['recommendations'] = [rec for _, _, rec in live]
+
+        if self._anomalies:
+            report['top_anomalies'] = [explanation for _, _, explanation in
+                                       sorted(self._anomalies, key=lambda item: (-item[0], item[1]))]
+
+        report['omitted'] = {
+            'high_risk_users': max(len(self._users if self._users is not None else ()) - len(top_users), 0),
+            'suspicious_ips': max(len(self._ips if self._ips is not None else ()) - len(top_ips), 0),
+            'recommendations': self.omitted_recommendations,
+        }
+        return report
@@ -0,0 +1,216 @@
+"""
+Aggregati orari per utente e per IP (report giornalieri e settimanali)
+"""
+import heapq
+import logging
+import os
+import pickle
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .sketches import hash_values, hll_ranks, hll_estimate
+
+LOG = logging.getLogger(__name__)
+
+HOUR_NS = 3600 * 10 ** 9
+
+# Colonne sommate, e quelle combinate con min/max, tra batch e tra ore
+SUM_COLUMNS = ['count', 'failures', 'anomalies', 'score_sum']
+MIN_COLUMNS = ['score_min']
+MAX_COLUMNS = ['score_max']
+
+
+class HourBucket:
+    """Aggregati di un'ora per le chiavi di una dimensione: un DataFrame
+    indicizzato per chiave e una matrice di registri HyperLogLog (una riga
+    per chiave) per i valori distinti dell'altra dimensione"""
+
+    __slots__ = ('stats', 'registers')
+
+    def __init__(self, precision: int):
+        self.stats = pd.DataFrame(columns=SUM_COLUMNS + MIN_COLUMNS + MAX_COLUMNS, dtype=np.float64)
+        self.registers = np.zeros((0, 1 << precision), dtype=np.uint8)
+
+    def add(self, partial: pd.DataFrame, rows: np.ndarray, index: np.ndarray, rank: np.ndarray):
+        """Fonde gli aggregati di un batch; rows[i] è la posizione in
+        `partial` della chiave della coppia i da inserire nello sketch"""
+        new_keys = partial.index.difference(self.stats.index, sort=False)
+        if len(new_keys):
+            added = pd.DataFrame(np.nan, index=new_keys, columns=self.stats.columns)
+            self.stats = pd.concat([self.stats, added]) if len(self.stats) else added
+            self.registers = np.vstack([self.registers, np.zeros(
+                (len(new_keys), self.registers.shape[1]), dtype=np.uint8)])
+
+        positions = self.stats.index.get_indexer(partial.index)
+        current = self.stats.iloc[positions]
+        merged = pd.DataFrame(index=partial.index)
+        for column in SUM_COLUMNS:
+            merged[column] = current[column].fillna(0).to_numpy() + partial[column].to_numpy()
+        for column in MIN_COLUMNS:
+            merged[column] = np.fmin(current[column].to_numpy(), partial[column].to_numpy())
+        for column in MAX_COLUMNS:
+            merged[column] = np.fmax(current[column].to_numpy(), partial[column].to_numpy())
+        self.stats.iloc[positions] = merged.to_numpy()
+
+        np.maximum.at(self.registers, (positions[rows], index), rank)
+
+
+class HourlyRollups:
+    """Rollup orari per utente e per IP aggiornati a ogni batch analizzato.
+
+    Per ogni ora e chiave: eventi, fallimenti, anomalie, somma/min/max
+    dello score e uno sketch HyperLogLog dei valori distinti dell'altra
+    dimensione (IP per gli utenti, utenti per gli IP). Un intervallo di
+    tempo si interroga unendo i bucket orari, senza rileggere gli eventi.
+    """
+
+    DIMENSIONS = {'user': 'ip', 'ip': 'user'}
+
+    def __init__(self, path: Optional[str] = None, retention_hours: int = 24 * 35,
+                 precision: int = 6, save_seconds: float = 60):
+        self.path = Path(path) if path else None
+        self.retention_hours = int(retention_hours)
+        self.precision = int(precision)
+        self.save_seconds = float(save_seconds)
+        self.buckets: Dict[str, Dict[int, HourBucket]] = {dimension: {} for dimension in self.DIMENSIONS}
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+        self._dirty = False
+        if self.path is not None and self.path.exists():
+            self.load()
+
+    @property
+    def hours(self) -> List[int]:
+        return sorted(self.buckets['user'])
+
+    def update(self, events: pd.DataFrame):
+        """Aggrega un batch analizzato (richiede anomaly_score e is_anomaly)"""
+        if events.empty:
+            return
+        timestamps = pd.to_datetime(events['timestamp'])
+        with self._lock:
+            hours = np.asarray(timestamps, dtype='datetime64[h]').astype(np.int64)
+            frame = pd.DataFrame({
+                'hour': hours,
+                'count': 1.0,
+                'failures': (~events['success'].astype(bool)).to_numpy(dtype=np.float64),
+                'anomalies': events['is_anomaly'].to_numpy(dtype=np.float64),
+                'score': events['anomaly_score'].to_numpy(dtype=np.float64),
+            })
+            for dimension, other in self.DIMENSIONS.items():
+                frame['key'] = events[dimension].astype(str).to_numpy()
+                index, rank = hll_ranks(hash_values(events[other].astype(str).to_numpy()), self.precision)
+                for hour, group in frame.groupby('hour', sort=True):
+                    partial = group.groupby('key', sort=False).agg(
+                        count=('count', 'sum'), failures=('failures', 'sum'),
+                        anomalies=('anomalies', 'sum'), score_sum=('score', 'sum'),
+                        score_min=('score', 'min'), score_max=('score', 'max'))
+                    rows = partial.index.get_indexer(group['key'])
+                    positions = group.index.to_numpy()
+                    bucket = self.buckets[dimension].get(hour)
+                    if bucket is None:
+                        bucket = self.buckets[dimension][hour] = HourBucket(self.precision)
+                    bucket.add(partial, rows, index[positions], rank[positions])
+
+            self._prune()
+            self._dirty = True
+
+    def _prune(self):
+        hours = self.hours
+        if not hours:
+            return
+        oldest = hours[-1] - self.retention_hours + 1
+        for dimension in self.DIMENSIONS:
+            for hour in [hour for hour in self.buckets[dimension] if hour < oldest]:
+                del self.buckets[dimension][hour]
+
+    @staticmethod
+    def _hour(value) -> int:
+        return int(pd.Timestamp(value).value // HOUR_NS)
+
+    def query(self, dimension: str, start=None, end=None) -> pd.DataFrame:
+        """Aggregati per chiave nelle ore di [start, end), unendo i bucket.
+
+        Returns:
+            DataFrame indicizzato per chiave con count, failures, anomalies,
+            avg_score, score_min, score_max e distinct (valori distinti
+            stimati dell'altra dimensione)
+        """
+        first = self._hour(start) if start is not None else None
+        last = self._hour(end) if end is not None else None
+        with self._lock:
+            selected = [bucket for hour, bucket in self.buckets[dimension].items()
+                        if (first is None or hour >= first) and (last is None or hour < last)]
+            if not selected:
+                return pd.DataFrame(columns=['count', 'failures', 'anomalies', 'avg_score',
+                                             'score_min', 'score_max', 'distinct'])
+            stats = pd.concat([bucket.stats for bucket in selected])
+            registers = np.concatenate([bucket.registers for bucket in selected])
+
+        codes, keys = pd.factorize(stats.index)
+        grouped = stats.groupby(codes, sort=False)
+        result = grouped[SUM_COLUMNS].sum()
+        result[MIN_COLUMNS] = grouped[MIN_COLUMNS].min()
+        result[MAX_COLUMNS] = grouped[MAX_COLUMNS].max()
+
+        # Unione degli sketch per chiave: massimo dei registri sui gruppi contigui
+        order = np.argsort(codes, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+        union = np.maximum.reduceat(registers[order], starts, axis=0)
+        result = result.sort_index()
+        result.index = keys
+        result['avg_score'] = result['score_sum'] / result['count']
+        result['distinct'] = np.round(hll_estimate(union))
+        return result.drop(columns='score_sum')[
+            ['count', 'failures', 'anomalies', 'avg_score', 'score_min', 'score_max', 'distinct']]
+
+    def top(self, dimension: str, by: str = 'failures', n: int = 10,
+            start=None, end=None) -> List[Dict[str, Any]]:
+        """Le `n` chiavi con il valore più alto di `by` nell'intervallo"""
+        stats = self.query(dimension, start, end)
+        ranked: List[Tuple[float, int]] = heapq.nlargest(
+            n, zip(stats[by].to_numpy(), range(len(stats))), key=lambda item: item[0])
+        rows = stats.iloc[[position for value, position in ranked if value > 0]]
+        return [{
+            dimension: key,
+            'events': int(row['count']),
+            'failures': int(row['failures']),
+            'anomalies': int(row['anomalies']),
+            'avg_score': round(float(row['avg_score']), 4),
+            'min_score': round(float(row['score_min']), 4),
+            f"distinct_{self.DIMENSIONS[dimension]}s": int(row['distinct']),
+        } for key, row in zip(rows.index, rows.to_dict('records'))]
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            LOG.warning(f"Rollup orari non leggibili ({self.path}): {e}")
+            return
+        with self._lock:
+            self.buckets = state['buckets']
+            self._prune()
+        LOG.debug(f"Caricate {len(self.hours)} ore di rollup da {self.path}")
+
+    def save(self, force: bool = False):
+        """Scrive i rollup se cambiati, al più ogni save_seconds secondi"""
+        if self.path is None or not self._dirty:
+            return
+        if not force and time.time() - self._last_save < self.save_seconds:
+            return
+        with self._lock:
+            payload = pickle.dumps({'buckets': self.buckets}, protocol=pickle.HIGHEST_PROTOCOL)
+            self._dirty = False
+            self._last_save = time.time()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,98 @@
+"""
+Campionamento a memoria limitata per l'addestramento su storico
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .baselines import hour_of_week
+
+LOG = logging.getLogger(__name__)
+
+
+def strata_keys(df: pd.DataFrame) -> np.ndarray:
+    """Chiave di strato (utente, ora-della-settimana, esito) per ogni evento"""
+    strata = pd.DataFrame({
+        'user': df['user'].to_numpy(),
+        'how': hour_of_week(df),
+        'failed': (df['event_type'] == 'auth_failed').to_numpy()
+    })
+    return pd.util.hash_pandas_object(strata, index=False).to_numpy()
+
+
+class StratifiedReservoir:
+    """Reservoir sampling stratificato con budget fisso di righe.
+
+    Ogni riga riceve una chiave casuale uniforme; per ogni strato si
+    tengono le righe con le chiavi più piccole, che sono un campione
+    uniforme dello strato visto finora. Finché il totale sta nel budget
+    non si scarta nulla; oltre, ogni strato è limitato a
+    max_rows // n_strati righe, così utenti rari, ore insolite e
+    fallimenti restano rappresentati accanto ai login di routine.
+    """
+
+    def __init__(self, max_rows: int = 200000, random_state: int = 42):
+        self.max_rows = int(max_rows)
+        self.rng = np.random.default_rng(random_state)
+        self.rows = None
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.priorities = np.zeros(0, dtype=np.float64)
+        self.labels = np.zeros(0, dtype=object)
+        self.seen = 0
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def n_strata(self) -> int:
+        return len(np.unique(self.keys))
+
+    def add(self, rows: np.ndarray, keys: np.ndarray, labels: np.ndarray = None):
+        """Offre un blocco di righe (n x d) con le rispettive chiavi di strato
+        ed eventuali etichette (es. utente) da conservare insieme alle righe"""
+        rows = np.asarray(rows, dtype=np.float64)
+        if len(rows) == 0:
+            return
+
+        self.seen += len(rows)
+        priorities = self.rng.random(len(rows))
+
+        if self.rows is None:
+            self.rows = np.empty((0, rows.shape[1]), dtype=np.float64)
+
+        all_rows = np.vstack([self.rows, rows])
+        all_keys = np.concatenate([self.keys, np.asarray(keys, dtype=np.uint64)])
+        all_priorities = np.concatenate([self.priorities, priorities])
+        if labels is None:
+            labels = np.full(len(rows), None, dtype=object)
+        all_labels = np.concatenate([self.labels, np.asarray(labels, dtype=object)])
+
+        if len(all_keys) > self.max_rows:
+            # Rango della riga nel proprio strato per priorità crescente
+            order = np.lexsort((all_priorities, all_keys))
+            sorted_keys = all_keys[order]
+            starts = np.r_[0, np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1]
+            group_sizes = np.diff(np.r_[starts, len(sorted_keys)])
+            rank = np.arange(len(order)) - np.repeat(starts, group_sizes)
+
+            per_stratum = max(1, self.max_rows // len(starts))
+            keep = order[rank < per_stratum]
+
+            # Troppi strati anche con una riga ciascuno: taglio uniforme globale
+            if len(keep) > self.max_rows:
+                keep = keep[np.argsort(all_priorities[keep])[:self.max_rows]]
+
+            all_rows = all_rows[keep]
+            all_keys = all_keys[keep]
+            all_priorities = all_priorities[keep]
+            all_labels = all_labels[keep]
+
+        self.rows, self.keys, self.priorities = all_rows, all_keys, all_priorities
+        self.labels = all_labels
+
+    def sample(self) -> np.ndarray:
+        """Righe campionate (n x d)"""
+        if self.rows is None:
+            return np.empty((0, 0), dtype=np.float64)
+        return self.rows
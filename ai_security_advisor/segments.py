@@ -0,0 +1,247 @@
+"""
+Modelli segmentati per coorte (dominio, ruolo o cluster di profili)
+"""
+import hashlib
+import logging
+import os
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+from sklearn.ensemble import IsolationForest
+
+from .flat_forest import FlatForest
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_COHORT = 'default'
+
+
+def _fit_segment(args: Tuple[str, np.ndarray, Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
+    """Addestra il modello di una coorte (eseguito in un processo separato)"""
+    cohort, features, params = args
+    mean = features.mean(axis=0)
+    scale = features.std(axis=0)
+    scale[scale == 0] = 1.0
+
+    model = IsolationForest(
+        n_estimators=params['n_estimators'],
+        contamination=params['contamination'],
+        max_samples=min(params['max_samples'], len(features)),
+        max_features=params['max_features'],
+        random_state=params['random_state'],
+    )
+    model.fit((features - mean) / scale)
+
+    return cohort, {
+        'mean': mean,
+        'scale': scale,
+        'forest': FlatForest.from_isolation_forest(model),
+        'n_rows': len(features),
+    }
+
+
+class CohortAssigner:
+    """Assegna ogni utente a una coorte.
+
+    Modi supportati:
+        domain  - parte dopo '@' nel nome utente ('default' se assente)
+        role    - 'service' / 'admin' / 'human' da liste in configurazione
+        cluster - KMeans su feature di profilo (volume, IP, ore notturne)
+    """
+
+    def __init__(self, mode: str = 'role', service_users: List[str] = None,
+                 admin_users: List[str] = None, n_clusters: int = 8):
+        self.mode = mode
+        self.service_users = set(service_users or [])
+        self.admin_users = set(admin_users or [])
+        self.n_clusters = int(n_clusters)
+        self.kmeans = None
+        self.cluster_scale = None
+
+    @staticmethod
+    def profile_vectors(users: np.ndarray, user_profiles: Dict[str, Dict],
+                        baselines) -> np.ndarray:
+        """Vettori di profilo per il clustering (n_utenti x 4)"""
+        vectors = np.zeros((len(users), 4), dtype=np.float64)
+        for row, user in enumerate(users):
+            profile = user_profiles.get(user) or {}
+            hist = baselines.user_histogram(user).reshape(7, 24)
+            topk = profile.get('ip_topk')
+            vectors[row] = (
+                np.log1p(profile.get('total_events', 0)),
+                len(topk) if topk is not None else 0,
+                hist[:, :6].sum(),  # quota di attività notturna (00-06)
+                hist[5:].sum(),  # quota di attività nel weekend
+            )
+        return vectors
+
+    def fit(self, user_profiles: Dict[str, Dict], baselines):
+        """Adatta il clustering sui profili (solo per mode='cluster')"""
+        if self.mode != 'cluster' or not user_profiles:
+            return self
+
+        users = np.asarray(list(user_profiles), dtype=object)
+        vectors = self.profile_vectors(users, user_profiles, baselines)
+        self.cluster_scale = vectors.std(axis=0)
+        self.cluster_scale[self.cluster_scale == 0] = 1.0
+
+        n_clusters = min(self.n_clusters, len(users))
+        self.kmeans = KMeans(n_clusters=n_clusters, n_init=4, random_state=42)
+        self.kmeans.fit(vectors / self.cluster_scale)
+        return self
+
+    def assign(self, users: pd.Series, user_profiles: Dict[str, Dict] = None,
+               baselines=None) -> np.ndarray:
+        """Coorte di ogni evento (array di stringhe)"""
+        codes, uniques = pd.factorize(users)
+        uniques = np.asarray(uniques, dtype=object)
+
+        if self.mode == 'domain':
+            labels = np.array([user.split('@', 1)[1] if '@' in user else DEFAULT_COHORT
+                               for user in uniques], dtype=object)
+        elif self.mode == 'role':
+            labels = np.array(['service' if user in self.service_users else
+                               'admin' if user in self.admin_users else 'human'
+                               for user in uniques], dtype=object)
+        elif self.mode == 'cluster' and self.kmeans is not None:
+            known = np.array([user in user_profiles for user in uniques], dtype=bool)
+            labels = np.full(len(uniques), DEFAULT_COHORT, dtype=object)
+            if known.any():
+                vectors = self.profile_vectors(uniques[known], user_profiles, baselines)
+                clusters = self.kmeans.predict(vectors / self.cluster_scale)
+                labels[known] = [f"cluster_{c}" for c in clusters]
+        else:
+            labels = np.full(len(uniques), DEFAULT_COHORT, dtype=object)
+
+        return labels[codes]
+
+
+class SegmentModelCache:
+    """Cache LRU dei modelli di coorte con budget di memoria in byte.
+
+    La dimensione di ogni modello è stimata dalla dimensione del file su
+    disco; quando il budget è superato si scaricano i meno usati.
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = int(budget_bytes)
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, path: Path, size: int) -> Dict[str, Any]:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+        self.misses += 1
+        with open(path, 'rb') as f:
+            segment = pickle.load(f)
+
+        self.entries[key] = (segment, size)
+        self.used_bytes += size
+        while self.used_bytes > self.budget_bytes and len(self.entries) > 1:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.used_bytes -= evicted_size
+        return segment
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+
+class SegmentedDetector:
+    """Un modello IsolationForest leggero per ogni coorte.
+
+    I modelli sono addestrati in parallelo (pool di processi), salvati
+    su disco uno per file e caricati pigramente tramite una cache LRU,
+    così migliaia di segmenti non stanno tutti in RAM. Le coorti senza
+    abbastanza dati ricadono sul modello globale.
+    """
+
+    def __init__(self, assigner: CohortAssigner, segment_dir: str,
+                 cache_mb: float = 256, min_rows: int = 200, workers: int = 0,
+                 model_params: Dict[str, Any] = None):
+        self.assigner = assigner
+        self.segment_dir = Path(segment_dir)
+        self.min_rows = int(min_rows)
+        self.workers = int(workers) or (os.cpu_count() or 1)
+        self.model_params = {
+            'n_estimators': 25,
+            'contamination': 0.01,
+            'max_samples': 128,
+            'max_features': 0.5,
+            'random_state': 42,
+        }
+        self.model_params.update(model_params or {})
+        self.index: Dict[str, Tuple[str, int]] = {}  # coorte -> (file, byte)
+        self.cache = SegmentModelCache(int(cache_mb * 1024 * 1024))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = SegmentModelCache(self.cache.budget_bytes)
+        return state
+
+    def _segment_path(self, cohort: str) -> Path:
+        digest = hashlib.sha1(cohort.encode('utf-8')).hexdigest()[:16]
+        return self.segment_dir / f"segment_{digest}.pkl"
+
+    def fit(self, features: np.ndarray, cohorts: np.ndarray) -> int:
+        """Addestra i modelli di coorte; restituisce quanti ne sono stati creati"""
+        self.segment_dir.mkdir(parents=True, exist_ok=True)
+        self.index = {}
+        self.cache.clear()
+
+        labels, counts = np.unique(cohorts.astype(str), return_counts=True)
+        jobs = [(str(cohort), features[cohorts == cohort], self.model_params)
+                for cohort, count in zip(labels, counts) if count >= self.min_rows]
+        if not jobs:
+            LOG.info("Nessuna coorte con dati sufficienti per un modello dedicato")
+            return 0
+
+        if self.workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as pool:
+                results = list(pool.map(_fit_segment, jobs))
+        else:
+            results = [_fit_segment(job) for job in jobs]
+
+        for cohort, segment in results:
+            path = self._segment_path(cohort)
+            with open(path, 'wb') as f:
+                pickle.dump(segment, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.index[cohort] = (path.name, path.stat().st_size)
+
+        LOG.info(f"Addestrati {len(self.index)} modelli di coorte "
+                 f"({len(labels) - len(self.index)} coorti sul modello globale)")
+        return len(self.index)
+
+    def score(self, features: np.ndarray, cohorts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Score (decision_function) per le righe con un modello di coorte.
+
+        Returns:
+            (score, scored): scored indica le righe valutate da un segmento;
+            le altre vanno valutate con il modello globale
+        """
+        scores = np.zeros(len(features), dtype=np.float64)
+        scored = np.zeros(len(features), dtype=bool)
+
+        for cohort in np.unique(cohorts.astype(str)):
+            if cohort not in self.index:
+                continue
+            file_name, size = self.index[cohort]
+            segment = self.cache.get(cohort, self.segment_dir / file_name, size)
+
+            mask = cohorts == cohort
+            scaled = (features[mask] - segment['mean']) / segment['scale']
+            scores[mask] = segment['forest'].decision_function(scaled)
+            scored |= mask
+
+        return scores, scored
@@ -0,0 +1,257 @@
+"""
+Servizio di scoring residente (HTTP su localhost o socket Unix)
+
+Mantiene caricati AnomalyDetector e PolicyAdvisor: ogni richiesta paga
+solo il parsing JSON e lo scoring, non l'avvio dell'interprete, gli import
+di pandas/sklearn e il caricamento del modello.
+
+Endpoint:
+    POST /score    corpo JSON (lista di eventi) oppure NDJSON (un evento
+                   per riga); un evento è una riga di log grezza (stringa)
+                   o un dizionario con timestamp, user, ip, event_type
+    GET  /health   versione del modello e contatori del servizio
+"""
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .client import DEFAULT_ADDRESS
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_address(address: str) -> Tuple[str, Any]:
+    """'unix:/percorso' -> ('unix', percorso); 'host:porta' -> ('tcp', (host, porta))"""
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+def json_default(value):
+    """Serializzazione JSON di scalari NumPy e timestamp"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class MicroBatcher:
+    """Raggruppa le richieste che arrivano ravvicinate in un solo batch.
+
+    Un unico thread consuma la coda: attende la prima richiesta, poi
+    raccoglie le successive per al più `window_ms` millisecondi (o fino a
+    `max_events` eventi), chiama `process(frame)` una sola volta sul batch
+    concatenato e restituisce a ogni richiesta la propria porzione di
+    righe. Se indicato, `finish(porzione)` costruisce sullo stesso thread
+    la risposta di ogni richiesta: detector e advisor sono quindi usati da
+    un solo thread alla volta.
+    """
+
+    def __init__(self, process, window_ms: float = 20, max_events: int = 5000,
+                 finish=None):
+        self.process = process
+        self.finish = finish
+        self.window = float(window_ms) / 1000.0
+        self.max_events = int(max_events)
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.requests = 0
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, frame: pd.DataFrame) -> Future:
+        future = Future()
+        self.queue.put((frame, future))
+        return future
+
+    def _collect(self) -> List[Tuple[pd.DataFrame, Future]]:
+        pending = [self.queue.get()]
+        n_events = len(pending[0][0])
+        deadline = time.monotonic() + self.window
+        while n_events < self.max_events:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            n_events += len(item[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            frames = [frame for frame, _ in pending]
+            try:
+                result = self.process(pd.concat(frames, ignore_index=True))
+            except Exception as e:
+                LOG.error(f"Errore nello scoring del batch: {e}")
+                import traceback
+                LOG.error(traceback.format_exc())
+                for _, future in pending:
+                    future.set_exception(e)
+            else:
+                start = 0
+                for frame, future in pending:
+                    part = result.iloc[start:start + len(frame)]
+                    start += len(frame)
+                    self._resolve(future, part)
+
+            self.batches += 1
+            self.requests += len(pending)
+
+    def _resolve(self, future: Future, part: pd.DataFrame):
+        """Risposta di una singola richiesta: un errore qui non tocca le altre"""
+        if self.finish is None:
+            future.set_result(part)
+            return
+        try:
+            future.set_result(self.finish(part))
+        except Exception as e:
+            LOG.error(f"Errore nella risposta di una richiesta: {e}")
+            import traceback
+            LOG.error(traceback.format_exc())
+            future.set_exception(e)
+
+
+class ScoringService:
+    """Detector e advisor residenti dietro a un micro-batcher"""
+
+    def __init__(self, detector, advisor, collector, window_ms: float = 20,
+                 max_batch_events: int = 5000, timeout: float = 60, writer=None):
+        self.detector = detector
+        self.advisor = advisor
+        self.collector = collector
+        self.writer = writer
+        self.timeout = float(timeout)
+        self.started = time.time()
+        # Anche spiegazioni e report girano sul thread del batcher: tra un
+        # batch e l'altro il detector può sostituire il modello o
+        # aggiornare profili e correlazioni
+        self.batcher = MicroBatcher(detector.detect_anomalies, window_ms, max_batch_events,
+                                    finish=self._respond)
+
+    def score(self, records: List[Any]) -> Dict[str, Any]:
+        """Score e raccomandazioni per un elenco di eventi"""
+        events = self.collector.events_from_records(records)
+        if events.empty:
+            return {'events': 0, 'anomaly_count': 0, 'scores': [], 'is_anomaly': [],
+                    'report': {'status': 'clean', 'message': 'Nessun evento valido'}}
+
+        return self.batcher.submit(events).result(self.timeout)
+
+    def _respond(self, analyzed: pd.DataFrame) -> Dict[str, Any]:
+        """Risposta di una richiesta (sul thread del batcher)"""
+        self.advisor.observe(analyzed)
+        if self.writer is not None and 'events' in self.writer.sinks:
+            self.writer.submit('events', analyzed)
+        anomalies = analyzed[analyzed['is_anomaly']]
+        return {
+            'model_version': self.detector.model_version,
+            'events': len(analyzed),
+            'anomaly_count': int(len(anomalies)),
+            'scores': analyzed['anomaly_score'].astype(float).tolist(),
+            'is_anomaly': analyzed['is_anomaly'].astype(bool).tolist(),
+            'report': self.advisor.generate_report(anomalies, explain=self.detector.explain,
+                                                   events=analyzed),
+        }
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            'status': 'ok',
+            'model_version': self.detector.model_version,
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'batches': self.batcher.batches,
+            'requests': self.batcher.requests,
+            'writer': self.writer.stats() if self.writer is not None else None,
+        }
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """Handler HTTP/1.1 del servizio (connessioni riutilizzabili)"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload, default=json_default).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_records(self) -> List[Any]:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        content_type = self.headers.get('Content-Type', '')
+        if 'ndjson' in content_type or not body.lstrip().startswith('['):
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        return json.loads(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, self.server.service.health())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            records = self._read_records()
+        except (ValueError, UnicodeDecodeError) as e:
+            self._send_json(400, {'error': f"corpo non valido: {e}"})
+            return
+        try:
+            self._send_json(200, self.server.service.score(records))
+        except Exception as e:
+            LOG.error(f"Errore nella richiesta di scoring: {e}")
+            self._send_json(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        # Sul socket Unix client_address è vuoto: niente address_string()
+        LOG.debug(format % args)
+
+
+class LocalHTTPServer(ThreadingHTTPServer):
+    """Server HTTP multi-thread su localhost"""
+
+    daemon_threads = True
+    request_queue_size = 128  # molti client cron che si connettono insieme
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server HTTP multi-thread su socket Unix"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, 0o660)
+
+
+def make_server(address: str, service: ScoringService):
+    """Crea il server (non avviato) per l'indirizzo indicato"""
+    kind, target = parse_address(address)
+    if kind == 'unix':
+        server = UnixHTTPServer(target, ScoringRequestHandler)
+    else:
+        server = LocalHTTPServer(target, ScoringRequestHandler)
+    server.service = service
+    return server
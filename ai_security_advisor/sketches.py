@@ -0,0 +1,276 @@
+"""
+Strutture dati probabilistiche a memoria limitata
+"""
+import heapq
+import logging
+import math
+from typing import Dict, List, Tuple, Any, Sequence, Optional
+
+import numpy as np
+import pandas as pd
+
+LOG = logging.getLogger(__name__)
+
+
+def hash_values(values: Sequence[Any], seed: int = 0) -> np.ndarray:
+    """Hash vettorizzato a 64 bit (uint64) di una sequenza di valori"""
+    hash_key = f"{seed:016d}"[-16:]
+    return pd.util.hash_array(np.asarray(values, dtype=object), hash_key=hash_key)
+
+
+def ip_prefix24(ips: Sequence[str]) -> np.ndarray:
+    """Prefisso /24 di ciascun IP (gli IP non IPv4 restano invariati)"""
+    series = pd.Series(np.asarray(ips, dtype=object), dtype=object).astype(str)
+    prefix = series.str.rsplit('.', n=1).str[0]
+    return np.where(series.str.count(r'\.') == 3, prefix + '.0/24', series).astype(object)
+
+
+class SpaceSaving:
+    """Top-k heavy hitters (algoritmo Space-Saving) con conteggi.
+
+    Mantiene al più `capacity` elementi: quando è pieno, il nuovo elemento
+    sostituisce quello col conteggio minimo ereditandone il conteggio
+    (registrato come errore massimo della stima).
+    """
+
+    __slots__ = ('capacity', 'counts', 'errors')
+
+    def __init__(self, capacity: int = 16):
+        self.capacity = int(capacity)
+        self.counts: Dict[Any, float] = {}
+        self.errors: Dict[Any, float] = {}
+
+    def __contains__(self, item) -> bool:
+        return item in self.counts
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def update(self, item, weight: float = 1):
+        """Aggiunge `weight` occorrenze di `item`"""
+        if item in self.counts:
+            self.counts[item] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = weight
+            self.errors[item] = 0
+        else:
+            victim = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(victim)
+            self.errors.pop(victim, None)
+            self.counts[item] = floor + weight
+            self.errors[item] = floor
+
+    def guaranteed_count(self, item) -> float:
+        """Limite inferiore garantito sul conteggio reale"""
+        return self.counts.get(item, 0) - self.errors.get(item, 0)
+
+    def top(self, n: int = None) -> List[Tuple[Any, float]]:
+        """Elementi ordinati per conteggio decrescente"""
+        ranked = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+        return ranked[:n] if n else ranked
+
+    def merge(self, other: 'SpaceSaving'):
+        """Unisce un altro sketch (stessa capacità) in questo"""
+        for item, count in other.counts.items():
+            self.update(item, count)
+
+
+class BloomFilter:
+    """Filtro di Bloom a dimensione fissa su array di bit numpy"""
+
+    __slots__ = ('n_bits', 'n_hashes', 'bits')
+
+    def __init__(self, n_bits: int = 2048, n_hashes: int = 4):
+        self.n_bits = int(n_bits)
+        self.n_hashes = int(n_hashes)
+        self.bits = np.zeros((self.n_bits + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, keys: Sequence[Any]) -> np.ndarray:
+        """Posizioni dei bit (n_keys x n_hashes) con double hashing"""
+        h1 = hash_values(keys, seed=0)
+        h2 = hash_values(keys, seed=1) | np.uint64(1)
+        steps = np.arange(self.n_hashes, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            combined = h1[:, None] + steps[None, :] * h2[:, None]
+        return (combined % np.uint64(self.n_bits)).astype(np.int64)
+
+    def add(self, keys: Sequence[Any]):
+        """Inserisce un insieme di chiavi"""
+        if len(keys) == 0:
+            return
+        positions = self._positions(keys).ravel()
+        np.bitwise_or.at(self.bits, positions >> 3,
+                         (1 << (positions & 7)).astype(np.uint8))
+
+    def contains(self, keys: Sequence[Any]) -> np.ndarray:
+        """Appartenenza (con falsi positivi) per ciascuna chiave"""
+        return BloomFilter.contains_many([self], np.zeros(len(keys), dtype=np.int64), keys)
+
+    @staticmethod
+    def contains_many(filters: List['BloomFilter'], rows: np.ndarray,
+                      keys: Sequence[Any]) -> np.ndarray:
+        """Interroga in blocco più filtri omogenei: keys[i] su filters[rows[i]]"""
+        if len(keys) == 0:
+            return np.zeros(0, dtype=bool)
+
+        matrix = np.stack([f.bits for f in filters])
+        positions = filters[0]._positions(keys)
+        bytes_ = matrix[rows[:, None], positions >> 3]
+        hits = (bytes_ >> (positions & 7).astype(np.uint8)) & 1
+        return hits.all(axis=1)
+
+
+def hll_ranks(hashes: np.ndarray, precision: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Registro (primi `precision` bit) e rango (posizione del primo bit a 1
+    nei bit restanti) di hash a 64 bit, come in HyperLogLog"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    index = (hashes & np.uint64((1 << precision) - 1)).astype(np.int64)
+    rest = hashes >> np.uint64(precision)
+    width = 64 - precision
+    # frexp dà la lunghezza in bit di `rest` (0 per rest == 0)
+    _, bit_length = np.frexp(rest.astype(np.float64))
+    rank = (width - bit_length + 1).astype(np.uint8)
+    return index, rank
+
+
+def hll_estimate(registers: np.ndarray) -> np.ndarray:
+    """Cardinalità stimata da registri HyperLogLog (sull'ultimo asse), con
+    la correzione linear counting per i valori piccoli"""
+    registers = np.asarray(registers)
+    m = registers.shape[-1]
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+    raw = alpha * m * m / np.exp2(-registers.astype(np.float64)).sum(axis=-1)
+    zeros = (registers == 0).sum(axis=-1)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class HyperLogLog:
+    """Conteggio approssimato degli elementi distinti in 2^precision byte.
+
+    L'errore standard è circa 1.04 / sqrt(2^precision); due sketch con la
+    stessa precisione si uniscono col massimo dei registri.
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision: int = 10):
+        self.precision = int(precision)
+        self.registers = np.zeros(1 << self.precision, dtype=np.uint8)
+
+    def add(self, values: Sequence[Any]):
+        """Inserisce un insieme di valori"""
+        if len(values) == 0:
+            return
+        index, rank = hll_ranks(hash_values(values), self.precision)
+        np.maximum.at(self.registers, index, rank)
+
+    def count(self) -> float:
+        return float(hll_estimate(self.registers))
+
+    def merge(self, other: 'HyperLogLog'):
+        """Unisce un altro sketch (stessa precisione) in questo"""
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+
+class CountMinSketch:
+    """Conteggi approssimati per chiave in memoria fissa (Count-Min Sketch).
+
+    Con width = ceil(e / epsilon) e depth = ceil(ln(1 / delta)) la stima
+    non è mai inferiore al vero e lo supera di al più epsilon * totale con
+    probabilità 1 - delta. Due sketch con le stesse dimensioni si uniscono
+    sommando le tabelle (es. tra worker o tra bucket temporali).
+    """
+
+    __slots__ = ('width', 'depth', 'table', 'total')
+
+    def __init__(self, epsilon: float = 0.001, delta: float = 0.01):
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.table = np.zeros((self.depth, self.width), dtype=np.float64)
+        self.total = 0.0
+
+    @property
+    def epsilon(self) -> float:
+        return math.e / self.width
+
+    @property
+    def error_bound(self) -> float:
+        """Sovrastima massima (con probabilità 1 - delta) di ogni conteggio"""
+        return self.epsilon * self.total
+
+    def _cells(self, keys: Sequence[Any]) -> np.ndarray:
+        return np.stack([(hash_values(keys, seed=101 + row) % np.uint64(self.width)).astype(np.int64)
+                         for row in range(self.depth)])
+
+    def add(self, keys: Sequence[Any], weights: Optional[Sequence[float]] = None):
+        """Aggiunge `weights` (default 1) occorrenze di ciascuna chiave"""
+        if len(keys) == 0:
+            return
+        weights = np.ones(len(keys)) if weights is None else np.asarray(weights, dtype=np.float64)
+        cells = self._cells(keys)
+        for row in range(self.depth):
+            self.table[row] += np.bincount(cells[row], weights, minlength=self.width)
+        self.total += float(weights.sum())
+
+    def query(self, keys: Sequence[Any]) -> np.ndarray:
+        """Conteggio stimato (limite superiore) di ciascuna chiave"""
+        if len(keys) == 0:
+            return np.zeros(0)
+        cells = self._cells(keys)
+        return self.table[np.arange(self.depth)[:, None], cells].min(axis=0)
+
+    def merge(self, other: 'CountMinSketch'):
+        if self.table.shape != other.table.shape:
+            raise ValueError(f"Sketch non compatibili: {self.table.shape} != {other.table.shape}")
+        self.table += other.table
+        self.total += other.total
+
+
+class HeavyHitters:
+    """Chiavi più frequenti stimate con un Count-Min Sketch.
+
+    Lo sketch conta tutte le chiavi; accanto resta solo l'insieme dei
+    `capacity` candidati con la stima più alta, aggiornato a ogni batch
+    con heapq.nlargest sulle chiavi del batch che superano il minimo
+    corrente. Unibile come lo sketch sottostante.
+    """
+
+    __slots__ = ('capacity', 'sketch', 'candidates')
+
+    def __init__(self, capacity: int = 20, epsilon: float = 0.001, delta: float = 0.01):
+        self.capacity = int(capacity)
+        self.sketch = CountMinSketch(epsilon, delta)
+        self.candidates: Dict[Any, float] = {}
+
+    def add(self, keys: Sequence[Any], weights: Optional[Sequence[float]] = None):
+        """Aggiorna lo sketch con un batch (una scrittura per chiave distinta)"""
+        if len(keys) == 0:
+            return
+        codes, uniques = pd.factorize(np.asarray(keys, dtype=object))
+        counts = np.bincount(codes, weights, minlength=len(uniques))
+        self.sketch.add(uniques, counts)
+        self._offer(uniques, self.sketch.query(uniques))
+
+    def _offer(self, keys: np.ndarray, estimates: np.ndarray):
+        current = list(self.candidates)
+        pool = dict(zip(current, self.sketch.query(current).tolist())) if current else {}
+        floor = min(pool.values()) if len(pool) >= self.capacity else -np.inf
+        mask = estimates > floor
+        pool.update(zip(keys[mask].tolist(), estimates[mask].tolist()))
+        self.candidates = dict(heapq.nlargest(self.capacity, pool.items(), key=lambda kv: kv[1]))
+
+    def query(self, keys: Sequence[Any]) -> np.ndarray:
+        return self.sketch.query(keys)
+
+    def top(self, n: int = None) -> List[Tuple[Any, float]]:
+        """Candidati ordinati per stima decrescente"""
+        ranked = sorted(self.candidates.items(), key=lambda kv: kv[1], reverse=True)
+        return ranked[:n] if n else ranked
+
+    def merge(self, other: 'HeavyHitters'):
+        """Unisce un altro sketch (stesse dimensioni) in questo"""
+        self.sketch.merge(other.sketch)
+        keys = np.asarray(list(other.candidates), dtype=object)
+        self._offer(keys, self.sketch.query(keys))
@@ -43,7 +43,7 @@ echo "⚙️  Creazione configurazione..."
 cat > config/devstack_vm.yaml << 'EOF'
 # Configurazione per DevStack su VM
 log_path: "/opt/stack/logs/keystone.log"
-model_path: "models/devstack_vm_model.pkl"
+model_path: "models/devstack_vm"
 
 collector:
   type: "devstack"
@@ -4,59 +4,223 @@ AI Security Advisor - Main entry point
 """
 import argparse
 import datetime
+import json
 import logging
 import sys
 import os
+import signal
+import threading
 from pathlib import Path
-
-import yaml
+from typing import Optional, TYPE_CHECKING
 
 # Aggiungi la directory del progetto al path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from ai_security_advisor.collector import KeystoneLogCollector
-from ai_security_advisor.ai_engine import AnomalyDetector
-from ai_security_advisor.policy_advisor import PolicyAdvisor
+# I moduli pesanti (pandas, numpy, sklearn) sono importati solo dalle fasi
+# che li usano: --help e un'esecuzione senza nuovi eventi restano rapidi
+if TYPE_CHECKING:
+    from ai_security_advisor.ai_engine import AnomalyDetector
 
-# Configurazione logging
+# Configurazione logging (il file di log è aperto solo alla prima scrittura)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('ai_security_advisor.log'),
+        logging.FileHandler('ai_security_advisor.log', delay=True),
         logging.StreamHandler()
     ]
 )
 LOG = logging.getLogger(__name__)
 
+
+def log_signature(log_path: str) -> Optional[dict]:
+    """Dimensione e mtime del file di log (None se non esiste)"""
+    try:
+        stat = os.stat(log_path)
+    except OSError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def log_unchanged(config: dict) -> bool:
+    """True se il log è identico a quello dell'ultima analisi completata"""
+    signature = log_signature(config.get('log_path', '/opt/stack/logs/keystone.log'))
+    state_path = Path(config.get('run_state_path', 'models/run_state.json'))
+    if signature is None or not state_path.exists():
+        return False
+    try:
+        with open(state_path) as f:
+            return json.load(f).get('log') == signature
+    except (OSError, ValueError):
+        return False
+
 class AISecurityAdvisor:
     """Orchestratore principale del sistema"""
 
     def __init__(self, config_path: str = "config/config.yaml"):
+        from ai_security_advisor.collector import KeystoneLogCollector
+        from ai_security_advisor.policy_advisor import PolicyAdvisor
+
         self.config = self.load_config(config_path)
-        self.collector = KeystoneLogCollector(
-            log_path=self.config.get('log_path', '/opt/stack/logs/keystone.log')
-        )
-        self.detector = AnomalyDetector()
+        # Sorgente degli eventi: il log di Keystone o il database degli
+        # eventi già salvati (finestre lette con query per intervallo)
+        self.event_source = (self.config.get('collector') or {}).get('source', 'log')
+        if self.event_source == 'database':
+            from ai_security_advisor.collector_db import DatabaseEventCollector
+
+            self.collector = DatabaseEventCollector(
+                self.config['database_path'],
+                partitioned=self.config.get('database_partitioned', False)
+            )
+        else:
+            self.collector = KeystoneLogCollector(
+                log_path=self.config.get('log_path', '/opt/stack/logs/keystone.log')
+            )
+        self.detector = self._new_detector()
+        self.model_path = self.config.get('model_path', 'models/registry')
+        self.model_loaded = Path(self.model_path).exists() and self.detector.load_model(self.model_path)
+        self._retrain_requested = False
+        self._retrain_thread = None
         self.advisor = PolicyAdvisor(self.config.get('policy', {}))
+        self._event_writer = None
+        self._writer = None
+        self._resident = False  # True nel servizio di scoring (--serve)
+
+    @property
+    def event_writer(self):
+        """Writer SQLite degli eventi analizzati (None se database_path è
+        vuoto): con database_partitioned database_path è una directory con
+        un file per giorno, altrimenti un unico file"""
+        if self._event_writer is None and self.config.get('database_path'):
+            if self.config.get('database_partitioned'):
+                from ai_security_advisor.event_store import EventStore
+
+                self._event_writer = EventStore(
+                    self.config['database_path'],
+                    retention_days=self.config.get('database_retention_days', 30),
+                    raw_line_codec=self.config.get('raw_line_codec')
+                )
+            else:
+                from ai_security_advisor.database import EventWriter
+
+                self._event_writer = EventWriter(self.config['database_path'],
+                                                 raw_line_codec=self.config.get('raw_line_codec'))
+        return self._event_writer
+
+    @property
+    def writer(self):
+        """Writer in background di eventi e report: il loop di rilevamento
+        accoda soltanto, il disco (e i suoi fsync) restano fuori dal
+        percorso critico"""
+        if self._writer is None:
+            from ai_security_advisor.background_writer import BackgroundWriter
+
+            sinks = {'report': self.save_report}
+            if self.event_writer is not None:
+                sinks['events'] = self.event_writer.write_batch
+            writer_config = self.config.get('writer') or {}
+            self._writer = BackgroundWriter(
+                sinks,
+                max_queue=writer_config.get('max_queue', 64),
+                window_ms=writer_config.get('window_ms', 50),
+                max_batch_rows=writer_config.get('max_batch_rows', 100000),
+                spill_dir=writer_config.get('spill_dir', 'models/spill')
+            )
+        return self._writer
+
+    def close(self):
+        """Scrive quanto è ancora in coda e chiude il database"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._event_writer is not None:
+            self._event_writer.close()
+            self._event_writer = None
+
+    def _new_detector(self) -> 'AnomalyDetector':
+        """Crea un detector secondo la sezione ai_engine della configurazione"""
+        from ai_security_advisor.ai_engine import AnomalyDetector
+
+        detector_config = dict(self.config.get('ai_engine') or {})
+        # Gli utenti di servizio in whitelist formano la coorte 'service'
+        detector_config.setdefault('service_users', self.config.get('whitelist', {}).get('users', []))
+        detector = AnomalyDetector(config=detector_config)
+        detector.on_drift = self._on_drift
+        return detector
+
+    def _on_drift(self, report: dict):
+        """Drift sul modello batch: riaddestramento in background, a fine
+        analisi con --once e subito nel servizio residente (che non ha una
+        fine analisi)"""
+        if self.detector.online:
+            return
+        self._retrain_requested = True
+        if self._resident:
+            self._start_background_retrain()
+
+    def _start_background_retrain(self):
+        """Riaddestra un nuovo detector in un thread; con il registro la nuova
+        versione è validata e installata a caldo nel detector in uso, che
+        non viene mai fermato"""
+        if self._retrain_thread is not None and self._retrain_thread.is_alive():
+            return
 
-    def load_config(self, config_path: str) -> dict:
+        from ai_security_advisor.hot_swap import ModelWatcher
+        from ai_security_advisor.registry import is_registry_path
+
+        def retrain():
+            detector = self._new_detector()
+            if not self._train(detector):
+                return
+            if is_registry_path(self.model_path):
+                ModelWatcher(
+                    self.detector, self.model_path,
+                    max_anomaly_rate=self.detector.config['hot_swap_max_anomaly_rate']
+                ).poll(detector.model_version)
+            else:
+                # Il servizio tiene il riferimento al detector: scambio
+                # all'inizio del prossimo batch come per il registro
+                self.detector.stage_state(detector.export_state())
+            self.model_loaded = True
+            LOG.info("Modello riaddestrato dopo drift")
+
+        self._retrain_requested = False
+        self._retrain_thread = threading.Thread(target=retrain, name='drift-retrain')
+        self._retrain_thread.start()
+
+    @staticmethod
+    def load_config(config_path: str) -> dict:
         """Carica configurazione da YAML"""
         default_config = {
             'log_path': '/opt/stack/logs/keystone.log',
-            'model_path': 'models/trained_model.pkl',
+            'model_path': 'models/registry',
             'history_hours': 168,  # 7 giorni
             'update_interval_minutes': 5,
+            'database_path': 'data/events',
+            'database_partitioned': True,
+            'database_retention_days': 30,
+            'raw_line_codec': 'zlib',
             'policy': {
                 'risk_threshold': 0.7,
-                'mfa_threshold': 0.5
+                'mfa_threshold': 0.5,
+                'cooldown_path': 'models/cooldowns.json',
+                'failure_stats_path': 'models/failure_stats.pkl',
+                'rollup_path': 'models/rollups.pkl'
             }
         }
 
         if Path(config_path).exists():
+            import yaml
+
             with open(config_path, 'r') as f:
-                user_config = yaml.safe_load(f)
-                default_config.update(user_config)
+                user_config = yaml.safe_load(f) or {}
+            # Le sezioni annidate (policy) si fondono con i default: una
+            # sezione parziale non perde i percorsi che non ridefinisce
+            for key, value in user_config.items():
+                if isinstance(value, dict) and isinstance(default_config.get(key), dict):
+                    default_config[key] = {**default_config[key], **value}
+                else:
+                    default_config[key] = value
 
         return default_config
 
@@ -64,59 +228,155 @@ class AISecurityAdvisor:
         """Addestra il modello iniziale su dati storici"""
         LOG.info("Addestramento modello iniziale...")
 
-        # Raccogli dati storici
-        historical_data = self.collector.collect_historical_events(
-            hours=self.config['history_hours']
-        )
+        if not self._train(self.detector):
+            LOG.warning("Nessun dato storico disponibile per l'addestramento")
 
-        if len(historical_data) > 0:
-            self.detector.train(historical_data)
+    def _train(self, detector: 'AnomalyDetector') -> bool:
+        """Addestra un detector sullo storico e lo salva"""
+        # Storico letto a blocchi: la memoria è limitata dal campione di training
+        chunks = self.collector.iter_historical_events(
+            hours=self.config['history_hours'],
+            chunk_size=detector.config['training_chunk_size']
+        )
+        if not detector.train_streaming(chunks):
+            return False
 
-            # Salva modello
-            model_path = self.config.get('model_path', 'models/trained_model.pkl')
-            Path(model_path).parent.mkdir(parents=True, exist_ok=True)
-            self.detector.save_model(model_path)
-            LOG.info(f"Modello addestrato su {len(historical_data)} eventi storici")
-        else:
-            LOG.warning("Nessun dato storico disponibile per l'addestramento")
+        # Salva modello
+        Path(self.model_path).parent.mkdir(parents=True, exist_ok=True)
+        detector.save_model(self.model_path)
+        LOG.info(f"Modello addestrato su {len(detector.user_profiles)} profili utente")
+        return True
 
     def run_once(self):
         """Esegue una singola analisi"""
+        import pandas as pd
+
         LOG.info("Avvio analisi...")
 
+        # Firma del log prima della lettura: righe aggiunte durante l'analisi
+        # verranno considerate alla prossima esecuzione
+        signature = log_signature(self.collector.log_path) if self.collector.log_path else None
+        last_event = self._load_run_state().get('last_event')
+
         # Raccogli eventi recenti (ultima ora)
         events = self.collector.collect_historical_events(hours=1)
 
         if len(events) == 0:
             LOG.info("Nessun evento recente trovato")
+            self._save_run_state(signature, last_event)
             return
 
         # Rileva anomalie
         analyzed_events = self.detector.detect_anomalies(events)
 
+        # Persisti baseline utente (e modello online) aggiornati in modo
+        # incrementale: nessuna nuova versione del registro
+        if self.model_loaded or self.detector.online:
+            Path(self.model_path).parent.mkdir(parents=True, exist_ok=True)
+            self.detector.save_state(self.model_path)
+
+        # Statistiche e rollup su più giorni: la finestra dell'ultima ora si
+        # sovrappone all'esecuzione precedente, solo gli eventi nuovi contano
+        fresh_events = analyzed_events
+        if last_event is not None:
+            fresh_events = analyzed_events[analyzed_events['timestamp'] > pd.Timestamp(last_event)]
+        self.advisor.observe(fresh_events)
+        if 'events' in self.writer.sinks and self.event_source != 'database':
+            self.writer.submit('events', fresh_events)
+        if len(analyzed_events):
+            last_event = max(pd.Timestamp(last_event or pd.Timestamp.min),
+                             analyzed_events['timestamp'].max()).isoformat()
+
         # Filtra anomalie
         anomalies = analyzed_events[analyzed_events['is_anomaly']]
-
         if len(anomalies) > 0:
             LOG.warning(f"Rilevate {len(anomalies)} anomalie!")
 
-            # Genera raccomandazioni
-            report = self.advisor.generate_report(anomalies)
+        # Genera raccomandazioni: le regole a finestra (spraying, stuffing)
+        # vedono tutti gli eventi analizzati, le altre solo le anomalie
+        report = self.advisor.generate_report(anomalies, explain=self.detector.explain,
+                                              events=analyzed_events)
 
+        if report.get('status') != 'clean':
             # Logga le raccomandazioni
             for rec in report.get('recommendations', []):
                 LOG.info(f"RACCOMANDAZIONE [{rec['priority'].upper()}]: {rec['action']} per {rec['target']} - {rec['reason']}")
 
-            # Salva report
-            self.save_report(report)
+            # Salva report (in background)
+            self.writer.submit('report', report)
         else:
             LOG.info("Nessuna anomalia rilevata")
 
+        self._save_run_state(signature, last_event)
+
+        # Riaddestramento solo se il monitor di drift lo ha richiesto
+        if self._retrain_requested:
+            self._start_background_retrain()
+
+    def _load_run_state(self) -> dict:
+        state_path = Path(self.config.get('run_state_path', 'models/run_state.json'))
+        try:
+            with open(state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_run_state(self, signature: Optional[dict], last_event: Optional[str] = None):
+        """Ricorda la firma del log analizzato (uscita rapida se non cambia)
+        e l'ultimo evento già aggregato nelle statistiche"""
+        if signature is None and last_event is None:
+            return
+        state_path = Path(self.config.get('run_state_path', 'models/run_state.json'))
+        state_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(state_path, 'w') as f:
+            json.dump({'log': signature, 'last_event': last_event}, f)
+
+    def serve(self):
+        """Servizio di scoring residente: modello e advisor restano in memoria
+        e i client (ai_security_advisor.client) inviano solo gli eventi"""
+        from ai_security_advisor.service import ScoringService, make_server, DEFAULT_ADDRESS
+        from ai_security_advisor.registry import is_registry_path
+
+        self._resident = True
+        service_config = self.config.get('service') or {}
+        address = service_config.get('address', DEFAULT_ADDRESS)
+        service = ScoringService(
+            self.detector, self.advisor, self.collector,
+            window_ms=service_config.get('batch_window_ms', 20),
+            max_batch_events=service_config.get('max_batch_events', 5000),
+            writer=self.writer
+        )
+        server = make_server(address, service)
+
+        # Le nuove versioni del registro sono installate a caldo
+        watcher = None
+        if is_registry_path(self.model_path):
+            watcher = self.detector.watch_registry(self.model_path)
+
+        # SIGTERM (systemd, kill) chiude il servizio come Ctrl+C
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: threading.Thread(target=server.shutdown).start())
+
+        LOG.info(f"Servizio di scoring in ascolto su {address}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            LOG.info("Arresto del servizio di scoring...")
+        finally:
+            server.server_close()
+            if watcher is not None:
+                watcher.stop()
+            # Persisti profili e baseline aggiornati durante il servizio
+            if self.model_loaded or self.detector.online:
+                self.detector.save_state(self.model_path)
+            self.advisor.save_state(force=True)
+            self.close()
+
     def save_report(self, report: dict):
         """Salva report su file"""
         import json
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         report_dir = Path("reports")
         report_dir.mkdir(exist_ok=True)
 
@@ -131,16 +391,43 @@ def main():
     parser = argparse.ArgumentParser(description="AI Security Advisor per OpenStack Keystone")
     parser.add_argument('--train', action='store_true', help='Addestra modello su dati storici')
     parser.add_argument('--once', action='store_true', help='Esegui analisi una volta')
+    parser.add_argument('--serve', action='store_true',
+                        help='Avvia il servizio di scoring residente (socket Unix o HTTP locale)')
     parser.add_argument('--config', default='config/config.yaml', help='Percorso file configurazione')
+    parser.add_argument('--force', action='store_true',
+                        help="Analizza anche se il log non è cambiato dall'ultima esecuzione")
+    parser.add_argument('--summary', type=int, metavar='ORE',
+                        help='Stampa il riepilogo delle ultime ORE dai rollup orari (24, 168, ...)')
 
     args = parser.parse_args()
 
+    if args.summary:
+        # Solo i rollup: nessun modello da caricare
+        import json
+        from ai_security_advisor.policy_advisor import PolicyAdvisor
+
+        config = AISecurityAdvisor.load_config(args.config)
+        summary = PolicyAdvisor(config.get('policy', {})).summarize(hours=args.summary)
+        print(json.dumps(summary, indent=2, default=str))
+        return
+
+    # Uscita rapida: nessun nuovo dato, nessun import di pandas/sklearn
+    if not (args.train or args.serve or args.force):
+        if log_unchanged(AISecurityAdvisor.load_config(args.config)):
+            LOG.info("Nessun nuovo evento nel log dall'ultima analisi")
+            return
+
     advisor = AISecurityAdvisor(args.config)
 
-    if args.train:
-        advisor.train_initial_model()
-    else:
-        advisor.run_once()
+    try:
+        if args.train:
+            advisor.train_initial_model()
+        elif args.serve:
+            advisor.serve()
+        else:
+            advisor.run_once()
+    finally:
+        advisor.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
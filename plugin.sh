@@ -29,7 +29,7 @@ function ai_security_advisor_configure {
     # Crea configurazione
     cat > /opt/stack/ai-security-advisor/config/devstack.yaml << EOF
 log_path: "/opt/stack/logs/keystone.log"
-model_path: "/opt/stack/ai-security-advisor/models/trained_model.pkl"
+model_path: "/opt/stack/ai-security-advisor/models/registry"
 
 collector:
   type: "devstack"
@@ -54,10 +54,10 @@ debug:
   log_level: "INFO"
 EOF
 
-    # Crea il modello iniziale vuoto se non esiste
-    if [ ! -f "/opt/stack/ai-security-advisor/models/trained_model.pkl" ]; then
-        echo "Creating initial empty model..."
-        python3 -c "import pickle; pickle.dump({}, open('/opt/stack/ai-security-advisor/models/trained_model.pkl', 'wb'))"
+    # Addestra il modello iniziale se il registro non ha ancora una versione
+    if [ ! -L "/opt/stack/ai-security-advisor/models/registry/current" ]; then
+        echo "Training initial model..."
+        (cd /opt/stack/ai-security-advisor && python3 main.py --train --config config/devstack.yaml) || true
     fi
 }
 
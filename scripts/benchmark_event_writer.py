@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark del writer SQLite degli eventi analizzati
+Scrive batch sintetici (come quelli di detect_anomalies) su un database
+temporaneo e riporta le righe al secondo
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_security_advisor.database import EventWriter
+from ai_security_advisor.event_store import EventStore
+
+
+def synthetic_batch(n_rows: int, start: pd.Timestamp, rng: np.random.Generator) -> pd.DataFrame:
+    """Batch analizzato sintetico con ~1% di anomalie"""
+    timestamps = start + pd.to_timedelta(np.sort(rng.integers(0, 3600, n_rows)), unit='s')
+    users = rng.integers(0, 5000, n_rows)
+    ips = [f"10.{i >> 8 & 255}.{i & 255}.1" for i in rng.integers(0, 50000, n_rows)]
+    success = rng.random(n_rows) < 0.8
+    messages = np.where(success, 'Successful login', 'Authorization failed')
+    return pd.DataFrame({
+        'timestamp': timestamps,
+        'user': [f"user{u}" for u in users],
+        'ip': ips,
+        'event_type': np.where(success, 'auth_success', 'auth_failed'),
+        'success': success,
+        'anomaly_score': rng.normal(0.1, 0.05, n_rows),
+        'is_anomaly': rng.random(n_rows) < 0.01,
+        'unusual_ip': rng.random(n_rows) < 0.05,
+        'high_frequency': rng.random(n_rows) < 0.01,
+        'raw_line': [f"{t} {m} for user 'user{u}' from {ip}"
+                     for t, m, u, ip in zip(timestamps.astype(str), messages, users, ips)],
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EventWriter (SQLite)")
+    parser.add_argument('--rows', type=int, default=1000000, help='Righe totali da scrivere')
+    parser.add_argument('--batch-size', type=int, default=20000, help='Righe per transazione')
+    parser.add_argument('--dir', default=None, help='Directory del database (default: temporanea)')
+    parser.add_argument('--partitioned', action='store_true',
+                        help='Scrive con EventStore (un file per giorno) invece che su un unico file')
+    parser.add_argument('--inline-indexes', action='store_true',
+                        help='File unico: indici secondari aggiornati a ogni insert invece che alla chiusura')
+    parser.add_argument('--raw-line-codec', choices=['zlib', 'lzma'], default=None,
+                        help='Righe grezze nel RawLineStore compresso invece che in raw_line')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n_batches = max(args.rows // args.batch_size, 1)
+    # Un batch all'ora fino a ora: l'archivio partizionato misura la
+    # retention da oggi e scarta gli eventi futuri
+    start = pd.Timestamp.now().floor('h') - pd.Timedelta(hours=n_batches)
+    batches = [synthetic_batch(args.batch_size, start + pd.Timedelta(hours=i), rng)
+               for i in range(n_batches)]
+    n_rows = sum(len(batch) for batch in batches)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        if args.partitioned:
+            writer = EventStore(os.path.join(work_dir, 'events'), retention_days=365,
+                                raw_line_codec=args.raw_line_codec)
+        else:
+            writer = EventWriter(os.path.join(work_dir, 'events.db'), raw_line_codec=args.raw_line_codec,
+                                 defer_indexes=not args.inline_indexes)
+        elapsed = []
+        for batch in batches:
+            begin = time.perf_counter()
+            writer.write_batch(batch)
+            elapsed.append(time.perf_counter() - begin)
+        begin = time.perf_counter()
+        writer.close()
+        closing = time.perf_counter() - begin
+        size_mb = sum(os.path.getsize(os.path.join(root, name))
+                      for root, _, names in os.walk(work_dir) for name in names) / 1e6
+
+    total = sum(elapsed)
+    print(f"righe scritte            {n_rows:>12,}")
+    print(f"anomalie scritte         {writer.anomalies_written:>12,}")
+    print(f"tempo totale             {total:>12.2f} s")
+    print(f"throughput               {n_rows / total:>12,.0f} righe/s")
+    print(f"chiusura (indici)        {closing:>12.2f} s")
+    print(f"throughput con chiusura  {n_rows / (total + closing):>12,.0f} righe/s")
+    print(f"batch (mediana / max)    {np.median(elapsed) * 1000:>8.1f} / {max(elapsed) * 1000:.1f} ms")
+    print(f"dimensione su disco      {size_mb:>12.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
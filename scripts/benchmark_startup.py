@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Benchmark dei tempi di avvio a freddo della CLI
+Misura --help, un'esecuzione senza nuovi eventi e l'import del client,
+confrontati con l'import completo del motore (pandas + sklearn)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(PROJECT_DIR, 'main.py')
+
+
+def measure(command, runs: int, cwd: str) -> dict:
+    """Tempo di esecuzione (ms) di un comando in processi nuovi"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True, env=dict(os.environ, PYTHONPATH=PROJECT_DIR),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'min_ms': round(min(timings), 1), 'median_ms': round(statistics.median(timings), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark avvio a freddo")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Log già analizzato: run_state.json ha la stessa firma del file
+        log_path = os.path.join(work_dir, 'keystone.log')
+        with open(log_path, 'w') as f:
+            f.write("2024-01-01 10:00:00 Successful login for user 'alice' from 10.0.0.5\n")
+        stat = os.stat(log_path)
+        state_path = os.path.join(work_dir, 'run_state.json')
+        with open(state_path, 'w') as f:
+            json.dump({'log': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}}, f)
+
+        config_path = os.path.join(work_dir, 'config.yaml')
+        with open(config_path, 'w') as f:
+            f.write(f"log_path: {log_path}\nrun_state_path: {state_path}\n")
+
+        python = sys.executable
+        benchmarks = {
+            'interpreter': [python, '-c', 'pass'],
+            'main --help': [python, MAIN, '--help'],
+            'main --once (nessun nuovo evento)': [python, MAIN, '--once', '--config', config_path],
+            'import client': [python, '-c', 'import ai_security_advisor.client'],
+            'import ai_engine (riferimento)': [python, '-c', 'import ai_security_advisor.ai_engine'],
+        }
+
+        for name, command in benchmarks.items():
+            result = measure(command, args.runs, work_dir)
+            print(f"{name:<40} min {result['min_ms']:>8.1f} ms   mediana {result['median_ms']:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
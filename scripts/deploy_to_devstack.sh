@@ -62,8 +62,9 @@ echo "5. ⚙️  Configurazione per DevStack..."
 ssh $VM_USER@$VM_IP "cat > $AI_DIR/config/devstack.yaml << 'EOF'
 # Configurazione per DevStack
 log_path: \"/opt/stack/logs/keystone.log\"
-model_path: \"$AI_DIR/models/devstack_model.pkl\"
-database_path: \"$AI_DIR/security_events.db\"
+model_path: \"$AI_DIR/models/devstack\"
+database_path: \"$AI_DIR/data/events\"  # directory: un database SQLite per giorno
+database_partitioned: true
 
 collector:
   type: \"devstack\"